@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+#
+# Compare csv parsing throughput - the old readline/split loop against the
+# chunked numpy parser. Uses the given file, or generates a forecast-style file.
+# With -z, also compares compressed copies of the file read with decompression
+# in a background thread and inline.
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import chunked_csv
+import streams
+
+MODELHEADER = "xid,yid,date_id,hour,model,wind\n"
+
+
+def generate(fn, nrows):
+    """
+    Write a forecast-style file of roughly nrows rows.
+    """
+    logging.warning("Generating {} rows into {} ...".format(nrows, fn))
+    rnd = random.Random(1)
+    with open(fn, "w") as f:
+        f.write(MODELHEADER)
+        count = 0
+        x = 1
+        while count < nrows:
+            for y in range(1, 422):
+                for hour in range(3, 21):
+                    for model in range(1, 11):
+                        f.write("{},{},1,{},{},{}\n".format(x, y, hour, model, round(rnd.uniform(0, 30), 2)))
+                count += 180
+                if count >= nrows:
+                    break
+            x += 1
+
+
+def bench_readline(fn):
+    """
+    The per-row parsing used throughout the tools before chunked_csv.
+    :return: rows parsed
+    """
+    rows = 0
+    with open(fn, "r") as f:
+        line = f.readline()
+        line = f.readline()
+        while line != '':
+            fields = line[:-1].split(',')
+            values = [int(v) for v in fields[:-1]]
+            values.append(float(fields[-1]))
+            rows += 1
+            line = f.readline()
+    return rows
+
+
+def bench_chunked(fn):
+    rows = 0
+    for cols in chunked_csv.read_columns(fn):
+        rows += len(cols["xid"])
+    return rows
+
+
+def bench_threaded(fn):
+    """
+    Chunked parsing with decompression in a background thread.
+    """
+    rows = 0
+    with streams.open_file(fn, "rb", threaded=True) as f:
+        names = chunked_csv.read_header(f)
+        for block in chunked_csv.read_blocks(f):
+            rows += len(chunked_csv.parse_block(block, len(names)))
+    return rows
+
+
+def bench_inline(fn):
+    """
+    Chunked parsing with decompression done inline by the parsing thread.
+    """
+    rows = 0
+    with streams.open_file(fn, "rb", threaded=False) as f:
+        names = chunked_csv.read_header(f)
+        for block in chunked_csv.read_blocks(f):
+            rows += len(chunked_csv.parse_block(block, len(names)))
+    return rows
+
+
+def compress(fn, ext):
+    """
+    Write a compressed copy of fn.
+    :return: name of the copy
+    """
+    out = fn + ext
+    logging.warning("Compressing {} ...".format(out))
+    with open(fn, "rb") as fin:
+        with streams.open_file(out, "wb") as fout:
+            shutil.copyfileobj(fin, fout, streams.BLOCK_BYTES)
+    return out
+
+
+def run(name, func, fn, size=None):
+    """
+    :param size: bytes to report throughput against - the file size by default
+    """
+    if size is None:
+        size = os.path.getsize(fn)
+    start = time.time()
+    rows = func(fn)
+    elapsed = time.time() - start
+    print("{:10} {:>12} rows {:8.2f} s {:>14.0f} rows/s {:8.1f} MB/s".format(
+        name, rows, elapsed, rows / elapsed, size / elapsed / 1e6))
+    return rows / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", default=None, help="csv file to parse - generated if not given")
+    parser.add_argument("-n", "--rows", default=2000000, type=int, help="rows to generate")
+    parser.add_argument("-z", "--compress", default=[], action="append", choices=sorted(streams.CODECS),
+                        help="also time a compressed copy - may be repeated")
+    parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    args = parser.parse_args()
+    nl = getattr(logging, args.log.upper(), None)
+    if not isinstance(nl, int):
+        raise ValueError("Invalid log level: {}".format(args.log))
+    logging.basicConfig(level=nl,
+                        format='%(message)s')
+    tmpdir = None
+    fn = args.input
+    if fn is None:
+        tmpdir = tempfile.mkdtemp()
+        fn = os.path.join(tmpdir, "bench.csv")
+        generate(fn, args.rows)
+    copies = []
+    try:
+        before = run("readline", bench_readline, fn)
+        after = run("chunked", bench_chunked, fn)
+        print("speedup x{:.1f}".format(after / before))
+        # compressed throughput is given against the uncompressed size
+        size = os.path.getsize(fn)
+        for ext in args.compress:
+            copies.append(compress(fn, ext))
+            inline = run(ext + " inline", bench_inline, copies[-1], size)
+            threaded = run(ext + " thread", bench_threaded, copies[-1], size)
+            print("{} : x{:.2f} of plain, thread x{:.2f} of inline".format(ext, threaded / after, threaded / inline))
+    finally:
+        for copy in copies:
+            os.remove(copy)
+        if tmpdir is not None:
+            os.remove(fn)
+            os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
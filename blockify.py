@@ -3,177 +3,279 @@
 # takes a NxNxT data set, and transforms to smaller MxMxT set
 # where M = N / ratio.  The data value per "block" is set
 # according to various strategies controller by args.
+#
+# By default the input csv is streamed through a Blockifier into one csv of blocks,
+# at a single ratio, with the mean, max, min and count of every block.
+# With -P each day of the input is instead reduced to a pyramid of coarser grids, each
+# ratio times coarser than the one before (2x, 4x, 8x ... for a ratio of 2), one
+# cube per level :
+#    <output root>_x<factor>.cube  shape (1, days, hours, ceil(x / factor), ceil(y / factor))
+# A block is reduced with the mode - mean, max, min or a percentile such as p90 -
+# over the cells of it that have data, so the blocks of a ragged edge are only
+# partly filled. Blocks with no data are NaN.
 
 import argparse
 import logging
+import os
 
-INPUTFILE = "combined_test.csv"
-OUTPUTFILE = "blockified.csv" 
+import numpy as np
 
-class Block(object):
-    """
-    Holds data for a block
-    """
-    ADD = 0
-    MAX = 1
-    
-    def __init__(self, x, y, d, h, points, mode):
-        self.x = x
-        self.y = y
-        self.d = d
-        self.h = h
-        self.points = points
-        self.value = 0.0
-        self.count = 0
-        self.mode = Block.ADD
-
-    def add(self, v):
-        if self.mode == Block.ADD:
-            self.value += v
-        else:
-            if v > self.value:
-                self.value = v
-        self.count += 1
-        if self.count == self.points:
-            return True
-        return False
-
-    def get(self):
-        if self.mode == Block.ADD:
-            return self.value / self.count
-        else:
-            return self.value
+import chunked_csv
+import metrics
+import sidecar
+import streams
+import windcube
 
-    def __str__(self):
-        return "Block {}.{}.{}.{} value {}".format(self.x, self.y, self.d, self.h, self.get())
-
-    def get_line(self):
-        return "{},{},{},{},{}\n".format(self.x, self.y, self.d, self.h, self.get())
 
+INPUTFILE = "combined_test.csv"
+OUTPUTFILE = "blockified.csv" 
+LEVELS = 4
+MODES = ("mean", "max", "min", "p<percentile>")
 
 class Blockifier(object):
     """
-    Takes a single stream of line data and produces :
-        * A file with the blockified 3-d data.
-        * A file per block with the raw data.
+    Takes a single stream of column data, in the x order the csv files are written
+    in, and produces a csv file of blocks keyed by (day, hour, bx, by).
+    Only the stripe of blocks of the current bx is held - as (days, hours, by) arrays
+    of sum, max, min and count - and it is written out as soon as the input moves on
+    to the next stripe, so memory does not depend on the size of the input.
     Input stream = xid,yid,date_id,hour,wind
-    Output stream = xid',yid',date_id,hour,processed(wind)
-    per-block files = selected data as per input stream
+    Output stream = bx,by,date_id,hour,wind,mean,max,min,count
+    where wind is the mean or the max as the mode asks, and bx, by start at 0 for
+    xid, yid 1 .. ratio.
     """
 
-    header = "bx,by,date_id,hour,wind\n"
+    ADD = 0
+    MAX = 1
+    header = "bx,by,date_id,hour,wind,mean,max,min,count\n"
 
-    def __init__(self, ratio, foutn, mode):
-        self.store = {}
+    def __init__(self, ratio, foutn, mode, meta):
+        """
+        :param mode: Blockifier.ADD or Blockifier.MAX
+        :param meta: sidecar metadata of the input - its days, hours and y size
+        """
         self.ratio = ratio
-        self.max_points = ratio * ratio
-        self.fout = open(foutn, "w")
-        self.fout.write(Blockifier.header)
         self.mode = mode
+        self.days = np.array(meta["days"])
+        self.min_hour = meta["min_hour"]
+        self.shape = (len(meta["days"]), meta["max_hour"] - meta["min_hour"] + 1, -(-meta["ysize"] // ratio))
+        self.bx = None
+        self.sums = np.zeros(self.shape)
+        self.maxs = np.full(self.shape, -np.inf)
+        self.mins = np.full(self.shape, np.inf)
+        self.counts = np.zeros(self.shape, dtype=np.int64)
+        self.stripes = 0
+        self.fout = streams.open_file(foutn, "w")
+        self.fout.write(Blockifier.header)
 
-    def add_line(self, line):
+    def add_columns(self, cols):
         """
-        
+        Add a block of parsed rows - their xid must not go back to an earlier stripe.
         """
-        xid_r, yid_r, date_r, hour_r, wind_r = line[:-1].split(',')
-        xid, yid, date, hour, wind = int(xid_r), int(yid_r), int(date_r), int(hour_r), float(wind_r)
-        bx = int(xid / self.ratio)
-        by = int(yid / self.ratio)
-        key = "{0}_{1}_{2}".format(bx, by, hour)
-        if key in self.store:
-            if self.store[key].add(wind):  # true implies full
-                logging.info("{} is full".format(self.store[key]))
-                newline = self.store[key].get_line()
-                self.fout.write(newline)
-                del(self.store[key])
-                logging.info("Removed block {}".format(key))
-        else:
-            self.store[key] = Block(bx, by, date, hour, self.max_points, self.mode)
-            logging.info("Adding new block {} - total is {}".format(key, len(self.store)))
-            if self.store[key].add(wind):  # true implies full
-                logging.info("{} is full".format(self.store[key]))
-                newline = self.store[key].get_line()
-                self.fout.write(newline)
-                del(self.store[key])
-                logging.info("Removed block {}".format(key))
+        bx = (cols["xid"] - 1) // self.ratio
+        assert np.all(bx[1:] >= bx[:-1]) and (self.bx is None or bx[0] >= self.bx), \
+            "Input is not in x order - build a pyramid from it instead"
+        starts = np.flatnonzero(np.diff(bx)) + 1
+        for s, e in zip(np.concatenate(([0], starts)).tolist(), np.concatenate((starts, [len(bx)])).tolist()):
+            if bx[s] != self.bx:
+                self.flush()
+                self.bx = int(bx[s])
+            self.add_stripe(dict((k, v[s:e]) for k, v in cols.items()))
+
+    def add_stripe(self, cols):
+        index = np.ravel_multi_index((np.searchsorted(self.days, cols["date_id"]),
+                                      cols["hour"] - self.min_hour,
+                                      (cols["yid"] - 1) // self.ratio), self.shape)
+        size = self.counts.size
+        wind = cols["wind"]
+        self.sums += np.bincount(index, weights=wind, minlength=size).reshape(self.shape)
+        self.counts += np.bincount(index, minlength=size).reshape(self.shape)
+        np.maximum.at(self.maxs.reshape(-1), index, wind)
+        np.minimum.at(self.mins.reshape(-1), index, wind)
+
+    def flush(self):
+        """
+        Write out the blocks of the current stripe, in by, day, hour order, and clear it.
+        """
+        if self.bx is None:
+            return
+        order = (2, 0, 1)
+        counts = self.counts.transpose(order)
+        present = counts > 0
+        by, di, hi = np.nonzero(present)
+        means = self.sums.transpose(order)[present] / counts[present]
+        maxs = self.maxs.transpose(order)[present]
+        mins = self.mins.transpose(order)[present]
+        winds = means if self.mode == Blockifier.ADD else maxs
+        for row in zip(by.tolist(), self.days[di].tolist(), (hi + self.min_hour).tolist(), winds.tolist(),
+                       means.tolist(), maxs.tolist(), mins.tolist(), counts[present].tolist()):
+            self.fout.write("{},{},{},{},{},{},{},{},{}\n".format(self.bx, *row))
+        logging.debug("Stripe {} written - {} blocks".format(self.bx, len(by)))
+        self.stripes += 1
+        self.sums[:] = 0
+        self.maxs[:] = -np.inf
+        self.mins[:] = np.inf
+        self.counts[:] = 0
 
     def drain(self):
-        logging.info("Draining remaining blocks")
-        sz = len(self.store)
-        logging.info("Starting drain with {} items".format(sz))
-        for k in self.store.keys():
-            logging.info("{} -> {}".format(k, self.store[k]))
-            newline = self.store[k].get_line()
-            self.fout.write(newline)
-            self.store[k] = None
+        self.flush()
+        self.bx = None
+        logging.info("Wrote {} stripes of blocks".format(self.stripes))
         self.fout.close()
-        
-        
 
-def process_and_block(args):
+
+def process_and_block(args, phase):
     if args.mode.upper() == 'ADD':
-        blker = Blockifier(args.ratio, args.output, Block.ADD)
+        mode = Blockifier.ADD
     else:
         if args.mode.upper() == 'MAX':
-            blker = Blockifier(args.ratio, args.output, Block.MAX)
+            mode = Blockifier.MAX
         else:
-            raise("Unknown mode")
-    with open(args.input, "r") as f:
-        line = f.readline()
-        assert line == "xid,yid,date_id,hour,wind\n", "line is : " + line
-        line = f.readline()
-        while line != '':
-            blker.add_line(line)
-            line = f.readline()
+            raise ValueError("Unknown mode {} - use add or max".format(args.mode))
+    blker = Blockifier(args.ratio, args.output, mode, sidecar.load_sidecar(args.input))
+    for cols in chunked_csv.read_columns(args.input, "xid,yid,date_id,hour,wind\n"):
+        phase.add(len(cols["wind"]))
+        blker.add_columns(cols)
     blker.drain()
-        
-
-def scan_file_for_max(fn):
-    mx = 0
-    my = 0
-    mh = 0
-    logging.warning("Scanning input file for max_x and max_y ...")
-    with open(fn, "r") as f:
-        line = f.readline()
-        assert line == "xid,yid,date_id,hour,wind\n", "line is : " + line
-        line = f.readline()
-        while line != '':
-            # note dropping of final \n
-            xid_r, yid_r, date_r, hour_r, wind_r = line[:-1].split(',')
-            xid, yid, hid = int(xid_r), int(yid_r), int(hour_r)
-            if xid > mx:
-                mx = xid
-            if yid > my:
-                my = yid
-            if hid > mh:
-                mh = hid
-            line = f.readline()
-        return mx, my, mh
+
+
+def block_view(data, ratio):
+    """
+    View of the (hours, x, y) data as blocks, padded with NaN out to whole blocks.
+    :return: array (hours, x blocks, y blocks, ratio * ratio)
+    """
+    hours, xsize, ysize = data.shape
+    nx = -(-xsize // ratio)
+    ny = -(-ysize // ratio)
+    if (nx * ratio, ny * ratio) != (xsize, ysize):
+        padded = np.full((hours, nx * ratio, ny * ratio), np.nan, dtype=data.dtype)
+        padded[:, :xsize, :ysize] = data
+        data = padded
+    return data.reshape(hours, nx, ratio, ny, ratio).transpose(0, 1, 3, 2, 4).reshape(hours, nx, ny, ratio * ratio)
+
+
+def block_percentile(blocks, q):
+    """
+    The q percentile of the values of each block, ignoring NaN, interpolated as
+    np.percentile does - by one sort of all the blocks rather than np.nanpercentile,
+    which goes block by block when there are NaNs.
+    :param blocks: array (..., values)
+    """
+    ordered = np.sort(blocks, axis=-1)  # NaN sorts last
+    count = (~np.isnan(blocks)).sum(axis=-1)
+    pos = np.maximum(count - 1, 0) * (q / 100.0)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, np.maximum(count - 1, 0))
+    low = np.take_along_axis(ordered, lo[..., None], axis=-1)[..., 0]
+    high = np.take_along_axis(ordered, hi[..., None], axis=-1)[..., 0]
+    result = low + (high - low) * (pos - lo)
+    result[count == 0] = np.nan
+    return result
+
+
+def build_pyramid(day, ratio, levels, mode):
+    """
+    Reduce the (hours, x, y) data of a day to coarser and coarser grids.
+    Max and min levels are built from the level before, means from the sums and
+    counts of the level before, and percentiles from the day itself.
+    :param mode: "mean", "max", "min" or "p" and a percentile, e.g. "p90"
+    :return: list of arrays (hours, x blocks, y blocks), ratio, ratio ** 2 ... times coarser
+    """
+    pyramid = []
+    if mode == "mean":
+        sums = np.nan_to_num(day, nan=0.0).astype(np.float64)
+        counts = (~np.isnan(day)).astype(np.int64)
+        for _ in range(levels):
+            sums = block_view(sums, ratio)
+            counts = block_view(counts.astype(np.float64), ratio)
+            sums = np.nansum(sums, axis=-1)
+            counts = np.nansum(counts, axis=-1)
+            with np.errstate(invalid="ignore"):
+                pyramid.append(sums / counts)
+    elif mode in ("max", "min"):
+        reduce = np.fmax.reduce if mode == "max" else np.fmin.reduce  # NaN only if every value is
+        level = day
+        for _ in range(levels):
+            level = reduce(block_view(level, ratio), axis=-1)
+            pyramid.append(level)
+    else:
+        assert mode.startswith("p"), "Unknown mode {} - use one of {}".format(mode, ", ".join(MODES))
+        q = float(mode[1:])
+        for k in range(1, levels + 1):
+            pyramid.append(block_percentile(block_view(day, ratio ** k), q))
+    return pyramid
+
+
+def level_name(output, factor):
+    root, _ = os.path.splitext(streams.strip_codec(output))
+    return "{}_x{}{}".format(root, factor, windcube.CUBE_EXTENSION)
+
+
+def make_pyramid(args, phase):
+    """
+    Write the pyramid cubes of every day of the input.
+    :return: files written
+    """
+    header = windcube.header_any(args.input)
+    assert not header["models"], "Expected data without a model column - combined or in-situ data"
+    mode = args.mode.lower()
+    if mode == "add":
+        mode = "mean"
+    names = []
+    cubes = []
+    for k in range(1, args.levels + 1):
+        factor = args.ratio ** k
+        lheader = windcube.make_header(-(-header["xsize"] // factor), -(-header["ysize"] // factor),
+                                       header["min_hour"], header["max_hour"], header["days"], [])
+        lheader["ratio"] = factor
+        lheader["mode"] = mode
+        names.append(level_name(args.output, factor))
+        logging.warning("Creating level cube {} with shape {} ...".format(names[-1], lheader["shape"]))
+        cubes.append(windcube.create_cube(names[-1], lheader))
+    for di, day in enumerate(header["days"]):
+        data, dheader = windcube.open_any(args.input, day)
+        day_data = np.asarray(data[0, windcube.day_index(dheader, day)])
+        for cube, level in zip(cubes, build_pyramid(day_data, args.ratio, args.levels, mode)):
+            cube[0, di] = level
+        phase.add(day_data.size)
+    for cube in cubes:
+        cube.flush()
+    return names
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", default=INPUTFILE, help="file to process")
-    parser.add_argument("-o", "--output", default=OUTPUTFILE, help="output file name")
-    parser.add_argument("-r", "--ratio", default=10, type=int, help="ratio of reduction")
-    parser.add_argument("-x", "--max_x", default=0, type=int, help="max x value - if not provided, the file will be scanned.")
-    parser.add_argument("-y", "--max_y", default=0, type=int, help="max y value - if not provided, the file will be scanned.")
-    parser.add_argument("-H", "--max_h", default=0, type=int, help="max hour value - if not provided, the file will be scanned.")
+    parser.add_argument("-o", "--output", default=OUTPUTFILE,
+                        help="output file name - the root of the level cube names for a pyramid")
+    parser.add_argument("-r", "--ratio", default=None, type=int,
+                        help="ratio of reduction - default 10, or 2 between pyramid levels")
+    parser.add_argument("-P", "--pyramid", action="store_true",
+                        help="write a pyramid of level cubes rather than a single csv of blocks")
+    parser.add_argument("-L", "--levels", default=LEVELS, type=int, help="number of pyramid levels")
     parser.add_argument("-l", "--log", default='INFO', help="Logging level to use.")
-    parser.add_argument("-m", "--mode", default='ADD', help="Mode to use - add or max.")
+    parser.add_argument("-m", "--mode", default='ADD',
+                        help="Mode to use - add or max, or for a pyramid also {}".format(", ".join(MODES)))
+    metrics.add_argument(parser)
     args = parser.parse_args()
     nl = getattr(logging, args.log.upper(), None)
     if not isinstance(nl, int):
         raise ValueError("Invalid log level: {}".format(args.log))
     logging.basicConfig(level=nl,
                         format='%(levelname)s:%(message)s')
-    if args.max_x == 0 or\
-       args.max_y == 0 or\
-       args.max_h == 0 :
-        args.max_x, args.max_y, args.max_h = scan_file_for_max(args.input)
-    logging.info("Max X, Y is {}, {}".format(args.max_x, args.max_y))
-    logging.info("Max hour seen = {}".format(args.max_h))
-    process_and_block(args)
+    meter = metrics.Metrics("blockify", args.metrics_out)
+    if args.pyramid:
+        if args.ratio is None:
+            args.ratio = 2
+        with meter.phase("pyramid", unit="cells", nbytes=metrics.file_bytes(args.input)) as phase:
+            make_pyramid(args, phase)
+        meter.total()
+        return
+    if args.ratio is None:
+        args.ratio = 10
+    with meter.phase("blockify", nbytes=metrics.file_bytes(args.input)) as phase:
+        process_and_block(args, phase)
+    meter.total()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+#
+# Wind bucket schemes, shared by the stages that bucket wind values :
+#    the SD per model per bucket (model_sd, model_stats) - default 6 buckets of 5 m/s
+#    the probability per bucket (weighted_means, the solvers) - default 60 buckets of 0.5 m/s
+# A scheme is a list of ascending lower edges, the last bucket being open ended, so
+# the buckets need not be of equal width. Values on an edge go to the upper bucket and
+# values below the first edge to the first bucket.
+# The files written with a bucket per column or value carry a "# edges = ..." line
+# unless they use the default scheme, so readers can rebuild the scheme they were
+# written with.
+
+import bisect
+
+import numpy as np
+
+EDGES_PREFIX = "# edges = "
+SD_WIDTH = 5
+SD_COUNT = 6
+PROB_WIDTH = 0.5
+PROB_COUNT = 60
+
+
+class BucketScheme(object):
+    """
+    Maps wind values to bucket indexes.
+    """
+
+    def __init__(self, edges):
+        """
+        :param edges: ascending lower edges of the buckets
+        """
+        self.edges = [float(e) for e in edges]
+        assert self.edges, "A bucket scheme needs at least one bucket"
+        assert all(a < b for a, b in zip(self.edges[:-1], self.edges[1:])), "Bucket edges must be ascending"
+        self.edge_array = np.array(self.edges)
+
+    @classmethod
+    def uniform(cls, width, count):
+        """
+        count buckets of the given width from 0, the last one open ended.
+        """
+        return cls([round(i * width, 9) for i in range(count)])  # 0.1 * 3 is not 0.3
+
+    @classmethod
+    def parse(cls, text, default_top):
+        """
+        Scheme from a command line option : either a bucket width, giving buckets up to
+        default_top, or a comma separated list of lower edges.
+        :param default_top: lower edge of the open ended bucket when only a width is given
+        """
+        values = [float(v) for v in text.split(",")]
+        if len(values) > 1:
+            return cls(values)
+        count = int(round(default_top / values[0])) + 1
+        return cls.uniform(values[0], count)
+
+    def __len__(self):
+        return len(self.edges)
+
+    def __eq__(self, other):
+        return isinstance(other, BucketScheme) and self.edges == other.edges
+
+    def __ne__(self, other):
+        return not self == other
+
+    def assign(self, values):
+        """
+        Bucket every value of an array at once.
+        :return: int64 array of bucket indexes, the shape of values
+        """
+        index = np.searchsorted(self.edge_array, values, side="right") - 1
+        return np.clip(index, 0, len(self.edges) - 1)
+
+    def index(self, value):
+        """
+        Bucket of a single value - for inner loops, where numpy calls cost too much.
+        """
+        return min(max(bisect.bisect_right(self.edges, value) - 1, 0), len(self.edges) - 1)
+
+    def titles(self):
+        """
+        :return: names of the buckets, e.g. "0..5-" and "25+"
+        """
+        names = ["{:g}..{:g}-".format(a, b) for a, b in zip(self.edges[:-1], self.edges[1:])]
+        return names + ["{:g}+".format(self.edges[-1])]
+
+    def edges_line(self):
+        return EDGES_PREFIX + ",".join("{!r}".format(e) for e in self.edges) + "\n"
+
+
+DEFAULT_SD = BucketScheme.uniform(SD_WIDTH, SD_COUNT)
+DEFAULT_PROB = BucketScheme.uniform(PROB_WIDTH, PROB_COUNT)
+
+
+def from_edges_line(line):
+    """
+    :return: the scheme of an edges line, or None if line is not one
+    """
+    if not line.startswith(EDGES_PREFIX):
+        return None
+    return BucketScheme(line[len(EDGES_PREFIX):].split(","))
+
+
+def write_edges(f, scheme, default):
+    """
+    Record a scheme in a file being written, unless it is the default one.
+    """
+    if scheme != default:
+        f.write(scheme.edges_line())
+
+
+def sd_option(parser):
+    parser.add_argument("-B", "--sd-buckets", default=None,
+                        help="Wind buckets for the per model SDs - a width, or comma separated lower edges. "
+                             "Default {} buckets of {}".format(SD_COUNT, SD_WIDTH))
+
+
+def prob_option(parser):
+    parser.add_argument("-P", "--prob-buckets", default=None,
+                        help="Wind buckets for the probabilities - a width, or comma separated lower edges. "
+                             "Default {} buckets of {}".format(PROB_COUNT, PROB_WIDTH))
+
+
+def sd_scheme(text):
+    """
+    :param text: value of the sd option, or None for the default
+    """
+    if text is None:
+        return DEFAULT_SD
+    return BucketScheme.parse(text, DEFAULT_SD.edges[-1])
+
+
+def prob_scheme(text):
+    """
+    :param text: value of the probability option, or None for the default
+    """
+    if text is None:
+        return DEFAULT_PROB
+    return BucketScheme.parse(text, DEFAULT_PROB.edges[-1])
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+#
+# Shared parsing layer for the csv weather files.
+# Rather than readline() + split() + int()/float() per row, large blocks of bytes are
+# read, cut at the last newline, and converted a whole block at a time by numpy's
+# C parser (np.loadtxt, numpy >= 1.23).
+# Callers get a dict of typed column arrays per block.
+
+import io
+import os
+
+import numpy as np
+
+import streams
+
+CHUNK_BYTES = 32 * 1024 * 1024
+CHUNK_ROWS = 1000000  # rows per read when walking files in step
+INT_COLUMNS = ("xid", "yid", "date_id", "hour", "model", "cid")
+INT_DTYPE = np.int32
+FLOAT_DTYPE = np.float64
+
+
+def read_blocks(f, chunk_bytes=CHUNK_BYTES, limit=None):
+    """
+    Read a binary stream in large blocks, each ending on a newline so no row is
+    split between two blocks.
+    :param f: file opened in binary mode, positioned after the header
+    :param limit: stop after this many bytes - the end of a byte range
+    :return: generator of bytes blocks
+    """
+    tail = b""
+    remaining = limit
+    while True:
+        if remaining is None:
+            data = f.read(chunk_bytes)
+        else:
+            data = f.read(min(chunk_bytes, remaining)) if remaining > 0 else b""
+            remaining -= len(data)
+        if not data:
+            if tail:
+                if not tail.endswith(b"\n"):  # last line without a newline
+                    tail += b"\n"
+                yield tail
+            return
+        if tail:
+            data = tail + data
+        cut = data.rfind(b"\n") + 1
+        if cut == 0:  # no complete row yet
+            tail = data
+            continue
+        tail = data[cut:]
+        yield data[:cut]
+
+
+def parse_block(block, ncols):
+    """
+    Convert a block of complete csv rows into a 2-d float array.
+    :param block: bytes ending with a newline
+    :param ncols: number of fields per row
+    :return: array of shape (rows, ncols)
+    """
+    table = np.loadtxt(io.BytesIO(block), dtype=FLOAT_DTYPE, delimiter=",", ndmin=2)
+    if table.shape[1] != ncols:
+        raise ValueError("Malformed csv block - expected {} columns, parsed {}".format(ncols, table.shape[1]))
+    return table
+
+
+def to_columns(table, names):
+    """
+    Split a parsed table into typed columns - ids become ints, everything else stays float.
+    :return: dict of column name to 1-d array
+    """
+    cols = {}
+    for i, name in enumerate(names):
+        if name in INT_COLUMNS:
+            cols[name] = table[:, i].astype(INT_DTYPE)
+        else:
+            cols[name] = table[:, i].copy()
+    return cols
+
+
+def header_names(header):
+    return header.strip().split(',')
+
+
+def read_header(f, expected=None):
+    """
+    :param f: file opened in binary mode
+    :param expected: header line the file must start with, including the newline
+    :return: list of column names
+    """
+    line = f.readline().decode("ascii")
+    if expected is not None:
+        assert line == expected, "Malformed file - header is : " + line
+    return header_names(line)
+
+
+def read_tables(fn, expected=None, chunk_bytes=CHUNK_BYTES):
+    """
+    :return: column names, generator of (rows, ncols) float arrays
+    """
+    f = streams.open_file(fn, "rb")
+    names = read_header(f, expected)
+
+    def tables():
+        with f:
+            for block in read_blocks(f, chunk_bytes):
+                yield parse_block(block, len(names))
+    return names, tables()
+
+
+def read_columns(fn, expected=None, chunk_bytes=CHUNK_BYTES):
+    """
+    Iterate over a csv file a block at a time.
+    :param fn: csv file name
+    :param expected: header line the file must start with, or None to accept any
+    :return: generator of dicts of column arrays
+    """
+    names, tables = read_tables(fn, expected, chunk_bytes)
+    for table in tables:
+        yield to_columns(table, names)
+
+
+def byte_ranges(fn, start, parts):
+    """
+    Split the rows of a file into byte ranges for parallel parsing.
+    Every range begins at the start of a line. Plain files only - compressed ones cannot seek.
+    :param start: offset of the first row, i.e. just after the header
+    :param parts: number of ranges wanted - fewer are returned for small files
+    :return: list of (start, end) offsets
+    """
+    size = os.path.getsize(fn)
+    bounds = [start]
+    with open(fn, "rb") as f:
+        for i in range(1, parts):
+            pos = start + (size - start) * i // parts
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()  # on to the start of the next line
+            pos = f.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_range_columns(fn, names, start, end, chunk_bytes=CHUNK_BYTES):
+    """
+    Iterate over the rows of one byte range, as given by byte_ranges.
+    :param names: column names from the header of the file
+    :return: generator of dicts of column arrays
+    """
+    with open(fn, "rb") as f:
+        f.seek(start)
+        for block in read_blocks(f, chunk_bytes, end - start):
+            yield to_columns(parse_block(block, len(names)), names)
+
+
+def read_range_slices(f, ranges, chunk_bytes=CHUNK_BYTES):
+    """
+    Get the bytes of a sorted list of byte ranges, reading in large sequential blocks
+    and only seeking over gaps that fall outside the current block.
+    Ranges longer than a block come out in several pieces.
+    :param f: file opened in binary mode
+    :param ranges: list of (start, end) offsets, in file order
+    :return: generator of (range index, bytes)
+    """
+    buf = b""
+    buf_start = 0
+    for i, (start, end) in enumerate(ranges):
+        pos = start
+        while pos < end:
+            if not buf_start <= pos < buf_start + len(buf):
+                f.seek(pos)
+                buf = f.read(chunk_bytes)
+                buf_start = pos
+                if not buf:
+                    raise IOError("Byte range {}..{} is beyond the end of the file".format(start, end))
+            stop = min(end, buf_start + len(buf))
+            yield i, buf[pos - buf_start:stop - buf_start]
+            pos = stop
+
+
+def read_ranges_columns(fn, names, ranges, chunk_bytes=CHUNK_BYTES):
+    """
+    Iterate over the rows held by a list of byte ranges - e.g. the rows of one day.
+    Every range must start and end on a line boundary.
+    :param names: column names from the header of the file
+    :return: generator of dicts of column arrays
+    """
+    pieces = []
+    size = 0
+    with open(fn, "rb") as f:
+        for _, data in read_range_slices(f, ranges, chunk_bytes):
+            pieces.append(data)
+            size += len(data)
+            if size >= chunk_bytes:
+                block = b"".join(pieces)
+                cut = block.rfind(b"\n") + 1
+                yield to_columns(parse_block(block[:cut], len(names)), names)
+                pieces = [block[cut:]]
+                size = len(pieces[0])
+    block = b"".join(pieces)
+    if block:
+        yield to_columns(parse_block(block, len(names)), names)
+
+
+class ColumnReader(object):
+    """
+    Hands out exactly the number of rows asked for, whatever the block boundaries are.
+    Used where two files have to be walked in step.
+    """
+
+    def __init__(self, fn, expected=None, chunk_bytes=CHUNK_BYTES):
+        self.names, self.tables = read_tables(fn, expected, chunk_bytes)
+        self.pending = np.empty((0, len(self.names)), dtype=FLOAT_DTYPE)
+
+    def read(self, nrows):
+        """
+        :param nrows: rows wanted
+        :return: dict of column arrays - shorter than nrows only at the end of the file
+        """
+        parts = [self.pending]
+        have = len(self.pending)
+        while have < nrows:
+            try:
+                table = next(self.tables)
+            except StopIteration:
+                break
+            parts.append(table)
+            have += len(table)
+        table = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        self.pending = table[nrows:]
+        return to_columns(table[:nrows], self.names)
+
+
+def read_groups(fn, expected, keys, size, chunk_rows=CHUNK_ROWS):
+    """
+    Iterate over a file whose rows come in consecutive groups of `size` rows sharing
+    the same key columns - e.g. the 10 model rows of one forecast location and hour.
+    Each block yielded holds whole groups only.
+    :param keys: names of the columns that must be equal within a group
+    :return: generator of dicts of column arrays
+    """
+    reader = ColumnReader(fn, expected)
+    chunk_rows -= chunk_rows % size
+    while True:
+        cols = reader.read(chunk_rows)
+        nrows = len(cols[reader.names[0]])
+        if nrows == 0:
+            return
+        assert nrows % size == 0, "Incomplete group at the end of {}".format(fn)
+        for k in keys:
+            grouped = cols[k].reshape(-1, size)
+            assert np.all(grouped == grouped[:, :1]), "Group of {} rows broken on {} in {}".format(size, k, fn)
+        yield cols
+
+
+def group_values(cols, size, index="model", value="wind"):
+    """
+    Lay the values of each group out as one row, placed by the (1 based) index column.
+    :param cols: block from read_groups
+    :return: array of shape (groups, size)
+    """
+    ngroups = len(cols[value]) // size
+    data = np.zeros((ngroups, size), dtype=FLOAT_DTYPE)
+    data[np.repeat(np.arange(ngroups), size), cols[index] - 1] = cols[value]
+    return data
+
+
+def format_rows(*columns):
+    """
+    Format columns back into csv text, one row per line.
+    Values go through str() so floats print exactly as the old per-row code did.
+    """
+    fmt = ",".join(["{}"] * len(columns)) + "\n"
+    return "".join([fmt.format(*row) for row in zip(*[c.tolist() for c in columns])])
+
+
+def field_bytes(values, decimals=0):
+    """
+    The ASCII bytes of a column of numbers as a matrix, one row per value, right aligned
+    and with 0 bytes as padding - see format_fixed.
+    :param decimals: digits after the point, rounded to - 0 prints whole numbers
+    :return: uint8 array of shape (values, width)
+    """
+    scaled = np.rint(np.asarray(values, dtype=np.float64) * 10 ** decimals).astype(np.int64)
+    negative = scaled < 0
+    magnitude = np.abs(scaled)
+    width = max(len(str(int(magnitude.max()))) if len(magnitude) else 1, decimals + 1)
+    # digits of each value, leading zeros kept down to the one before the point
+    shown = np.full(len(scaled), decimals + 1)
+    for k in range(decimals + 1, width):
+        shown += magnitude >= 10 ** k
+    digits = np.zeros((len(scaled), width), dtype=np.uint8)
+    for i in range(width):
+        place = width - 1 - i
+        digits[:, i] = np.where(place < shown, 48 + (magnitude // 10 ** place) % 10, 0)
+    sign = np.where(negative, ord("-"), 0).astype(np.uint8)[:, None]
+    if decimals == 0:
+        return np.hstack((sign, digits))
+    point = np.full((len(scaled), 1), ord("."), dtype=np.uint8)
+    return np.hstack((sign, digits[:, :width - decimals], point, digits[:, width - decimals:]))
+
+
+def format_fixed(columns, decimals):
+    """
+    Format columns into csv bytes, one row per line, without going through Python for
+    each value : every field is built as a matrix of bytes, and the padding dropped.
+    :param columns: list of arrays of the same length
+    :param decimals: digits after the point for each column, 0 for whole numbers
+    :return: bytes
+    """
+    n = len(columns[0])
+    parts = []
+    for i, (column, places) in enumerate(zip(columns, decimals)):
+        parts.append(field_bytes(column, places))
+        parts.append(np.full((n, 1), ord(",") if i < len(columns) - 1 else ord("\n"), dtype=np.uint8))
+    text = np.hstack(parts).ravel()
+    return text[text != 0].tobytes()
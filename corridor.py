@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+#
+# Coarse to fine solving : the path of every city is first found on a coarse grid of
+# ratio x ratio blocks, each with the highest cost of its cells (a max-pooled
+# blockify level, so the coarse costs never understate the risk). The fine solve then
+# only gets the cells of the blocks those paths go through, widened by a number of
+# blocks either side - the corridor. Every other cell costs +inf, which the solvers
+# never enter.
+# On the coarse grid a move to the next block takes ratio steps and adds ratio times
+# the block cost of the hour, and a stay adds the block cost at each hour change, as
+# the fine solvers do per cell.
+# A route leaving the corridor has to go through one of its edge cells first, then
+# through an outside cell next to it, then on to the city. Costs only add up, and every
+# move adds the cost of the cell moved into at some hour of the day, so such a route
+# costs at least the lowest cost the edge cell was reached at, plus the cheapest way
+# from the outside cell to the city over cells each costing their lowest cost of the
+# day. That static shortest path is found from every outside cell at once, by passes
+# over the rows, so one solve gives the bound of every city. If the bound of a city is
+# not below the cost found in the corridor, the corridor did not change its path.
+# Otherwise the corridor constraint may have been active for the city, and it is
+# solved again in a corridor WIDEN times as wide around its own coarse path, and so on.
+# Once the box around a corridor would cover more than MAX_AREA of the grid, the cities
+# left are solved on the whole grid.
+# The solvers write what happened to each city to a csv :
+#    cid,width,confidence,corridor_confidence
+# with width the blocks either side of the corridor the path was taken from, or
+# "full" for the whole grid, and corridor_confidence that of the path found in the
+# first corridor - where the two confidences differ, that corridor was active.
+
+import logging
+import math
+
+import numpy as np
+
+import blockify
+import streams
+
+RATIO = 10
+WIDTH = 2
+REPORT = "corridor_report.csv"
+REPORT_HEADER = "cid,width,confidence,corridor_confidence\n"
+INF = float("inf")
+# relative slack on the bound, for the rounding of the costs the solvers add up in float32
+SLACK = 1e-5
+WIDEN = 2
+# a corridor whose box covers more of the grid than this saves too little over the whole
+# grid - the solvers only solve the box around the corridor
+MAX_AREA = 0.5
+# weights above this are capped - a lower weight keeps the bound a bound, and the row
+# sums stay finite
+CAP = 1e4
+# parent codes of the coarse solve : stay, then the moves, as (dx, dy)
+MOVES = ((0, 0), (-1, 0), (1, 0), (0, -1), (0, 1))
+
+
+def shifted(values, dx, dy, fill=INF):
+    """
+    :return: array where [x][y] holds values[x - dx][y - dy] - the value of the cell a
+             move of (dx, dy) comes from - and fill off the grid
+    """
+    out = np.full_like(values, fill)
+    xs, ys = values.shape
+    out[max(dx, 0):xs + min(dx, 0), max(dy, 0):ys + min(dy, 0)] = \
+        values[max(-dx, 0):xs + min(-dx, 0), max(-dy, 0):ys + min(-dy, 0)]
+    return out
+
+
+def coarse_solve(coarse, ratio, start, steps_per_hour, total_steps):
+    """
+    Lowest cost of reaching every block at every coarse step from the start block.
+    :param coarse: block costs (hours, x blocks, y blocks)
+    :param start: (x, y) of the start block
+    :return: costs (steps, x blocks, y blocks), parent codes of the same shape - an
+             index into MOVES
+    """
+    nsteps = total_steps // ratio
+    values = np.full((nsteps,) + coarse.shape[1:], INF)
+    parents = np.zeros(values.shape, dtype=np.int8)
+    values[0][start] = coarse[0][start]
+    last_hour = len(coarse) - 1
+    for k in range(1, nsteps):
+        hour = min(k * ratio // steps_per_hour, last_hour)
+        stay = coarse[hour] if hour != (k - 1) * ratio // steps_per_hour else 0.0
+        candidates = [values[k - 1] + stay] + \
+                     [shifted(values[k - 1], dx, dy) + ratio * coarse[hour] for dx, dy in MOVES[1:]]
+        candidates = np.array(candidates)
+        parents[k] = np.argmin(candidates, axis=0)
+        values[k] = np.take_along_axis(candidates, parents[k][None].astype(np.int64), axis=0)[0]
+    return values, parents
+
+
+def coarse_path(values, parents, block):
+    """
+    Walk back from the cheapest step at which a block is reached.
+    :return: list of (x, y) blocks from the start, or None if it is never reached
+    """
+    k = int(np.argmin(values[:, block[0], block[1]]))
+    if values[k, block[0], block[1]] == INF:
+        return None
+    x, y = block
+    path = [(x, y)]
+    for step in range(k, 0, -1):
+        dx, dy = MOVES[parents[step, x, y]]
+        x -= dx
+        y -= dy
+        path.append((x, y))
+    return path[::-1]
+
+
+def corridor_mask(costs, cities, steps_per_hour, total_steps, ratio=RATIO, width=WIDTH, cids=None):
+    """
+    The cells of the corridor around the coarse paths of the cities.
+    :param costs: fine costs (hours, x, y)
+    :param cities: list of (x, y), the start first
+    :param width: blocks added either side of the coarse paths
+    :param cids: ids of the cities to take the paths of, None for all
+    :return: boolean array (x, y), True inside the corridor
+    """
+    coarse = blockify.build_pyramid(np.asarray(costs), ratio, 1, "max")[0]
+    start = (cities[0][0] // ratio, cities[0][1] // ratio)
+    values, parents = coarse_solve(coarse, ratio, start, steps_per_hour, total_steps)
+    blocks = np.zeros(coarse.shape[1:], dtype=bool)
+    blocks[start] = True
+    for cid in range(1, len(cities)) if cids is None else cids:
+        city = cities[cid]
+        path = coarse_path(values, parents, (city[0] // ratio, city[1] // ratio))
+        if path is None:
+            logging.warning("City {} not reached on the coarse grid - solving the whole grid".format(cid))
+            return np.ones(costs.shape[1:], dtype=bool)
+        for b in path:
+            blocks[b] = True
+    for _ in range(width):
+        grown = blocks.copy()
+        for dx, dy in MOVES[1:]:
+            grown |= shifted(blocks, dx, dy, False)
+        blocks = grown
+    mask = np.repeat(np.repeat(blocks, ratio, axis=0), ratio, axis=1)
+    xsize, ysize = costs.shape[1:]
+    mask = mask[:xsize, :ysize]
+    logging.warning("Corridor of {} blocks of {}x{} - {:.1f}% of the grid".format(
+        int(blocks.sum()), ratio, ratio, 100.0 * mask.sum() / mask.size))
+    return mask
+
+
+def bounding_box(mask):
+    """
+    :return: (x slice, y slice) of the smallest box holding the whole corridor
+    """
+    xs = np.nonzero(mask.any(axis=1))[0]
+    ys = np.nonzero(mask.any(axis=0))[0]
+    return slice(int(xs[0]), int(xs[-1]) + 1), slice(int(ys[0]), int(ys[-1]) + 1)
+
+
+def box_area(box):
+    """
+    :return: cells in a box from bounding_box
+    """
+    return (box[0].stop - box[0].start) * (box[1].stop - box[1].start)
+
+
+def restrict(costs, mask):
+    """
+    :return: the costs with every cell outside the corridor at +inf
+    """
+    return np.where(mask[None], costs, np.float32(INF))
+
+
+def edge(mask):
+    """
+    :return: boolean array (x, y) of the corridor cells next to a cell outside it
+    """
+    outside = ~mask
+    near = np.zeros_like(mask)
+    for dx, dy in MOVES[1:]:
+        near |= shifted(outside, dx, dy, False)
+    return mask & near
+
+
+def edge_cells(mask):
+    """
+    :return: list of the (x, y) corridor cells next to a cell outside it
+    """
+    return list(zip(*[a.tolist() for a in np.nonzero(edge(mask))]))
+
+
+def along_row(dist, weights):
+    """
+    Lower the distances of one row, moving along it either way. With S the sums of the
+    weights up to each cell, dist[i] = S[i] + min over j <= i of (dist[j] - S[j]) one
+    way, and the same on the reversed row the other.
+    """
+    for d, w in ((dist, weights), (dist[::-1], weights[::-1])):
+        upto = np.cumsum(w)
+        np.minimum(d, upto + np.minimum.accumulate(d - upto), out=d)
+
+
+def settle(dist, weights):
+    """
+    Lower the distances in place to the cheapest way of reaching each cell from any
+    cell, moving one cell at a time and paying the weight of every cell moved into.
+    Each pass goes down then up the rows, taking each row from the row before it and
+    then along the row, until a pass changes nothing.
+    :param dist: starting costs (x, y), INF where nothing starts
+    :param weights: cost of moving into each cell (x, y)
+    """
+    xsize = len(dist)
+    changed = True
+    while changed:
+        before = dist.copy()
+        for rows in (range(xsize), range(xsize - 1, -1, -1)):
+            last = None
+            for x in rows:
+                if last is not None:
+                    np.minimum(dist[x], dist[last] + weights[x], out=dist[x])
+                along_row(dist[x], weights[x])
+                last = x
+        changed = not np.array_equal(before, dist)
+
+
+def leaving_bounds(costs, mask, cells, cell_costs):
+    """
+    Lower bound on the cost of reaching each cell by a route that leaves the corridor.
+    The weight of the cell reached is left out, as the triggered solver does not count
+    the city in the cost of its path.
+    :param costs: fine costs (hours, x, y), not restricted to the corridor
+    :param cells: edge cells of the corridor, from edge_cells
+    :param cell_costs: lowest cost each edge cell was reached at
+    :return: array (x, y), INF where no route can leave the corridor
+    """
+    weights = np.minimum(np.asarray(costs).min(axis=0), CAP).astype(np.float64)
+    reached = np.full(weights.shape, INF)
+    if cells:
+        xs, ys = [np.array(a) for a in zip(*cells)]
+        reached[xs, ys] = cell_costs
+    # stepping out of the corridor, from the cheapest edge cell next to each outside cell
+    out = np.min([shifted(reached, dx, dy) for dx, dy in MOVES[1:]], axis=0) + weights
+    dist = np.where(mask, INF, out)
+    settle(dist, weights)
+    return dist - weights
+
+
+def report(cid, cost, bound):
+    """
+    Say whether the corridor may have kept a city from a cheaper path.
+    :param cost: cost of the path found to the city
+    :param bound: lower bound on the cost of a path leaving the corridor, from leaving_bounds
+    :return: True if the corridor constraint may have been active
+    """
+    active = bound < cost * (1 + SLACK)
+    if active:
+        logging.warning("City {} : a route leaving the corridor may cost as little as {} against {} - "
+                        "corridor constraint may be active".format(cid, bound, cost))
+    else:
+        logging.warning("City {} : no route leaving the corridor can be cheaper - "
+                        "corridor constraint not active".format(cid))
+    return active
+
+
+def write_report(fn, widths, costs, corridor_costs):
+    """
+    Write what the corridor did for each city.
+    :param widths: dict of city id to the corridor width its path was taken from, None
+                   for the whole grid
+    :param costs: dict of city id to the cost of its path
+    :param corridor_costs: dict of city id to the cost of its path in the first corridor
+    """
+    with streams.open_file(fn, "w") as f:
+        f.write(REPORT_HEADER)
+        for cid in sorted(costs):
+            f.write("{},{},{},{}\n".format(cid, "full" if widths[cid] is None else widths[cid],
+                                           math.exp(-costs[cid]), math.exp(-corridor_costs[cid])))
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+#
+# Least squares blend weights : the weight per model whose blend of the forecast best
+# fits the in-situ data, in place of hand picked (poc_preprocess.py) or inverse
+# variance (weighted_means.py) weights.
+# Only the normal equations X'X (models x models) and X'y are accumulated, a day and
+# a chunk of cells at a time, so memory does not grow with the data. With -j the days
+# go to a pool of processes and their equations are added together.
+# The weights are constrained to sum to 1, so the blend is a weighted mean, as the
+# other stages take it. They can be solved for :
+#    all cells at once (-g all)
+#    per wind bucket of the blend by the overall weights (-g bucket) - a second pass,
+#        bucketed as weighted_means.CacherOne buckets its initial estimate
+#    per square region of the grid (-g region)
+# Groups with too few cells get the overall weights.
+# The weights file holds one comma separated line of weights per group, each after a
+# "# group = ..." line. The first group is always "all".
+# weighted_means.py -L combines with the file, and is the only stage that applies each
+# group where it belongs : bucket weights to the cells whose initial estimate falls in
+# that bucket, region weights to the cells of that region, the overall weights
+# everywhere else.
+# poc_preprocess.py -W reads the same file as a sweep - every group's line is scored
+# as a blend of the whole grid, so bucket and region weights are only compared there,
+# not applied per bucket or region. Its -w takes a single inline weights string.
+
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import buckets
+import metrics
+import model_errors
+import streams
+import windcube
+
+OUTPUT = "lsq_weights.csv"
+GROUP_PREFIX = "# group = "
+REGION_PREFIX = "# region = "
+ALL = "all"
+REGION_SIZE = 50
+MIN_CELLS = 1000  # fewer cells than this in a group and it takes the overall weights
+CHUNK_CELLS = 1 << 20
+
+
+class NormalEquations(object):
+    """
+    X'X, X'y, y'y and the count of cells per group, X being the model values of a
+    cell and y its in-situ value.
+    """
+
+    def __init__(self, nmodels, ngroups=1):
+        self.xtx = np.zeros((ngroups, nmodels, nmodels))
+        self.xty = np.zeros((ngroups, nmodels))
+        self.yty = np.zeros(ngroups)
+        self.count = np.zeros(ngroups, dtype=np.int64)
+
+    def add(self, x, y, group):
+        """
+        :param x: model values (models, cells), none missing
+        :param y: in-situ values (cells)
+        :param group: group of each cell (cells)
+        """
+        for g in np.unique(group).tolist():
+            sel = group == g
+            xg = x[:, sel]
+            yg = y[sel]
+            self.xtx[g] += xg.dot(xg.T)
+            self.xty[g] += xg.dot(yg)
+            self.yty[g] += yg.dot(yg)
+            self.count[g] += len(yg)
+
+    def merge(self, other):
+        """
+        Add in the equations of other cells - e.g. another day, from another process.
+        """
+        self.xtx += other.xtx
+        self.xty += other.xty
+        self.yty += other.yty
+        self.count += other.count
+
+    def solve(self, ridge=0.0):
+        """
+        Weights minimising the squared error of the blend, subject to summing to 1 :
+        the Lagrange system [[X'X, 1], [1', 0]] [w, mu] = [X'y, 1].
+        :param ridge: added to the diagonal of X'X, relative to its mean diagonal value
+        :return: weights (groups, models), NaN for groups with too few cells or no solution
+        """
+        ngroups, nmodels = self.xty.shape
+        weights = np.full((ngroups, nmodels), np.nan)
+        for g in range(ngroups):
+            if self.count[g] < MIN_CELLS:
+                continue
+            a = np.ones((nmodels + 1, nmodels + 1))
+            a[nmodels, nmodels] = 0
+            a[:nmodels, :nmodels] = self.xtx[g] + np.eye(nmodels) * ridge * np.trace(self.xtx[g]) / nmodels
+            b = np.append(self.xty[g], 1.0)
+            try:
+                weights[g] = np.linalg.solve(a, b)[:nmodels]
+            except np.linalg.LinAlgError:
+                logging.warning("No least squares solution for group {}".format(g))
+        return weights
+
+    def rmse(self, weights):
+        """
+        :param weights: (groups, models)
+        :return: RMSE of the blend of each group, from the equations alone
+        """
+        sum_err_2 = np.einsum("gi,gij,gj->g", weights, self.xtx, weights) - 2 * (weights * self.xty).sum(axis=1) \
+            + self.yty
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(np.maximum(sum_err_2, 0) / self.count)
+
+
+class Grouping(object):
+    """
+    Which group the equations of each cell go to.
+    """
+
+    def __init__(self, kind=ALL, scheme=None, weights=None, region=REGION_SIZE, header=None):
+        """
+        :param kind: ALL, "bucket" or "region"
+        :param scheme: buckets.BucketScheme of the blend, for "bucket"
+        :param weights: overall weights to blend with, for "bucket"
+        :param region: side of the square regions in cells, for "region"
+        :param header: grid, for "region"
+        """
+        self.kind = kind
+        self.scheme = scheme
+        self.weights = weights
+        self.region = region
+        if kind == "region":
+            self.rx = -(-header["xsize"] // region)
+            self.ry = -(-header["ysize"] // region)
+
+    def __len__(self):
+        if self.kind == "bucket":
+            return len(self.scheme)
+        if self.kind == "region":
+            return self.rx * self.ry
+        return 1
+
+    def assign(self, day):
+        """
+        :param day: model values (models, hours, x, y)
+        :return: group of every cell (hours, x, y)
+        """
+        shape = day.shape[1:]
+        if self.kind == "bucket":
+            return self.scheme.assign(np.tensordot(self.weights, day, axes=1))
+        if self.kind == "region":
+            x = np.arange(shape[1]).reshape(-1, 1) // self.region
+            y = np.arange(shape[2]).reshape(1, -1) // self.region
+            return np.broadcast_to(x * self.ry + y, shape)
+        return np.zeros(shape, dtype=np.int64)
+
+    def names(self):
+        """
+        :return: name of each group, as written after GROUP_PREFIX
+        """
+        if self.kind == "bucket":
+            return ["{}".format(b) for b in range(len(self.scheme))]
+        if self.kind == "region":
+            return ["{} {}".format(x, y) for x in range(self.rx) for y in range(self.ry)]
+        return [ALL]
+
+
+def day_equations(job):
+    """
+    Worker : the normal equations of one day, a chunk of cells at a time.
+    Cells missing the in-situ value or any model are skipped.
+    :param job: forecast file, in-situ file, common grid header, date_id, Grouping
+    :return: NormalEquations
+    """
+    forecast_fn, insitu_fn, header, day, grouping = job
+    forecast, fheader = windcube.open_any(forecast_fn, day, np.float64)
+    insitu, iheader = windcube.open_any(insitu_fn, day, np.float64)
+    fday = np.asarray(model_errors.day_slice(forecast, fheader, header, day), dtype=np.float64)
+    iday = model_errors.day_slice(insitu, iheader, header, day)[0].ravel()
+    group = grouping.assign(fday).ravel()
+    fday = fday.reshape(len(header["models"]), -1)
+    keep = ~np.isnan(iday) & ~np.isnan(fday).any(axis=0)
+    fday = fday[:, keep]
+    iday = iday[keep]
+    group = group[keep]
+    equations = NormalEquations(len(header["models"]), len(grouping))
+    for start in range(0, len(iday), CHUNK_CELLS):
+        end = start + CHUNK_CELLS
+        equations.add(fday[:, start:end], iday[start:end], group[start:end])
+    return equations
+
+
+def accumulate(forecast_fn, insitu_fn, header, grouping, workers, phase):
+    """
+    The normal equations of every day of the common grid, added together.
+    :return: NormalEquations
+    """
+    jobs = [(forecast_fn, insitu_fn, header, day, grouping) for day in header["days"]]
+    equations = NormalEquations(len(header["models"]), len(grouping))
+    if workers > 1 and len(jobs) > 1:
+        logging.warning("  {} days over {} workers".format(len(jobs), workers))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            days = list(pool.map(day_equations, jobs))
+    else:
+        days = map(day_equations, jobs)
+    for day in days:
+        equations.merge(day)
+        phase.add(int(day.count.sum()))
+    return equations
+
+
+class BlendWeights(object):
+    """
+    Weights read back from a weights file.
+    """
+
+    def __init__(self, weights, groups, scheme=None, region=None):
+        """
+        :param weights: overall weights, one per model
+        :param groups: dict of group name to weights, besides "all"
+        :param scheme: buckets.BucketScheme if grouped by bucket
+        :param region: region side if grouped by region
+        """
+        self.weights = np.array(weights)
+        self.groups = groups
+        self.scheme = scheme
+        self.region = region
+
+    def bucket_weights(self):
+        """
+        :return: scheme the weights are bucketed by - a single bucket unless grouped
+                 by bucket - and the weights (buckets, models)
+        """
+        if self.scheme is None:
+            return buckets.BucketScheme([0]), self.weights.reshape(1, -1)
+        return self.scheme, np.array([self.groups.get("{}".format(b), self.weights) for b in range(len(self.scheme))])
+
+    def cell_weights(self, header):
+        """
+        :return: weights (models, 1, x, y) of each cell of a grid, by its region
+        """
+        weights = np.empty((len(self.weights), 1, header["xsize"], header["ysize"]))
+        weights[:] = self.weights.reshape(-1, 1, 1, 1)
+        for name, w in self.groups.items():
+            rx, ry = [int(v) for v in name.split()]
+            weights[:, 0, rx * self.region:(rx + 1) * self.region, ry * self.region:(ry + 1) * self.region] = \
+                np.reshape(w, (-1, 1, 1))
+        return weights
+
+
+def write_weights(fn, grouping, overall, weights, equations, overall_equations):
+    """
+    :param overall: the weights over all cells
+    :param weights: weights per group (groups, models), NaN rows taking the overall ones
+    """
+    rmse = equations.rmse(np.where(np.isnan(weights), overall, weights))
+    logging.warning("Weights written to {}".format(fn))
+    with streams.open_file(fn, "w") as f:
+        f.write("# least squares blend weights - each line sums to 1\n")
+        if grouping.kind == "bucket":
+            f.write(grouping.scheme.edges_line())
+        elif grouping.kind == "region":
+            f.write("{}{}\n".format(REGION_PREFIX, grouping.region))
+        f.write("{}{} : {} cells, rmse = {}\n".format(GROUP_PREFIX, ALL, overall_equations.count[0],
+                                                     overall_equations.rmse(overall.reshape(1, -1))[0]))
+        f.write(",".join("{}".format(w) for w in overall.tolist()) + "\n")
+        if grouping.kind == ALL:
+            return
+        for g, name in enumerate(grouping.names()):
+            if np.isnan(weights[g]).any():
+                note = ", too few cells - overall weights"
+                row = overall
+            else:
+                note = ""
+                row = weights[g]
+            f.write("{}{} : {} cells, rmse = {}{}\n".format(GROUP_PREFIX, name, equations.count[g], rmse[g], note))
+            f.write(",".join("{}".format(w) for w in row.tolist()) + "\n")
+
+
+def read_weights(fn):
+    """
+    Read back a file written by write_weights.
+    :return: BlendWeights
+    """
+    scheme = None
+    region = None
+    groups = {}
+    name = None
+    with streams.open_file(fn, "r") as f:
+        for line in f:
+            if line.startswith(buckets.EDGES_PREFIX):
+                scheme = buckets.from_edges_line(line)
+            elif line.startswith(REGION_PREFIX):
+                region = int(line[len(REGION_PREFIX):])
+            elif line.startswith(GROUP_PREFIX):
+                name = line[len(GROUP_PREFIX):].split(" : ")[0]
+            elif not line.startswith("#") and line.strip():
+                assert name is not None, "Weights without a group in {}".format(fn)
+                groups[name] = [float(w) for w in line.split(",")]
+                name = None
+    assert ALL in groups, "No overall weights in {}".format(fn)
+    return BlendWeights(groups.pop(ALL), groups, scheme, region)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model_file", default=model_errors.mfile, help="Forecast data - csv or cube format")
+    parser.add_argument("-i", "--insitu", default=model_errors.rfile, help="In-situ data - csv or cube format")
+    parser.add_argument("-o", "--output", default=OUTPUT, help="Weights file to write")
+    parser.add_argument("-g", "--group", default=ALL, choices=[ALL, "bucket", "region"],
+                        help="Solve for weights over all cells, or per wind bucket, or per region as well")
+    parser.add_argument("-R", "--region", default=REGION_SIZE, type=int, help="Side of the regions in cells")
+    parser.add_argument("-r", "--ridge", default=0.0, type=float,
+                        help="Ridge added to the diagonal of X'X, relative to its mean diagonal value")
+    parser.add_argument("-j", "--workers", default=1, type=int, help="processes to accumulate the days over")
+    buckets.sd_option(parser)
+    parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    nl = getattr(logging, args.log.upper(), None)
+    if not isinstance(nl, int):
+        raise ValueError("Invalid log level: {}".format(args.log))
+    logging.basicConfig(level=nl,
+                        format='%(asctime)s : %(message)s')
+    meter = metrics.Metrics("lsq_weights", args.metrics_out)
+    fheader = windcube.header_any(args.model_file)
+    iheader = windcube.header_any(args.insitu)
+    assert fheader["models"] and not iheader["models"], "Expected a forecast file and an in-situ file"
+    header = model_errors.common_header(fheader, iheader)
+    nbytes = metrics.file_bytes(args.model_file, args.insitu)
+    grouping = Grouping(ALL)
+    if args.group == "region":
+        grouping = Grouping("region", region=args.region, header=header)
+    with meter.phase("accumulate", unit="cells", nbytes=nbytes) as phase:
+        equations = accumulate(args.model_file, args.insitu, header, grouping, args.workers, phase)
+    if grouping.kind == "region":
+        overall_equations = NormalEquations(len(header["models"]))
+        for name in ("xtx", "xty", "yty", "count"):
+            getattr(overall_equations, name)[0] = getattr(equations, name).sum(axis=0)
+    else:
+        overall_equations = equations
+    overall = overall_equations.solve(args.ridge)[0]
+    assert not np.isnan(overall).any(), "No overall least squares weights"
+    if args.group == "bucket":
+        grouping = Grouping("bucket", scheme=buckets.sd_scheme(args.sd_buckets), weights=overall)
+        with meter.phase("accumulate buckets", unit="cells", nbytes=nbytes) as phase:
+            equations = accumulate(args.model_file, args.insitu, header, grouping, args.workers, phase)
+    weights = equations.solve(args.ridge)
+    write_weights(args.output, grouping, overall, weights, equations, overall_equations)
+    print("Overall weights : {}".format(",".join("{}".format(w) for w in overall.tolist())))
+    meter.total()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+#
+# Incremental ingest of csv weather files into a cube, tracked by a manifest next
+# to the cube (<cube>.manifest.json) :
+#    sources    : size, mtime and checksum of each csv ingested
+#    days       : the csv each day came from and the sha1 of that day's csv bytes
+#    partitions : sha1 of the cube data of each (day, model), keyed "day:model"
+#                 (model 0 for files without a model column)
+#    consumers  : per downstream stage, the partition sha1s it last worked from, and
+#                 the digest of its other inputs - one per day, or one for them all
+# Re-running the ingest only parses the days whose bytes changed, and the stages
+# ask dirty_partitions() for the partitions they have not yet seen.
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+import chunked_csv
+import metrics
+import sidecar
+import streams
+import windcube
+
+VERSION = 1
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def manifest_name(cube_fn):
+    return cube_fn + MANIFEST_SUFFIX
+
+
+def partition_key(day, model):
+    return "{}:{}".format(day, model)
+
+
+def split_key(key):
+    day, model = key.split(":")
+    return int(day), int(model)
+
+
+def empty_manifest():
+    return {"version": VERSION, "sources": {}, "days": {}, "partitions": {}, "consumers": {}}
+
+
+def load_manifest(cube_fn):
+    """
+    :return: manifest dict, or None if the cube has no usable manifest
+    """
+    try:
+        with open(manifest_name(cube_fn), "r") as f:
+            m = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if m.get("version") != VERSION or not os.path.exists(cube_fn):
+        return None
+    return m
+
+
+def write_manifest(cube_fn, m):
+    tmp = manifest_name(cube_fn) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(m, f, indent=1, sort_keys=True)
+    os.replace(tmp, manifest_name(cube_fn))
+
+
+def day_digests(fn, meta):
+    """
+    sha1 of the csv bytes of each day, read through the sidecar run index.
+    :return: dict of date_id to hex digest, or None if the file has no run index
+    """
+    if meta["run_key"] is None:
+        return None
+    _, runs = sidecar.load_runs(fn)
+    hashes = dict((d, hashlib.sha1()) for d in meta["days"])
+    dids = runs["date_id"].tolist()
+    with open(fn, "rb") as f:
+        for i, data in chunked_csv.read_range_slices(f, list(zip(runs["start"].tolist(), runs["end"].tolist()))):
+            hashes[dids[i]].update(data)
+    return dict((d, h.hexdigest()) for d, h in hashes.items())
+
+
+def partition_digests(cube, header, days):
+    """
+    sha1 of the cube data of every (day, model) of the given days.
+    :return: dict of partition key to hex digest
+    """
+    models = header["models"] or [0]
+    digests = {}
+    for day in days:
+        di = header["days"].index(day)
+        for mi, model in enumerate(models):
+            digests[partition_key(day, model)] = hashlib.sha1(np.ascontiguousarray(cube[mi, di]).tobytes()).hexdigest()
+    return digests
+
+
+def merge_headers(old, meta):
+    """
+    Header of a cube holding both the old cube and the csv described by meta.
+    """
+    assert bool(old["models"]) == bool(meta["models"]), "Cannot mix files with and without a model column"
+    return windcube.make_header(max(old["xsize"], meta["xsize"]),
+                                max(old["ysize"], meta["ysize"]),
+                                min(old["min_hour"], meta["min_hour"]),
+                                max(old["max_hour"], meta["max_hour"]),
+                                sorted(set(old["days"]) | set(meta["days"])),
+                                sorted(set(old["models"]) | set(meta["models"])))
+
+
+def regrow_cube(cube_fn, header):
+    """
+    Copy a cube into a new one of a larger header - slice by slice, no parsing.
+    """
+    old, old_header = windcube.open_cube(cube_fn)
+    tmp = cube_fn + ".tmp"
+    logging.warning("Growing cube {} to shape {} ...".format(cube_fn, header["shape"]))
+    cube = windcube.create_cube(tmp, header)
+    h0 = old_header["min_hour"] - header["min_hour"]
+    h1 = h0 + old_header["max_hour"] - old_header["min_hour"] + 1
+    for mi, model in enumerate(old_header["models"] or [0]):
+        nmi = 0 if model == 0 else header["models"].index(model)
+        for di, day in enumerate(old_header["days"]):
+            cube[nmi, header["days"].index(day), h0:h1, :old_header["xsize"], :old_header["ysize"]] = old[mi, di]
+    cube.flush()
+    del cube, old
+    os.replace(tmp, cube_fn)
+
+
+def fill_days(cube, header, fn, meta, days):
+    """
+    Parse the rows of the given days into the cube, reading only their byte ranges
+    when the run index allows it.
+    :return: rows stored
+    """
+    ranges = sidecar.day_ranges(fn, days)
+    names = chunked_csv.header_names(meta["header"])
+    if ranges is None:
+        blocks = chunked_csv.read_columns(fn, meta["header"] + "\n")
+    else:
+        blocks = chunked_csv.read_ranges_columns(fn, names, ranges)
+    count = 0
+    for cols in blocks:
+        wanted = np.isin(cols["date_id"], days)
+        if not np.all(wanted):
+            cols = dict((k, v[wanted]) for k, v in cols.items())
+        windcube.store_columns(cube, header, cols)
+        count += len(cols["wind"])
+    return count
+
+
+def ingest(fn, cube_fn, workers=1):
+    """
+    Bring a cube up to date with a csv file, only parsing the days that are new or
+    whose bytes changed since the last ingest.
+    :param fn: csv file - a whole month, or a single new day
+    :param cube_fn: cube file, created if needed
+    :param workers: processes to scan a new csv, and fill a new cube, with
+    :return: set of (day, model) partitions whose data changed
+    """
+    meta = sidecar.load_sidecar(fn, workers=workers)
+    m = load_manifest(cube_fn)
+    source = os.path.abspath(fn)
+    fresh = m is None
+    if fresh:
+        m = empty_manifest()
+        header = windcube.make_header(meta["xsize"], meta["ysize"], meta["min_hour"], meta["max_hour"],
+                                      meta["days"], meta["models"])
+        logging.warning("Creating cube {} with shape {} ...".format(cube_fn, header["shape"]))
+        windcube.create_cube(cube_fn, header).flush()
+    else:
+        if m["sources"].get(source, {}).get("sha1") == meta["sha1"]:
+            logging.warning("{} is up to date with {}".format(cube_fn, fn))
+            return set()
+        header, _ = windcube.read_header(cube_fn)
+        new_header = merge_headers(header, meta)
+        if new_header["shape"] != header["shape"]:
+            regrow_cube(cube_fn, new_header)
+            header = new_header
+    digests = day_digests(fn, meta)
+    changed = []
+    for day in meta["days"]:
+        seen = m["days"].get(str(day))
+        if digests is None or seen is None or seen["sha1"] != digests[day] or seen["source"] != source:
+            changed.append(day)
+    logging.warning("Ingesting {} of the {} days of {} ...".format(len(changed), len(meta["days"]), fn))
+    parallel = fresh and workers > 1 and not streams.is_compressed(fn)
+    if parallel:
+        count = windcube.fill_from_csv_parallel(cube_fn, fn, meta, workers)
+        logging.warning("  done - {} rows.".format(count))
+    cube, header = windcube.open_cube(cube_fn, "r+")
+    if changed and not parallel:
+        models = meta["models"] or [0]
+        mis = [0] if models == [0] else [header["models"].index(model) for model in models]
+        for day in changed:
+            cube[mis, header["days"].index(day)] = np.nan
+        count = fill_days(cube, header, fn, meta, changed)
+        cube.flush()
+        logging.warning("  done - {} rows.".format(count))
+    dirty = set()
+    for key, digest in partition_digests(cube, header, changed).items():
+        if m["partitions"].get(key) != digest:
+            dirty.add(split_key(key))
+        m["partitions"][key] = digest
+    for day in changed:
+        m["days"][str(day)] = {"source": source, "sha1": None if digests is None else digests[day]}
+    m["sources"][source] = {"size": meta["size"], "mtime_ns": meta["mtime_ns"], "sha1": meta["sha1"]}
+    write_manifest(cube_fn, m)
+    return dirty
+
+
+def stage_inputs(inputs):
+    """
+    The inputs digest of a stage as the manifest keeps it - json only has string keys.
+    """
+    if isinstance(inputs, dict):
+        return dict((str(day), digest) for day, digest in inputs.items())
+    return inputs
+
+
+def dirty_partitions(cube_fn, stage, inputs=None):
+    """
+    Partitions that have changed since a downstream stage last marked them consumed.
+    :param stage: name of the stage asking, e.g. "model_sd"
+    :param inputs: digest of the stage's other inputs - if it differs from the one
+                   recorded, every partition is dirty. A dict of date_id to digest
+                   makes only the partitions of the days whose digest differs dirty.
+                   None skips the check.
+    :return: set of (day, model), or None if the cube has no manifest
+    """
+    m = load_manifest(cube_fn)
+    if m is None:
+        return None
+    seen = m["consumers"].get(stage, {})
+    inputs = stage_inputs(inputs)
+    recorded = seen.get("inputs")
+    all_dirty = False
+    changed_days = set()
+    if isinstance(inputs, dict) and isinstance(recorded, dict):
+        changed_days = set(int(day) for day in set(inputs) | set(recorded) if inputs.get(day) != recorded.get(day))
+    else:
+        all_dirty = inputs is not None and recorded != inputs
+    parts = seen.get("partitions", {})
+    return set(split_key(k) for k, digest in m["partitions"].items()
+               if all_dirty or split_key(k)[0] in changed_days or parts.get(k) != digest)
+
+
+def mark_consumed(cube_fn, stage, inputs=None):
+    """
+    Record that a stage is up to date with every partition of the cube.
+    """
+    m = load_manifest(cube_fn)
+    if m is None:
+        return
+    m["consumers"][stage] = {"inputs": stage_inputs(inputs), "partitions": dict(m["partitions"])}
+    write_manifest(cube_fn, m)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", nargs="+", help="csv files to ingest, in order")
+    parser.add_argument("-o", "--output", default=None,
+                        help="cube file - defaults to the first input name with a .cube extension")
+    parser.add_argument("-s", "--stage", default=[], action="append",
+                        help="report the partitions dirty for this downstream stage - may be repeated")
+    parser.add_argument("-j", "--workers", default=1, type=int, help="processes to scan new csv files with")
+    parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    nl = getattr(logging, args.log.upper(), None)
+    if not isinstance(nl, int):
+        raise ValueError("Invalid log level: {}".format(args.log))
+    logging.basicConfig(level=nl,
+                        format='%(asctime)s : %(message)s')
+    if args.output is None:
+        args.output = windcube.cube_name(args.input[0])
+    meter = metrics.Metrics("manifest", args.metrics_out)
+    for fn in args.input:
+        with meter.phase("ingest", unit="partitions", nbytes=metrics.file_bytes(fn)) as phase:
+            dirty = ingest(fn, args.output, args.workers)
+            phase.add(len(dirty))
+        print("{} : {} partitions changed {}".format(fn, len(dirty), sorted(dirty)))
+    for stage in args.stage:
+        print("{} : dirty {}".format(stage, sorted(dirty_partitions(args.output, stage))))
+    meter.total()
+
+
+if __name__ == '__main__':
+    main()
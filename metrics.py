@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#
+# Throughput and timing instrumentation shared by the stages, in place of the old
+# print(counter) and tqdm progress.
+#
+#    metrics = Metrics("model_sd", args.metrics_out)
+#    with metrics.phase("accumulate", nbytes=os.path.getsize(fn)) as phase:
+#        for cols in blocks:
+#            phase.add(len(cols["wind"]))
+#
+# Each phase logs progress every PROGRESS_SECONDS and, when finished, appends one
+# JSON line to the metrics file : stage, phase, wall time, count and rate, bytes and
+# bytes/s, peak RSS. add() only looks at the clock every so many calls, so it is
+# cheap enough to call once per row.
+
+import json
+import logging
+import os
+import socket
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+PROGRESS_SECONDS = 10.0
+CHECK_SECONDS = 0.5  # aim to look at the clock about this often
+
+
+def peak_rss_mb(who="self"):
+    """
+    :param who: "self", or "children" for finished worker processes
+    :return: peak resident set size in MB, or None where unknown
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    scale = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0  # bytes on macOS, KB elsewhere
+    return round(usage.ru_maxrss / scale, 1)
+
+
+class Phase(object):
+    """
+    Counts the work of one phase of a stage. Use as a context manager.
+    """
+
+    def __init__(self, metrics, name, unit="rows", nbytes=0):
+        """
+        :param name: phase name, e.g. "parse"
+        :param unit: what add() counts
+        :param nbytes: bytes handled, if known up front - e.g. the input file size
+        """
+        self.metrics = metrics
+        self.name = name
+        self.unit = unit
+        self.count = 0
+        self.nbytes = nbytes
+        self.calls_per_check = 1
+        self.countdown = 1
+        self.start = None
+        self.last_check = None
+        self.last_report = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self.last_check = self.start
+        self.last_report = self.start
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.record(self, time.time() - self.start, exc_type is None)
+        return False
+
+    def add(self, count=1, nbytes=0):
+        """
+        Count work done. Only every calls_per_check calls look at the clock.
+        """
+        self.count += count
+        self.nbytes += nbytes
+        self.countdown -= 1
+        if self.countdown > 0:
+            return
+        now = time.time()
+        # adjust the sampling so the clock is looked at about every CHECK_SECONDS
+        elapsed = now - self.last_check
+        if elapsed < CHECK_SECONDS / 2:
+            self.calls_per_check = min(self.calls_per_check * 2, 1 << 20)
+        elif elapsed > CHECK_SECONDS * 2 and self.calls_per_check > 1:
+            self.calls_per_check //= 2
+        self.countdown = self.calls_per_check
+        self.last_check = now
+        if now - self.last_report >= PROGRESS_SECONDS:
+            self.last_report = now
+            logging.warning("{} {} : {} {}, {:.0f} {}/s".format(self.metrics.stage, self.name, self.count, self.unit,
+                                                                self.count / (now - self.start), self.unit))
+
+
+class Metrics(object):
+    """
+    Collects the phases of one run of a stage and writes them as JSON lines.
+    """
+
+    def __init__(self, stage, out=None):
+        """
+        :param stage: name of the stage, e.g. the script name
+        :param out: JSON lines file to append to, or None to only log
+        """
+        self.stage = stage
+        self.out = out
+        self.run = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.started = time.time()
+
+    def phase(self, name, unit="rows", nbytes=0):
+        return Phase(self, name, unit, nbytes)
+
+    def record(self, phase, wall, ok=True):
+        entry = {"stage": self.stage,
+                 "phase": phase.name,
+                 "run": self.run,
+                 "host": socket.gethostname(),
+                 "ok": ok,
+                 "wall_s": round(wall, 3),
+                 "unit": phase.unit,
+                 "count": phase.count,
+                 "per_s": round(phase.count / wall, 1) if wall > 0 else None,
+                 "bytes": phase.nbytes,
+                 "bytes_per_s": round(phase.nbytes / wall, 1) if wall > 0 else None,
+                 "peak_rss_mb": peak_rss_mb(),
+                 "peak_rss_children_mb": peak_rss_mb("children")}
+        self.write(entry)
+        logging.warning("{} {} : {} {} in {:.2f} s{}".format(
+            self.stage, phase.name, phase.count, phase.unit, wall,
+            ", {:.0f} {}/s".format(entry["per_s"], phase.unit) if entry["per_s"] else ""))
+
+    def write(self, entry):
+        if self.out is None:
+            return
+        with open(self.out, "a") as f:
+            f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    def total(self):
+        """
+        Write a line for the whole run.
+        """
+        wall = time.time() - self.started
+        self.write({"stage": self.stage,
+                    "phase": "total",
+                    "run": self.run,
+                    "host": socket.gethostname(),
+                    "ok": True,
+                    "wall_s": round(wall, 3),
+                    "peak_rss_mb": peak_rss_mb(),
+                    "peak_rss_children_mb": peak_rss_mb("children")})
+
+
+def add_argument(parser):
+    parser.add_argument("--metrics-out", default=None,
+                        help="Append throughput and timing metrics to this file as JSON lines.")
+
+
+def file_bytes(*names):
+    """
+    Total size of the given files, for the bytes of a phase.
+    """
+    return sum(os.path.getsize(fn) for fn in names if fn is not None and os.path.exists(fn))
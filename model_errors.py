@@ -2,44 +2,236 @@
 #
 # forecase has : xid,yid,date_id,hour,model,wind
 # insitu has : xid,yid,date_id,hour,wind
+#
+# Both files are read a day at a time as float32 cubes indexed (model, day, hour, x, y),
+# so their rows may come in any order. The error (in-situ - model) of a day is one
+# broadcast subtraction, stored in an error cube and written out as csv before the next
+# day is read. The csv is formatted a column at a time, with the winds and errors rounded
+# to the decimals of the input winds so the float32 values print as the inputs did.
+# Cells present in one file but not the other are counted and reported together at
+# the end rather than asserted on.
+
+import argparse
+import logging
+
+import numpy as np
+
+import chunked_csv
+import metrics
+import sidecar
+import streams
+import windcube
 
 mfile = "ForecastDataforTraining_201712.csv"
 rfile = "In_situMeasurementforTraining_201712.csv"
+cfile = "ModelErrors.cube"
 ofile = "ModelErrorFile.csv"
 
-message_count = 10000  # every message_count iterations, output a message
-
-with open(ofile, "w") as o:
-    with open(rfile, "r") as r:
-        with open(mfile, "r") as m:
-            rline = r.readline()
-            assert rline == "xid,yid,date_id,hour,wind\n"
-            mline = m.readline()
-            assert mline == "xid,yid,date_id,hour,model,wind\n"
-            oline = "xid,yid,date_id,hour,model,wind,error\n"
-            o.write(oline)
-            # we rely on the in-situ and model files to be aligned
-            # the asserts below enforce this
-            rline = r.readline()
-            counter = 0
-            while rline != '':
-                if counter % message_count == 0:
-                    print(counter)
-                counter += 1
-                xid, yid, date_id, hour, wind = rline[:-1].split(',')
-                for mthing in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]:
-                    mline = m.readline()
-                    mxid, myid, mdate_id, mhour, model, mwind = mline[:-1].split(',')
-                    assert mxid == xid and myid == yid, "Locations do not match"
-                    assert mdate_id == date_id, "Dates do not match"
-                    assert mhour == hour, "Hour does not match"
-                    err = float(wind) - float(mwind)
-                    oline = "{},{},{},{},{},{},{}\n".format(xid, yid, date_id, hour, model, wind, err)
-                    o.write(oline)
-                rline = r.readline()
-    
-            
- 
-        
-    
+ERRORHEADER = "xid,yid,date_id,hour,model,wind,error\n"
+DECIMALS = 2  # of the winds in the input files
+MISMATCHHEADER = "kind,xid,yid,date_id,hour\n"
+EXAMPLES = 5  # mismatched cells shown in the log
+
+
+def common_header(fheader, iheader):
+    """
+    Header of the grid covered by both the forecast and the in-situ cube.
+    """
+    return windcube.make_header(min(fheader["xsize"], iheader["xsize"]),
+                                min(fheader["ysize"], iheader["ysize"]),
+                                max(fheader["min_hour"], iheader["min_hour"]),
+                                min(fheader["max_hour"], iheader["max_hour"]),
+                                sorted(set(fheader["days"]) & set(iheader["days"])),
+                                fheader["models"])
+
+
+def day_slice(cube, header, grid, day):
+    """
+    The part of one day of a cube that falls on the grid described by another header.
+    :return: array of shape (models, hours, x, y)
+    """
+    h0 = grid["min_hour"] - header["min_hour"]
+    h1 = h0 + grid["max_hour"] - grid["min_hour"] + 1
+    return cube[:, header["days"].index(day), h0:h1, :grid["xsize"], :grid["ysize"]]
+
+
+class MismatchReport(object):
+    """
+    Collects the cells that cannot give an error, by kind.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.cells = []
+
+    def note(self, kind, count):
+        if count:
+            self.counts[kind] = self.counts.get(kind, 0) + count
+
+    def add(self, kind, mask, header, day):
+        """
+        :param mask: boolean array (hours, x, y) of the cells of this kind on one day
+        """
+        h, x, y = np.nonzero(mask)
+        if len(h) == 0:
+            return
+        self.note(kind, len(h))
+        self.cells.append((kind, x + 1, y + 1, np.full(len(h), day), h + header["min_hour"]))
+
+    def log(self):
+        if not self.counts:
+            logging.warning("Forecast and in-situ data match up.")
+            return
+        for kind in sorted(self.counts):
+            logging.warning("Mismatch - {} : {} cells".format(kind, self.counts[kind]))
+        for kind, x, y, d, h in self.cells[:EXAMPLES]:
+            logging.warning("  e.g. {} at xid {}, yid {}, date {}, hour {}".format(kind, x[0], y[0], d[0], h[0]))
+
+    def write(self, fn):
+        with streams.open_file(fn, "w") as f:
+            f.write(MISMATCHHEADER)
+            for kind, x, y, d, h in self.cells:
+                f.write(chunked_csv.format_rows(np.full(len(x), kind, dtype=object), x, y, d, h))
+
+
+def duplicate_rows(fn, cells):
+    """
+    Rows of a csv file that landed on a cell already filled by an earlier row.
+    :param cells: cells of the file with data, over every day
+    """
+    if windcube.is_cube(fn):
+        return 0
+    return sidecar.load_sidecar(fn)["rows"] - cells
+
+
+def day_cells(cube, header, grid, day):
+    """
+    Cells of one day of a cube with data, in all and on the common grid.
+    :return: cells, cells inside the grid
+    """
+    cells = int(np.count_nonzero(~np.isnan(cube[:, header["days"].index(day)])))
+    if day not in grid["days"]:
+        return cells, 0
+    return cells, int(np.count_nonzero(~np.isnan(day_slice(cube, header, grid, day))))
+
+
+def day_errors(forecast, fheader, insitu, iheader, header, day, report):
+    """
+    Errors of every model for one day, recording the cells that do not match up.
+    :return: errors (models, hours, x, y) - NaN where either value is missing,
+             in-situ wind (hours, x, y)
+    """
+    fday = day_slice(forecast, fheader, header, day)
+    iday = day_slice(insitu, iheader, header, day)[0]
+    have_model = ~np.isnan(fday)
+    have_any = have_model.any(axis=0)
+    have_insitu = ~np.isnan(iday)
+    report.add("missing models", have_any & ~have_model.all(axis=0), header, day)
+    report.add("no in-situ", have_any & ~have_insitu, header, day)
+    report.add("no forecast", have_insitu & ~have_any, header, day)
+    return iday[None] - fday, iday
+
+
+def write_day_csv(o, err, wind, header, day, decimals=DECIMALS):
+    """
+    Write the errors of one day as csv, in the xid, yid, hour, model order of the
+    forecast file, for every cell with both a forecast and an in-situ value.
+    :param o: file open for binary writing
+    :param err: errors (models, hours, x, y)
+    :param wind: in-situ wind (hours, x, y)
+    :param decimals: the winds and errors are rounded to this many decimals
+    :return: rows written
+    """
+    models = header["models"] or [0]
+    hours = np.arange(header["min_hour"], header["max_hour"] + 1)
+    yids, hour_ids, model_ids = [a.ravel() for a in np.meshgrid(np.arange(1, header["ysize"] + 1), hours, models,
+                                                                 indexing="ij")]
+    rows = 0
+    for x in range(header["xsize"]):
+        # (models, hours, y) -> one row per (y, hour, model)
+        e = err[:, :, x, :].transpose(2, 1, 0).ravel()
+        w = np.repeat(wind[:, x, :].T.ravel(), len(models))
+        present = ~np.isnan(e)
+        n = int(np.count_nonzero(present))
+        o.write(chunked_csv.format_fixed([np.full(n, x + 1), yids[present], np.full(n, day), hour_ids[present],
+                                          model_ids[present], w[present], e[present]],
+                                         [0, 0, 0, 0, 0, decimals, decimals]))
+        rows += n
+    return rows
+
+
+def open_day(fn, header, day):
+    """
+    One day of a file as a float32 cube, or None if the file has no data for it.
+    """
+    if day not in header["days"]:
+        return None, None
+    return windcube.open_any(fn, day, windcube.DTYPE)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model_file", default=mfile, help="Forecast data - csv or cube format")
+    parser.add_argument("-i", "--insitu", default=rfile, help="In-situ data - csv or cube format")
+    parser.add_argument("-o", "--output", default=cfile, help="Error cube to write")
+    parser.add_argument("-c", "--csv", default=ofile, help="Error csv to write as well")
+    parser.add_argument("-n", "--no-csv", action="store_true", help="Only write the error cube")
+    parser.add_argument("-d", "--decimals", default=DECIMALS, type=int,
+                        help="Decimals of the input winds - the csv winds and errors are rounded to them")
+    parser.add_argument("-M", "--mismatches", default=None,
+                        help="Write every cell that does not match up to this file")
+    parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    nl = getattr(logging, args.log.upper(), None)
+    if not isinstance(nl, int):
+        raise ValueError("Invalid log level: {}".format(args.log))
+    logging.basicConfig(level=nl,
+                        format='%(asctime)s : %(message)s')
+    meter = metrics.Metrics("model_errors", args.metrics_out)
+    fheader = windcube.header_any(args.model_file)
+    iheader = windcube.header_any(args.insitu)
+    assert fheader["models"] and not iheader["models"], "Expected a forecast file and an in-situ file"
+    header = common_header(fheader, iheader)
+    logging.warning("Creating error cube {} with shape {} ...".format(args.output, header["shape"]))
+    error = windcube.create_cube(args.output, header)
+    report = MismatchReport()
+    # cells with data per file, in all and on the common grid
+    fcells = [0, 0]
+    icells = [0, 0]
+    o = None
+    if not args.no_csv:
+        o = streams.open_file(args.csv, "wb")
+        o.write(ERRORHEADER.encode())
+    with meter.phase("errors", nbytes=metrics.file_bytes(args.model_file, args.insitu)) as phase:
+        for day in sorted(set(fheader["days"]) | set(iheader["days"])):
+            logging.warning("Reading day {} ...".format(day))
+            forecast, fdheader = open_day(args.model_file, fheader, day)
+            insitu, idheader = open_day(args.insitu, iheader, day)
+            if forecast is not None:
+                fcells = [a + b for a, b in zip(fcells, day_cells(forecast, fdheader, header, day))]
+            if insitu is not None:
+                icells = [a + b for a, b in zip(icells, day_cells(insitu, idheader, header, day))]
+            if day in header["days"]:
+                di = header["days"].index(day)
+                error[:, di], iday = day_errors(forecast, fdheader, insitu, idheader, header, day, report)
+                if o is None:
+                    phase.add(int(np.count_nonzero(~np.isnan(iday))))
+                else:
+                    phase.add(write_day_csv(o, error[:, di], iday, header, day, args.decimals))
+            del forecast, insitu
+        error.flush()
+    if o is not None:
+        o.close()
+    report.note("duplicate forecast rows", duplicate_rows(args.model_file, fcells[0]))
+    report.note("duplicate in-situ rows", duplicate_rows(args.insitu, icells[0]))
+    report.note("forecast cells outside the common grid", fcells[0] - fcells[1])
+    report.note("in-situ cells outside the common grid", icells[0] - icells[1])
+    report.log()
+    if args.mismatches is not None:
+        report.write(args.mismatches)
+    meter.total()
+
 
+if __name__ == '__main__':
+    main()
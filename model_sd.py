@@ -1,81 +1,110 @@
 #!/usr/bin/python
 
-import math
+import argparse
+import os
+
+import numpy as np
+
+import buckets
+import chunked_csv
+import manifest
+import metrics
+import model_stats
+import sidecar
 
 header = "xid,yid,date_id,hour,model,wind,error\n"
 errors_file = "ModelErrorFile.csv"
 sd_file = "sd_file.csv"
 sd_bucket_file = "sd_bucket_file.csv"
+# the forecast cube kept up to date by manifest.py - its manifest tells us which
+# (day, model) partitions changed, so only those are accumulated again. The errors
+# also depend on the in-situ data, so the days of the errors file whose bytes changed -
+# after a new in-situ file or a rerun of model_errors - are dirty as well. Without a
+# run index to find its days by, any change to the errors file makes every partition dirty.
+forecast_cube = "ForecastDataforTraining_201712.cube"
+state_file = "sd_state.npz"
+stage = "model_sd"
 
 Nmodels = 10
-message_count = 10000  # every message_count iterations, output a message
-values = {}
-variances = {}
-values_per_bucket = {}
-variances_per_bucket = {}
-counts = {}
-counts_per_bucket = {0:{}, 1:{}, 2:{}, 3:{}, 4:{}, 5:{}, 6:{}, 7:{}, 8:{}, 9:{}, 10:{}}
-bucket_titles=["0..5-", "5..10-", "10..15-", "15..20-", "20..25-", "25+"]
 
+parser = argparse.ArgumentParser()
+parser.add_argument("-e", "--errors_file", default=errors_file, help="Model errors file from model_errors.py")
+parser.add_argument("-f", "--forecast_cube", default=forecast_cube,
+                    help="Forecast cube whose manifest gives the changed partitions")
+buckets.sd_option(parser)
+metrics.add_argument(parser)
+args = parser.parse_args()
+meter = metrics.Metrics("model_sd", args.metrics_out)
+scheme = buckets.sd_scheme(args.sd_buckets)
+Nbuckets = len(scheme)
+errors_file = args.errors_file
+forecast_cube = args.forecast_cube
+# the sha1 of each day of the errors file, or of the whole file - rescanned if it has changed
+errors_meta = sidecar.load_sidecar(errors_file)
+inputs = manifest.day_digests(errors_file, errors_meta) or errors_meta["sha1"]
+
+# accumulators indexed [day][model][bucket] - models start at 1 so row 0 stays empty
+dirty = manifest.dirty_partitions(forecast_cube, stage, inputs)
+state = np.load(state_file) if dirty is not None and os.path.exists(state_file) else None
+if state is not None and "edges" in state and state["edges"].tolist() == scheme.edges:
+    days = state["days"].tolist()
+    sums = state["sums"]
+    sums_2 = state["sums_2"]
+    counts_per_bucket = state["counts"]
+else:
+    dirty = None
+    days = []
+    sums = np.zeros((0, Nmodels + 1, Nbuckets))
+    sums_2 = np.zeros((0, Nmodels + 1, Nbuckets))
+    counts_per_bucket = np.zeros((0, Nmodels + 1, Nbuckets), dtype=np.int64)
 
-with open(errors_file, "r") as f:
-    line = f.readline()
-    assert line == header
-    line = f.readline()
-    counter = 0
-    for b in range(len(bucket_titles)):
-        variances_per_bucket[b] = {}
-        values_per_bucket[b] = {}
-        for m in range(Nmodels):
-            counts_per_bucket[b][m+1] = 0
-    while line != '':
-        if counter % message_count == 0:
-            print(counter)
-        counter += 1
-        xid, yid, date_id, hour, model, wind, err = line[:-1].split(',')
-        w = float(wind)
+if dirty is None:
+    print("Accumulating every partition")
+    blocks = chunked_csv.read_columns(errors_file, header)
+else:
+    print("Accumulating {} changed partitions".format(len(dirty)))
+    dirty_keys = np.array([d * (Nmodels + 1) + m for d, m in dirty], dtype=np.int64)
+    for d, m in dirty:
+        if d in days:
+            sums[days.index(d), m] = 0
+            sums_2[days.index(d), m] = 0
+            counts_per_bucket[days.index(d), m] = 0
+    dirty_days = sorted(set(d for d, m in dirty))
+    ranges = sidecar.day_ranges(errors_file, dirty_days) if dirty_days else []
+    if ranges is None:
+        blocks = chunked_csv.read_columns(errors_file, header)
+    else:
+        blocks = chunked_csv.read_ranges_columns(errors_file, chunked_csv.header_names(header), ranges)
+
+with meter.phase("accumulate", nbytes=metrics.file_bytes(errors_file) if dirty is None else 0) as phase:
+    for cols in blocks:
+        phase.add(len(cols["error"]))
+        if dirty is not None:
+            wanted = np.isin(cols["date_id"].astype(np.int64) * (Nmodels + 1) + cols["model"], dirty_keys)
+            cols = dict((k, v[wanted]) for k, v in cols.items())
+        if len(cols["error"]) == 0:
+            continue
+        new_days = sorted(set(np.unique(cols["date_id"]).tolist()) - set(days))
+        if new_days:
+            grow = ((0, len(new_days)), (0, 0), (0, 0))
+            days += new_days
+            sums = np.pad(sums, grow)
+            sums_2 = np.pad(sums_2, grow)
+            counts_per_bucket = np.pad(counts_per_bucket, grow)
+        day_lut = np.zeros(max(days) + 1, dtype=np.int64)
+        day_lut[days] = np.arange(len(days))
         # bucketize
-        bucket = int(w / 5)
-        if bucket > 5:
-            bucket = 5
-        #
-        errval =  float(err)
-        modelval = int(model)
-        v2 = errval * errval
-        try:
-            variances[modelval] += v2
-            values[modelval] += errval
-            counts[modelval] += 1
-            variances_per_bucket[bucket][modelval] += v2
-            values_per_bucket[bucket][modelval] += errval
-            counts_per_bucket[bucket][modelval] += 1
-        except KeyError:
-            variances[modelval] = v2
-            values[modelval] = errval
-            counts[modelval] = 1
-            variances_per_bucket[bucket][modelval] = v2
-            values_per_bucket[bucket][modelval] = errval
-        line = f.readline()
-print("Results")
-with open(sd_file, "w") as sdf:
-    sdf.write("model,sd\n")
-    with open(sd_bucket_file, "w") as bf:
-        bf.write("model,b0,b1,b2,b3,b4,b5\n")
-        for m in sorted(values.keys()):
-            assert counts[m] != 0
-            variance = variances[m] / counts[m]
-            av_err = values[m] / counts[m]
-            sd = math.sqrt(variance)
-            print("Model {} has variance = {}, SD = {} and average error {}".format(m, variance, sd, av_err))
-            sdf.write("{},{}\n".format(m, sd))
-            bvals = []
-            for b in range(len(bucket_titles)):
-                vb = variances_per_bucket[b][m] / counts_per_bucket[b][m]
-                sdb = math.sqrt(vb)
-                valb = values_per_bucket[b][m] / counts_per_bucket[b][m]
-                print("  bucket {} has variance = {}, SD = {} and average error {}".format(bucket_titles[b], vb, sdb, valb))
-                bvals.append(sdb)
-            bf.write("{},{},{},{},{},{},{}\n".format(m, bvals[0], bvals[1], bvals[2], bvals[3], bvals[4], bvals[5]))
+        bucket = scheme.assign(cols["wind"])
+        index = (day_lut[cols["date_id"]] * (Nmodels + 1) + cols["model"]) * Nbuckets + bucket
+        shape = sums.shape
+        size = sums.size
+        errval = cols["error"]
+        sums_2 += np.bincount(index, weights=errval * errval, minlength=size).reshape(shape)
+        sums += np.bincount(index, weights=errval, minlength=size).reshape(shape)
+        counts_per_bucket += np.bincount(index, minlength=size).reshape(shape)
+np.savez(state_file, days=np.array(days, dtype=np.int64), edges=np.array(scheme.edges), sums=sums, sums_2=sums_2, counts=counts_per_bucket)
+model_stats.write_sd_files(range(1, Nmodels + 1), sums.sum(axis=0)[1:], sums_2.sum(axis=0)[1:],
+                           counts_per_bucket.sum(axis=0)[1:], sd_file, sd_bucket_file, scheme)
+manifest.mark_consumed(forecast_cube, stage, inputs)
+meter.total()
 print("Done")
-
-    
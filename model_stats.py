@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+#
+# model_errors and model_sd in one pass, without the ModelErrorFile.csv in between.
+# Each day of the forecast and in-situ data is loaded as a cube, its errors found by
+# one broadcast subtraction, and the sums, sums of squares and counts per model and
+# wind bucket added up with np.bincount. Only the accumulators outlive the day.
+# Writes sd_file.csv and sd_bucket_file.csv as model_sd.py does.
+
+import argparse
+import logging
+import math
+
+import numpy as np
+
+import buckets
+import metrics
+import model_errors
+import streams
+import windcube
+
+sd_file = "sd_file.csv"
+sd_bucket_file = "sd_bucket_file.csv"
+
+
+def accumulate_day(err, wind, sums, sums_2, counts, scheme=buckets.DEFAULT_SD):
+    """
+    Add the errors of one day into the accumulators, bucketed by the in-situ wind.
+    :param err: errors (models, hours, x, y), NaN where missing
+    :param wind: in-situ wind (hours, x, y)
+    :param sums: accumulators of shape (models, buckets), added to in place
+    :param scheme: buckets.BucketScheme of the wind buckets
+    :return: errors counted
+    """
+    present = ~np.isnan(err)
+    model = np.broadcast_to(np.arange(err.shape[0]).reshape(-1, 1, 1, 1), err.shape)[present]
+    index = model * len(scheme) + scheme.assign(np.broadcast_to(wind, err.shape)[present])
+    errval = err[present]
+    shape = sums.shape
+    sums += np.bincount(index, weights=errval, minlength=sums.size).reshape(shape)
+    sums_2 += np.bincount(index, weights=errval * errval, minlength=sums.size).reshape(shape)
+    counts += np.bincount(index, minlength=sums.size).reshape(shape)
+    return len(errval)
+
+
+def accumulate(model_file, insitu_file, header, report, phase, scheme=buckets.DEFAULT_SD, maps=None):
+    """
+    Accumulate the errors of every day of the common grid.
+    Csv inputs are read a day at a time, through the sidecar run index.
+    :param header: common grid, from model_errors.common_header
+    :param maps: variance_maps.VarianceMaps to add the errors to as well, or None
+    :return: sums, sums of squares and counts, each of shape (models, buckets)
+    """
+    sums = np.zeros((len(header["models"]), len(scheme)))
+    sums_2 = np.zeros_like(sums)
+    counts = np.zeros(sums.shape, dtype=np.int64)
+    for day in header["days"]:
+        logging.warning("Accumulating day {} ...".format(day))
+        forecast, fheader = windcube.open_any(model_file, day, np.float64)
+        insitu, iheader = windcube.open_any(insitu_file, day, np.float64)
+        err, wind = model_errors.day_errors(forecast, fheader, insitu, iheader, header, day, report)
+        phase.add(accumulate_day(err, wind, sums, sums_2, counts, scheme))
+        if maps is not None:
+            maps.add_day(err)
+        del forecast, insitu
+    return sums, sums_2, counts
+
+
+def sd_tables(models, sums_2, counts_per_bucket):
+    """
+    The SDs as weighted_means reads them back from the sd files.
+    :return: dict of model to SD, dict of model to list of per bucket SDs
+    """
+    variances = sums_2.sum(axis=1).tolist()
+    counts = counts_per_bucket.sum(axis=1).tolist()
+    sds = {}
+    bsds = {}
+    for i, m in enumerate(models):
+        if counts[i] == 0:
+            continue
+        sds[m] = math.sqrt(variances[i] / counts[i])
+        bsds[m] = [math.sqrt(v / c) for v, c in zip(sums_2[i].tolist(), counts_per_bucket[i].tolist())]
+    return sds, bsds
+
+
+def write_sd_files(models, sums, sums_2, counts_per_bucket, sd_fn=sd_file, bucket_fn=sd_bucket_file,
+                   scheme=buckets.DEFAULT_SD):
+    """
+    Write the SD of each model, overall and per wind bucket.
+    :param models: model ids, one per row of the accumulators
+    :param sums: sums of the errors (models, buckets) - likewise sums_2 and counts_per_bucket
+    :param scheme: buckets.BucketScheme of the wind buckets - recorded in the bucket file
+                   unless it is the default
+    """
+    bucket_titles = scheme.titles()
+    variances_per_bucket = sums_2.tolist()
+    values_per_bucket = sums.tolist()
+    variances = sums_2.sum(axis=1).tolist()
+    values = sums.sum(axis=1).tolist()
+    counts = counts_per_bucket.sum(axis=1).tolist()
+    counts_per_bucket = counts_per_bucket.tolist()
+    print("Results")
+    with streams.open_file(sd_fn, "w") as sdf:
+        sdf.write("model,sd\n")
+        with streams.open_file(bucket_fn, "w") as bf:
+            buckets.write_edges(bf, scheme, buckets.DEFAULT_SD)
+            bf.write(bucket_header(scheme))
+            for i, m in enumerate(models):
+                if counts[i] == 0:  # model not in the data
+                    continue
+                variance = variances[i] / counts[i]
+                av_err = values[i] / counts[i]
+                sd = math.sqrt(variance)
+                print("Model {} has variance = {}, SD = {} and average error {}".format(m, variance, sd, av_err))
+                sdf.write("{},{}\n".format(m, sd))
+                bvals = []
+                for b in range(len(bucket_titles)):
+                    vb = variances_per_bucket[i][b] / counts_per_bucket[i][b]
+                    sdb = math.sqrt(vb)
+                    valb = values_per_bucket[i][b] / counts_per_bucket[i][b]
+                    print("  bucket {} has variance = {}, SD = {} and average error {}".format(bucket_titles[b], vb, sdb, valb))
+                    bvals.append(sdb)
+                bf.write(",".join(["{}".format(m)] + ["{}".format(v) for v in bvals]) + "\n")
+
+
+def read_sd_files(sd_fn=sd_file, bucket_fn=sd_bucket_file):
+    """
+    Read back the files written by write_sd_files.
+    :return: dict of model to SD, dict of model to list of per bucket SDs, bucket scheme
+    """
+    sds = {}
+    with streams.open_file(sd_fn, "r") as f:
+        line = f.readline()
+        assert line == "model,sd\n", "Malformed sd file : {}".format(sd_fn)
+        for line in f:
+            model, data = line[:-1].split(',')
+            sds[int(model)] = float(data)
+    bsds = {}
+    with streams.open_file(bucket_fn, "r") as f:
+        line = f.readline()
+        scheme = buckets.from_edges_line(line)
+        if scheme is None:
+            scheme = buckets.DEFAULT_SD
+        else:
+            line = f.readline()
+        assert line == bucket_header(scheme), "Malformed sd bucket file : {}".format(bucket_fn)
+        for line in f:
+            values = line[:-1].split(',')
+            bsds[int(values[0])] = [float(v) for v in values[1:]]
+    return sds, bsds, scheme
+
+
+def bucket_header(scheme):
+    return ",".join(["model"] + ["b{}".format(b) for b in range(len(scheme))]) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model_file", default=model_errors.mfile, help="Forecast data - csv or cube format")
+    parser.add_argument("-i", "--insitu", default=model_errors.rfile, help="In-situ data - csv or cube format")
+    parser.add_argument("-s", "--sd_file", default=sd_file, help="Per model SD file to write")
+    parser.add_argument("-b", "--bucket_file", default=sd_bucket_file, help="Per model and bucket SD file to write")
+    parser.add_argument("-M", "--mismatches", default=None,
+                        help="Write every cell that does not match up to this file")
+    buckets.sd_option(parser)
+    parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    nl = getattr(logging, args.log.upper(), None)
+    if not isinstance(nl, int):
+        raise ValueError("Invalid log level: {}".format(args.log))
+    logging.basicConfig(level=nl,
+                        format='%(asctime)s : %(message)s')
+    meter = metrics.Metrics("model_stats", args.metrics_out)
+    fheader = windcube.header_any(args.model_file)
+    iheader = windcube.header_any(args.insitu)
+    assert fheader["models"] and not iheader["models"], "Expected a forecast file and an in-situ file"
+    header = model_errors.common_header(fheader, iheader)
+    scheme = buckets.sd_scheme(args.sd_buckets)
+    report = model_errors.MismatchReport()
+    with meter.phase("accumulate", nbytes=metrics.file_bytes(args.model_file, args.insitu)) as phase:
+        sums, sums_2, counts = accumulate(args.model_file, args.insitu, header, report, phase, scheme)
+    report.log()
+    if args.mismatches is not None:
+        report.write(args.mismatches)
+    write_sd_files(header["models"], sums, sums_2, counts, args.sd_file, args.bucket_file, scheme)
+    meter.total()
+    print("Done")
+
+
+if __name__ == '__main__':
+    main()
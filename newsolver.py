@@ -4,27 +4,88 @@
 
 import argparse
 import logging
-import pdb
+import math
+
+import numpy as np
+
+import corridor
+import metrics
+import prob_cube
+import streams
 
 
 WEATHERHEADER = "xid,yid,date_id,hour,wind\n"
 MESSAGE_COUNT = 400000
+INF = float("inf")
+VALUE_DTYPE = np.float32
 
 
 class Cell(object):
     """
-    Hold the cell info
+    Hold the cell info - where a path is at a step, and its cost so far
     Methods sparse to improve performance
     """
-    def __init__(self, x, y, t, parent, value):
+    def __init__(self, x, y, t, value):
         self.x = x
         self.y = y
         self.t = t
-        self.parent = parent
         self.value = value
 
-    def get_parent(self):
-        return self.parent
+
+class StepKernel(object):
+    """
+    The costs of every cell at the next step from those at this step, the whole grid
+    at once : the lowest of staying or moving in from one of the four neighbours, each a
+    shifted copy of the current slice plus the risk layer of the next step. A stay only
+    adds the risk when the next step starts an hour.
+    The candidates are merged one at a time with arithmetic rather than masked writes,
+    which numpy does a lot slower on masks as irregular as these. Ties go to the first
+    move in MOVES, as np.argmin would have it.
+    """
+
+    MOVES = corridor.MOVES
+
+    def __init__(self, xsize, ysize):
+        self.xsize = xsize
+        self.ysize = ysize
+        # scratch slices, reused every step
+        self.candidate = np.empty((xsize, ysize), dtype=VALUE_DTYPE)
+        self.better = np.empty((xsize, ysize), dtype=bool)
+        self.diff = np.empty((xsize, ysize), dtype=np.int8)
+
+    def window(self, dx, dy):
+        """
+        :return: slices of the cells a move of (dx, dy) can end in, and of where it starts
+        """
+        xs, ys = self.xsize, self.ysize
+        return ((slice(max(dx, 0), xs + min(dx, 0)), slice(max(dy, 0), ys + min(dy, 0))),
+                (slice(max(-dx, 0), xs + min(-dx, 0)), slice(max(-dy, 0), ys + min(-dy, 0))))
+
+    def step(self, current, layer, boundary, out, codes):
+        """
+        :param current: costs [x][y] at this step, +inf where not reached
+        :param layer: risk costs [x][y] of the next step
+        :param boundary: True if the next step starts an hour
+        :param out: costs [x][y] at the next step, filled in
+        :param codes: parent codes [x][y] of the next step, filled in - an index into MOVES
+        """
+        if boundary:
+            np.add(current, layer, out=out)
+        else:  # during an hour, the cell value does not change.
+            out[:] = current
+        codes.fill(0)
+        for code, (dx, dy) in enumerate(StepKernel.MOVES[1:], 1):
+            dst, src = self.window(dx, dy)
+            candidate = self.candidate[dst]
+            better = self.better[dst]
+            diff = self.diff[dst]
+            np.add(current[src], layer[dst], out=candidate)
+            np.less(candidate, out[dst], out=better)
+            np.minimum(out[dst], candidate, out=out[dst])
+            # codes = better ? code : codes
+            np.subtract(np.int8(code), codes[dst], out=diff)
+            np.multiply(diff, better, out=diff)
+            np.add(codes[dst], diff, out=codes[dst])
 
 
 class SolverStore(object):
@@ -38,34 +99,32 @@ class SolverStore(object):
     MIN_STEPS = MIN_HOUR * STEPS_PER_HOUR
     MAX_STEPS = MAX_HOUR * STEPS_PER_HOUR
     TOTAL_STEPS = (MAX_HOUR - MIN_HOUR) * STEPS_PER_HOUR
-
-    def __init__(self, cell, layers, xsize, ysize, wthing, furthestc, step=90):
-        # store is a list of list of list so can do [x][y][t]
-        # this is different from the layer structure which is [t][x][y]
+    # parent codes : the move into a cell, an index into MOVES, or NO_PARENT at the start
+    MOVES = corridor.MOVES
+    NO_PARENT = -1
+    # (x, y) of the grid the store covers, on the whole grid - set by solve
+    origin = (0, 0)
+
+    def __init__(self, cell, costs, xsize, ysize, city_dist, step=90):
+        # the store is two arrays indexed [t][x][y], as the layers are - the cost of the
+        # best path to each cell at each step, +inf where none has been found, and the
+        # move it came by.
+        # costs holds -log(1 - probability of a wind >= 15) per [t][x][y], so cell
+        # values are the cost of the path so far - lower is better
         self.steps_size = SolverStore.TOTAL_STEPS
-        logging.warning("Initializing store ...")
-        self.store = [[[None for h in range(self.steps_size)] for y in range(ysize)] for x in range(xsize)]
+        shape = (self.steps_size, xsize, ysize)
+        logging.warning("Initializing store of {} MB ...".format(
+            (np.prod(shape) * (np.dtype(VALUE_DTYPE).itemsize + 1)) >> 20))
+        self.values = np.full(shape, INF, dtype=VALUE_DTYPE)
+        self.parents = np.full(shape, SolverStore.NO_PARENT, dtype=np.int8)
         logging.warning("  done.")
-        self.store[cell.x][cell.y][cell.t] = cell
-        assert self.store[cell.x][cell.y][cell.t] is not None
+        self.values[cell.t, cell.x, cell.y] = cell.value
         self.xsize = xsize
         self.ysize = ysize
-        self.wthing = wthing
-        self.furthestc = furthestc
+        self.city_dist = city_dist
         self.step = step
-        self.layers = layers
-
-    def validate(self, x, y, t):
-        dist = abs(self.furthestc[0] - x) + abs(self.furthestc[1] - y)
-        if dist > SolverStore.TOTAL_STEPS - t:
-            return False
-        if x < 0 or x >= self.xsize:
-            return False
-        if y < 0 or y >= self.ysize:
-            return False
-        if t < 0 or t >= SolverStore.TOTAL_STEPS:
-            return False
-        return True
+        self.costs = np.asarray(costs, dtype=VALUE_DTYPE)
+        self.kernel = StepKernel(xsize, ysize)
 
     @staticmethod
     def to_layer_index(t):
@@ -73,130 +132,89 @@ class SolverStore(object):
         assert li >= 0, "Bad calculation!"
         return li
 
-    def calc_value(self, current, wind):
-        return current * (1 - self.wthing.get_prob(wind))
-
-    def merge_child(self, cell):
-        # check the cell against all others with the same x,y,t - only the best survives.
-        peer = self.store[cell.x][cell.y][cell.t]
-        if peer is None or cell.value > peer.value:
-            self.store[cell.x][cell.y][cell.t] = cell
-
-    def generate_children(self, c):
+    def take_step(self, city, step):
         """
-        Children = stay here or move 1 in up/down/left/right
-        Merge into store
-        :return: valid child cells
+        Fill in the costs of the cells at a step from those of the step before.
+        Step 0 is the start.
         """
-        #pdb.set_trace()
-        nt = c.t + 1
-        for dx in [-1, 0, 1]:
-            for dy in [-1, 0, 1]:
-                if abs(dx) == abs(dy):
-                    continue  # no diags
-                nx = c.x + dx
-                ny = c.y + dy
-                if self.validate(nx, ny, nt):
-                    nv = self.calc_value(c.value, self.layers[self.to_layer_index(nt)][nx][ny])
-                    peer = self.store[nx][ny][nt]
-                    if peer is None or nv > peer.value:
-                        self.store[nx][ny][nt] = Cell(nx, ny, nt, c, nv)
-        # and stay in place for a step
-        if self.validate(c.x, c.y, nt):
-            if nt % SolverStore.STEPS_PER_HOUR == 0:  # on a boundary
-                nv = self.calc_value(c.value, self.layers[self.to_layer_index(nt)][c.x][c.y])
-            else:  # during an hour, the cell value does not change.
-                nv = c.value
-            peer = self.store[c.x][c.y][nt]
-            if peer is None or nv > peer.value:
-                self.store[c.x][c.y][nt] = Cell(c.x, c.y, nt, c, nv)
-
-    def take_step(self, city, step):
-        diff = city.x - step
-        if diff < 0:
-            sx = 0
-        else:
-            sx = diff
-        diff = city.x + step + 1
-        if diff > self.xsize:
-            ex = self.xsize
-        else:
-            ex = diff
-        diff = city.y - step
-        if diff < 0:
-            sy = 0
-        else:
-            sy = diff
-        diff = city.y + step + 1
-        if diff > self.ysize:
-            ey = self.ysize
-        else:
-            ey = diff
-        for x in range(sx, ex):
-            for y in range(sy, ey):
-                for h in range(self.steps_size):
-                    target = self.store[x][y][h]
-                    if target is not None:
-                        self.generate_children(target)
+        if step == 0:
+            return
+        self.kernel.step(self.values[step - 1], self.costs[self.to_layer_index(step)],
+                         step % SolverStore.STEPS_PER_HOUR == 0, self.values[step], self.parents[step])
+        # too far from every city to get to one in time
+        self.values[step][self.city_dist > SolverStore.TOTAL_STEPS - step] = INF
+
+    def parent_of(self, entry):
+        """
+        Decode the parent of a cell from its move code.
+        :return: Cell the path came from, None at the start
+        """
+        code = self.parents[entry.t, entry.x, entry.y]
+        if code == SolverStore.NO_PARENT:
+            return None
+        dx, dy = SolverStore.MOVES[code]
+        x = entry.x - dx
+        y = entry.y - dy
+        return Cell(x, y, entry.t - 1, float(self.values[entry.t - 1, x, y]))
 
     def report_path(self, entry, cityid, dayid):
         """
-        Output the resulting path.
+        Output the resulting path, from the start to the city, in the line format of
+        triggered_solver - cid,date_id,hh:mm,xid,yid.
         Note the need to +1 the x and y values as they are reduced by 1 internally,
-        and adding 3 hours of steps to the time.
+        and adding 3 hours of steps to the time. Cells are moved back onto the whole
+        grid from the origin of the store.
         :param entry: Cell of interest
         :return: String with path data.
         """
         assert entry is not None, "Entry must not be None!"
-        if entry.get_parent is None:  # no parent, so at start
-            return "{},{},{}:{},{},{}\n".format(cityid,
-                                                dayid,
-                                                (entry.t / SolverStore.STEPS_PER_HOUR) + SolverStore.MIN_HOUR,
-                                                2 * (entry.t % SolverStore.STEPS_PER_HOUR),
-                                                entry.x + 1,
-                                                entry.y + 1)
-        else:
-            return "{},{},{}\n".format(cityid,
-                                       dayid,
-                                       (entry.t / SolverStore.STEPS_PER_HOUR) + SolverStore.MIN_HOUR,
-                                       2 * (entry.t % SolverStore.STEPS_PER_HOUR),
-                                       entry.x + 1,
-                                       entry.y + 1) +\
-                   self.report_path(entry.get_parent(), cityid, dayid)
+        lines = []
+        while entry is not None:
+            lines.append("{},{},{:02d}:{:02d},{},{}\n".format(cityid,
+                                                           dayid,
+                                                           int(entry.t // SolverStore.STEPS_PER_HOUR) +
+                                                           SolverStore.MIN_HOUR,
+                                                           2 * (entry.t % SolverStore.STEPS_PER_HOUR),
+                                                           entry.x + self.origin[0] + 1,
+                                                           entry.y + self.origin[1] + 1))
+            entry = self.parent_of(entry)
+        return "".join(reversed(lines))
 
     def find_best_path(self, cityid, cities, dayid):
-        city = cities[cityid]
-        best = None
-        bestconfidence = 0
-        for t in range(SolverStore.TOTAL_STEPS):
-            thisone = self.store[city[0]][city[1]][t]
-            if thisone is None:  # city wasn't found yet
-                continue
-            else:
-                if thisone.value > bestconfidence:
-                    bestconfidence = thisone.value
-                    best = thisone
+        best = self.best_entry(cityid, cities)
         if best is None:
-            pdb.set_trace()
-        assert best is not None, "No path found no matter how ludicrous!"
+            return ""
         # OK - now walk back from here
         return self.report_path(best, cityid, dayid)
 
+    def best_cost(self, x, y):
+        """
+        :return: the lowest cost a cell was reached at, at any step, INF if never
+        """
+        return float(self.values[:, x, y].min())
+
+    def best_entry(self, cityid, cities):
+        """
+        :return: the Cell reaching a city with the lowest cost, None if it is never reached
+        """
+        x, y = cities[cityid]
+        t = int(np.argmin(self.values[:, x, y]))
+        bestcost = float(self.values[t, x, y])
+        if bestcost == INF:
+            logging.warning("City {} is unreachable - no path written".format(cityid))
+            return None
+        logging.info("City {} reached with confidence {}".format(cityid, to_confidence(bestcost)))
+        return Cell(x, y, t, bestcost)
+
     def dump_debug_info(self):
         """
         Report various bits of info on the store.
         :return:
         """
         logging.warning("Reporting debug info on store ...")
-        h_none_count = [0 for h in range(self.steps_size)]
-        vcounts = [[0 for x in range(self.xsize)] for h in range(self.steps_size)]
-        for x in range(self.xsize):
-            for y in range(self.ysize):
-                for h in range(self.steps_size):
-                    if self.store[x][y][h] is None:
-                        h_none_count[h] += 1
-                    else:
-                        vcounts[h][x] += self.store[h][x][y]
+        reached = self.values < INF
+        h_none_count = (~reached).sum(axis=(1, 2)).tolist()
+        vcounts = np.where(reached, self.values, 0).sum(axis=2).tolist()
         print("steps_size = {}, xsize = {}, ysize = {}".format(self.steps_size, self.xsize, self.ysize))
         print("None per step = ")
         for h in range(self.steps_size):
@@ -207,97 +225,132 @@ class SolverStore(object):
                 print("{}:{} => {}".format(h, x, vcounts[h][x]))
 
 
-
-
-class Weighter(object):
+class RollingSolver(SolverStore):
     """
-    This reads probabilities from a file, then
-    uses this to map winds to probs
-    The data is a single line of probabilities for buckets of 0.5 each
+    The same search a step at a time : only the costs of the current and the next step
+    are kept, as [x][y] slices, and the move into every cell at every step as a 3 bit
+    code, packed, in memory or in a file.
     """
 
-    Nprobs = 60
-    BucketWidth = 0.5
-    MAX = 1.0
+    CODE_BITS = 3
+    NO_PARENT = (1 << CODE_BITS) - 1
 
-    def __init__(self, args):
-        self.values = None
-        logging.warning("Reading probabilites ...")
-        with open(args.probfile, "r") as f:
-            line = f.readline()
-            # skip comments as weight file has a lot of extra stuff
-            while line != '' and line[0] == '#':
-                line = f.readline()
-            self.values = list(map(float, line[:-1].split(',')))
-        assert len(list(self.values)) == Weighter.Nprobs, "Unexpected number of probabilities!"
-        for v in self.values:
-            assert v <= Weighter.MAX, "Bad value"
-        logging.warning("  done.")
+    def __init__(self, cell, costs, xsize, ysize, city_dist, parents_file=None):
+        self.steps_size = SolverStore.TOTAL_STEPS
+        self.xsize = xsize
+        self.ysize = ysize
+        self.city_dist = city_dist
+        self.costs = np.asarray(costs, dtype=VALUE_DTYPE)
+        self.current = np.full((xsize, ysize), INF, dtype=VALUE_DTYPE)
+        self.current[cell.x, cell.y] = cell.value
+        self.next = np.empty_like(self.current)
+        self.codes = np.empty((xsize, ysize), dtype=np.int8)
+        self.kernel = StepKernel(xsize, ysize)
+        # lowest cost each cell is reached at over the steps so far, and the first step at it
+        self.lowest = self.current.copy()
+        self.lowest_t = np.zeros((xsize, ysize), dtype=np.int16)
+        step_bytes = -(-xsize * ysize * RollingSolver.CODE_BITS // 8)
+        logging.warning("Packed moves take {} MB{} ...".format(
+            (self.steps_size * step_bytes) >> 20, "" if parents_file is None else " in " + parents_file))
+        if parents_file is None:
+            self.packed = np.zeros((self.steps_size, step_bytes), dtype=np.uint8)
+        else:
+            self.packed = np.memmap(parents_file, dtype=np.uint8, mode="w+", shape=(self.steps_size, step_bytes))
+        self.packed[0] = RollingSolver.pack(np.full((xsize, ysize), RollingSolver.NO_PARENT, dtype=np.uint8))
 
-    def get_prob(self, wind):
-        index = int(wind / Weighter.BucketWidth)
-        if index >= Weighter.Nprobs:
-            index = Weighter.Nprobs - 1
-        return self.values[index]
-
-
-def scan_file_for_dimensions(fn):
-    mx = 0
-    my = 0
-    maxh = 0
-    minh = 24  # hour cannot be beyond end of day
-    count = 0
-    logging.warning("Scanning input file for size information ...")
-    with open(fn, "r") as f:
-        line = f.readline()
-        assert line == WEATHERHEADER, "Malformed file - header does not match expectations"
-        line = f.readline()
-        while line != '':
-            if count % MESSAGE_COUNT == 0:
-                print(count)
-            count += 1
-            # note dropping of final \n
-            xid_r, yid_r, date_r, hour_r, wind_r = line[:-1].split(',')
-            xid, yid, hid = int(xid_r), int(yid_r), int(hour_r)
-            if xid > mx:
-                mx = xid
-            if yid > my:
-                my = yid
-            if hid > maxh:
-                maxh = hid
-            if hid < minh:
-                minh = hid
-            line = f.readline()
-        return mx, my, minh, maxh
+    @staticmethod
+    def pack(codes):
+        """
+        :param codes: move codes [x][y]
+        :return: the codes packed CODE_BITS each, in [x][y] order, high bit first
+        """
+        # every 8 codes make a word of CODE_BITS bytes - a lot quicker than np.packbits
+        # on a bit per byte array
+        bits = RollingSolver.CODE_BITS
+        n = codes.size
+        flat = np.zeros(-(-n // 8) * 8, dtype=np.uint32)
+        flat[:n] = codes.ravel()
+        word = np.zeros(len(flat) // 8, dtype=np.uint32)
+        for i in range(8):
+            np.bitwise_or(word, flat[i::8] << np.uint32(bits * (7 - i)), out=word)
+        packed = np.empty((len(word), bits), dtype=np.uint8)
+        for b in range(bits):
+            packed[:, b] = word >> np.uint32(8 * (bits - 1 - b))
+        return packed.ravel()[:-(-n * bits // 8)]
+
+    def code_at(self, x, y, t):
+        """
+        Unpack the move code of a cell at a step.
+        """
+        bit = (x * self.ysize + y) * RollingSolver.CODE_BITS
+        code = 0
+        for b in range(bit, bit + RollingSolver.CODE_BITS):
+            code = (code << 1) | ((int(self.packed[t, b >> 3]) >> (7 - (b & 7))) & 1)
+        return code
+
+    def take_step(self, city, step):
+        """
+        Fill in the costs of the cells at a step from those of the step before.
+        Step 0 is the start.
+        """
+        if step == 0:
+            return
+        nxt = self.next
+        self.kernel.step(self.current, self.costs[self.to_layer_index(step)],
+                         step % SolverStore.STEPS_PER_HOUR == 0, nxt, self.codes)
+        # too far from every city to get to one in time
+        nxt[self.city_dist > SolverStore.TOTAL_STEPS - step] = INF
+        self.packed[step] = RollingSolver.pack(self.codes)
+        better = self.kernel.better
+        np.less(nxt, self.lowest, out=better)
+        np.minimum(self.lowest, nxt, out=self.lowest)
+        self.lowest_t += better * (step - self.lowest_t)
+        self.current, self.next = nxt, self.current
+
+    def parent_of(self, entry):
+        """
+        Decode the parent of a cell from its packed move code.
+        :return: Cell the path came from, None at the start
+        """
+        code = self.code_at(entry.x, entry.y, entry.t)
+        if code == RollingSolver.NO_PARENT:
+            return None
+        dx, dy = SolverStore.MOVES[code]
+        return Cell(entry.x - dx, entry.y - dy, entry.t - 1, None)
+
+    def best_cost(self, x, y):
+        return float(self.lowest[x, y])
 
+    def best_entry(self, cityid, cities):
+        """
+        :return: the Cell reaching a city with the lowest cost, None if it is never reached
+        """
+        x, y = cities[cityid]
+        bestcost = float(self.lowest[x, y])
+        if bestcost == INF:
+            logging.warning("City {} is unreachable - no path written".format(cityid))
+            return None
+        logging.info("City {} reached with confidence {}".format(cityid, to_confidence(bestcost)))
+        return Cell(x, y, int(self.lowest_t[x, y]), bestcost)
 
-def read_layers(args):
-    xsize, ysize, minh, maxh = scan_file_for_dimensions(args.weatherfile)
-    assert minh >= SolverStore.MIN_HOUR, "Unexpected early hour!"
+    def dump_debug_info(self):
+        logging.warning("No store to report on - the rolling solver only keeps the last step")
+
+
+def read_costs(args):
+    """
+    The -log(1 - p) costs of the day, from its cost cube - see prob_cube.py.
+    """
+    cache = "" if args.no_cost_cache else args.cost_cache
+    costs, xsize, ysize, minh, maxh = prob_cube.day_costs(args.weatherfile, args.dayid, args.probfile, cache)
+    assert minh == SolverStore.MIN_HOUR, "Unexpected early hour!"
     assert maxh < SolverStore.MAX_HOUR, "Unexpected late hour!"
-    hsize = SolverStore.MAX_HOUR - SolverStore.MIN_HOUR
-    logging.warning("Creating layer structure ...")
-    layers = [[[0 for y in range(1, ysize + 1)] for x in range(1, xsize + 1)] for h in range(minh, maxh + 1)]
-    logging.warning("Reading weather file data into layers...")
-    with open(args.weatherfile, "r") as f:
-        line = f.readline()
-        assert line == WEATHERHEADER, "Unexpected header for weather data"
-        line = f.readline()
-        read_count = 0
-        while line != '':
-            if read_count % MESSAGE_COUNT == 0:
-                print(read_count)
-            read_count += 1
-            xid_r, yid_r, date_id_r, hour_r, wind_r = line[:-1].split(',')
-            xid, yid, hour, wind = int(xid_r) - 1, int(yid_r) - 1, int(hour_r) - SolverStore.MIN_HOUR, float(wind_r)
-            layers[hour][xid][yid] = wind
-            line = f.readline()
-    return layers, xsize, ysize
+    return costs, xsize, ysize
 
 
 def read_cities(args):
     tmp = {}
-    with open(args.cities, "r") as f:
+    with streams.open_file(args.cities, "r") as f:
         line = f.readline()
         assert line == "cid,xid,yid\n", "Malformed city file"
         line = f.readline()
@@ -312,58 +365,149 @@ def read_cities(args):
     return cities
 
 
-def confidence(before, prob):
-    return before * (1 - prob)
+def to_confidence(cost):
+    """
+    The confidence of a path from its cost - only done when reporting.
+    """
+    return math.exp(-cost)
 
 
-def get_furthest_city(cities):
-    maxd = 0
-    fc = None
-    for c in cities[1:]:
-        dist = abs(c[0] - cities[0][0]) + abs(c[1] - cities[0][1])
-        if dist > maxd:
-            maxd = dist
-            fc = c
-    return fc
+def city_distances(cities, xsize, ysize):
+    """
+    Steps from every cell to the nearest city - a cell further than the steps left
+    cannot be on the path to any of them.
+    :return: int array [x][y]
+    """
+    xs, ys = np.meshgrid(np.arange(xsize), np.arange(ysize), indexing="ij")
+    return np.min([abs(c[0] - xs) + abs(c[1] - ys) for c in cities[1:]], axis=0)
+
+
+def solve(args, costs, cities, xsize, ysize, phase, origin=(0, 0)):
+    """
+    Build up a complete set of ways of getting to everywhere from the start city.
+    :param costs: costs [hour][x][y]
+    :param cities: list of (x, y) on the grid of the costs
+    :param phase: metrics phase counting the steps
+    :param origin: (x, y) of the grid of the costs on the whole grid
+    :return: SolverStore, or RollingSolver with -r
+    """
+    start_time = 0  # just remember need to add MIN_STEPS on output
+    london = Cell(cities[0][0], cities[0][1],
+                  start_time,
+                  costs[0][cities[0][0]][cities[0][1]])
+    city_dist = city_distances(cities, xsize, ysize)
+    if args.rolling:
+        ss = RollingSolver(london, costs, xsize, ysize, city_dist, args.parents_file)
+    else:
+        ss = SolverStore(london, costs, xsize, ysize, city_dist)
+    ss.origin = origin
+    for step in range(SolverStore.TOTAL_STEPS):
+        ss.take_step(london, step)
+        phase.add()
+    return ss
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-w", "--weatherfile", default="combined_day_1.csv",
-                        help="Weather prediction data in csv format")
+                        help="Weather prediction data in csv or cube format")
     parser.add_argument("-c", "--cities", default="CityData.csv", help="City data in csv format")
     parser.add_argument("-p", "--probfile", default="ProbData.csv", help="Mapping of wind to prob >= 15")
-    parser.add_argument("-d", "--dayid", default=1, help="Which day is being processed. Used during output only")
+    parser.add_argument("-d", "--dayid", "--day", default=1,
+                        help="Which day is being processed - only this day's rows of a multi-day file are read")
+    parser.add_argument("-o", "--output", default=None, help="Output path information - default stdout")
     parser.add_argument("-D", "--debug", action="store_true", help="Debug mode - some extra output is provided.")
+    parser.add_argument("-k", "--cost_cache", default=None,
+                        help="Cost cube of the day, built if out of date - default next to the weather file")
+    parser.add_argument("-K", "--no-cost-cache", action="store_true",
+                        help="Map the winds to costs without keeping them in a cube")
+    parser.add_argument("-W", "--corridor", default=None, type=int,
+                        help="Solve coarse to fine - only cells within this many blocks of the coarse paths")
+    parser.add_argument("-R", "--coarse_ratio", default=corridor.RATIO, type=int,
+                        help="Cells per side of the blocks of the coarse solve")
+    parser.add_argument("-S", "--corridor_report", default=corridor.REPORT,
+                        help="What the corridor did for each city, written with -W")
+    parser.add_argument("-r", "--rolling", action="store_true",
+                        help="Keep only two steps of costs, and the moves into every cell as packed 3 bit codes")
+    parser.add_argument("-P", "--parents_file", default=None,
+                        help="Keep the packed moves of the rolling solver in this file rather than in memory")
     parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
     args = parser.parse_args()
     nl = getattr(logging, args.log.upper(), None)
     if not isinstance(nl, int):
         raise ValueError("Invalid log level: {}".format(args.log))
     logging.basicConfig(level=nl,
                         format='%(asctime)s : %(message)s')
-    layers, xsize, ysize = read_layers(args)
+    meter = metrics.Metrics("newsolver", args.metrics_out)
+    with meter.phase("read", unit="layers", nbytes=metrics.file_bytes(args.weatherfile)) as phase:
+        costs, xsize, ysize = read_costs(args)
+        phase.add(len(costs))
     cities = read_cities(args)
-    weighter = Weighter(args)
-    start_time = 0  # just remember need to add MIN_STEPS on output
-    london = Cell(cities[0][0], cities[0][1],
-                  start_time,
-                  None,
-                  confidence(1, weighter.get_prob(layers[0][cities[0][0]][cities[0][1]])))
-    furthest_city = get_furthest_city(cities)
-    ss = SolverStore(london, layers, xsize, ysize, weighter, furthest_city)
-    # build up a complete set of ways of getting to everywhere
-    for step in range(SolverStore.TOTAL_STEPS):
-        logging.warning("Step {}".format(step))
-        ss.take_step(london, step)
-    if args.debug:
-        ss.dump_debug_info()
-    # now see what the best path is to every city
-    logging.warning("Finding paths ...")
-    path = None
-    for cityid in range(len(cities[1:])):
-        path = ss.find_best_path(cityid, cities, args.dayid)
-    print("{}".format(path))
+    paths = {}
+    # per city : the corridor width its path was taken from, None for the whole grid,
+    # the cost of the path, and the cost found in the first corridor
+    widths = {}
+    path_costs = {}
+    corridor_costs = {}
+    remaining = list(range(1, len(cities)))
+    width = args.corridor
+    while remaining:
+        mask = None
+        if width is not None:
+            with meter.phase("coarse", unit="cities") as phase:
+                mask = corridor.corridor_mask(costs, cities, SolverStore.STEPS_PER_HOUR, SolverStore.TOTAL_STEPS,
+                                              args.coarse_ratio, width, remaining)
+                phase.add(len(remaining))
+            # the kernel works on the whole of its grid, so only the box around the
+            # corridor is solved - it is what has to be small
+            box = corridor.bounding_box(mask)
+            if corridor.box_area(box) > corridor.MAX_AREA * mask.size:
+                logging.warning("Solving the whole grid for {} cities ...".format(len(remaining)))
+                mask = None
+        if mask is None:
+            box = (slice(0, xsize), slice(0, ysize))
+            box_costs = costs
+        else:
+            box_costs = corridor.restrict(costs, mask)[(slice(None),) + box]
+        x0, y0 = box[0].start, box[1].start
+        local = [(x - x0, y - y0) for x, y in cities]
+        with meter.phase("solve", unit="steps") as phase:
+            ss = solve(args, box_costs, local, box_costs.shape[1], box_costs.shape[2], phase, (x0, y0))
+        if args.debug:
+            ss.dump_debug_info()
+        settled = remaining
+        if mask is not None:
+            cells = corridor.edge_cells(mask)
+            with meter.phase("bounds", unit="cities") as phase:
+                bounds = corridor.leaving_bounds(costs, mask, cells, [ss.best_cost(x - x0, y - y0) for x, y in cells])
+                phase.add(len(remaining))
+            settled = [cid for cid in remaining
+                       if not corridor.report(cid, ss.best_cost(*local[cid]), bounds[cities[cid]])]
+        # now see what the best path is to every city
+        logging.warning("Finding paths ...")
+        with meter.phase("paths", unit="cities") as phase:
+            for cityid in settled:
+                paths[cityid] = ss.find_best_path(cityid, local, args.dayid)
+                widths[cityid] = None if mask is None else width
+                path_costs[cityid] = ss.best_cost(*local[cityid])
+                phase.add()
+        for cityid in remaining:
+            corridor_costs.setdefault(cityid, ss.best_cost(*local[cityid]))
+        remaining = [cityid for cityid in remaining if cityid not in settled]
+        if remaining:
+            width *= corridor.WIDEN
+            logging.warning("Solving {} cities again in a corridor of width {} ...".format(len(remaining), width))
+        del ss  # done with - and a rolling solver may be about to reuse its parents file
+    if args.corridor is not None:
+        corridor.write_report(args.corridor_report, widths, path_costs, corridor_costs)
+    paths = "".join(paths[cityid] for cityid in sorted(paths))
+    if args.output is None:
+        print(paths, end="")
+    else:
+        with streams.open_file(args.output, "w") as fout:
+            fout.write(paths)
+    meter.total()
 
 if __name__ == '__main__':
     main()
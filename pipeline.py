@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+#
+# The whole preparation chain in two passes over the raw data, in place of
+#    model_errors.py -> model_sd.py -> weighted_means.py (steps 1 and 2) -> split_combined.py
+# each of which went through a full csv on disk.
+#    pass 1 : forecast + in-situ, a day at a time -> sd_file.csv, sd_bucket_file.csv
+#    pass 2 : forecast + in-situ, a day at a time -> combined cube, per-day combined
+#             files, results.csv and its per day and per hour probability tables
+# Nothing else is written - the errors and the combined values of a day only live in
+# memory, or in the memmap of the combined cube.
+# The solvers take the per-day files as before, or the combined cube with -d, and
+# verify_path.py reads a day straight from the in-situ file with --day.
+
+import argparse
+import logging
+
+import numpy as np
+
+import buckets
+import metrics
+import model_errors
+import model_stats
+import streams
+import variance_maps
+import weighted_means
+import windcube
+
+COMBINEDHEADER = weighted_means.WeighingMachine.COMBINEDHEADER
+
+
+def first_pass(args, header, report, meter, scheme):
+    """
+    Errors of every model against the in-situ data, written as the sd files.
+    :param scheme: buckets.BucketScheme of the per model SDs
+    :return: SD per model, SDs per model per bucket
+    """
+    maps = None if args.variance_maps is None else variance_maps.VarianceMaps(header)
+    with meter.phase("errors", nbytes=metrics.file_bytes(args.model_file, args.insitu)) as phase:
+        sums, sums_2, counts = model_stats.accumulate(args.model_file, args.insitu, header, report, phase, scheme,
+                                                      maps)
+    model_stats.write_sd_files(header["models"], sums, sums_2, counts, args.sdfile, args.sdbucketfile, scheme)
+    if maps is not None:
+        maps.write(args.variance_maps)
+    return model_stats.sd_tables(header["models"], sums_2, counts)
+
+
+def per_day_name(args, day):
+    return "{}_{}.csv{}".format(args.per_day, day, args.compress)
+
+
+def second_pass(args, cacher, header, meter):
+    """
+    Combine the models of each day, write the day out, and add its errors against the
+    in-situ data into the results table.
+    :param header: common grid of the forecast and in-situ data
+    :return: files written
+    """
+    fheader = windcube.header_any(args.model_file)
+    cheader = windcube.make_header(fheader["xsize"], fheader["ysize"], fheader["min_hour"], fheader["max_hour"],
+                                   fheader["days"], [], np.float64)
+    logging.warning("Creating combined cube {} with shape {} ...".format(args.combined, cheader["shape"]))
+    combined = windcube.create_cube(args.combined, cheader)
+    tables = weighted_means.TableSet(header, buckets.prob_scheme(args.prob_buckets))
+    written = [args.combined]
+    with meter.phase("combine", nbytes=metrics.file_bytes(args.model_file, args.insitu)) as phase:
+        for ci, day in enumerate(cheader["days"]):
+            logging.warning("Combining day {} ...".format(day))
+            forecast, dheader = windcube.open_any(args.model_file, day, np.float64)
+            cacher.combine_day(forecast, dheader, dheader["days"].index(day), combined, ci)
+            del forecast
+            if args.per_day is not None:
+                day_header = windcube.make_header(cheader["xsize"], cheader["ysize"], cheader["min_hour"],
+                                                  cheader["max_hour"], [day], [], np.float64)
+                written.append(per_day_name(args, day))
+                with streams.open_file(written[-1], "w") as out:
+                    out.write(COMBINEDHEADER)
+                    cacher.write_cube(combined[:, ci:ci + 1], day_header, out, phase)
+            if day in header["days"]:
+                insitu, iheader = windcube.open_any(args.insitu, day, np.float64)
+                cval = model_errors.day_slice(combined, cheader, header, day)[0]
+                ival = model_errors.day_slice(insitu, iheader, header, day)[0]
+                tables.add_day(day, weighted_means.hour_tables(cval, ival, tables.scheme))
+                del insitu
+        combined.flush()
+    return written + tables.write(args.results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model_file", default=model_errors.mfile, help="Forecast data - csv or cube format")
+    parser.add_argument("-i", "--insitu", default=model_errors.rfile, help="In-situ data - csv or cube format")
+    parser.add_argument("-s", "--sdfile", default=model_stats.sd_file, help="Per model SD file to write")
+    parser.add_argument("-b", "--sdbucketfile", default=model_stats.sd_bucket_file,
+                        help="Per model and bucket SD file to write")
+    parser.add_argument("-c", "--combined", default="combined.cube", help="Combined cube to write")
+    parser.add_argument("-p", "--per_day", default="combined_per_day",
+                        help="Root name of the per-day combined csv files")
+    parser.add_argument("-n", "--no-per-day", action="store_true",
+                        help="Do not write per-day files - the solvers can read the combined cube")
+    parser.add_argument("-z", "--compress", default="", choices=["", ".gz", ".bz2", ".xz"],
+                        help="Compress the per-day files.")
+    parser.add_argument("-r", "--results", default="results.csv", help="Probability results file to write")
+    parser.add_argument("-M", "--mismatches", default=None,
+                        help="Write every cell where forecast and in-situ do not match up to this file")
+    parser.add_argument("-V", "--variance_maps", default=None,
+                        help="Also write per cell and per hour variance maps under this root name, and "
+                             "combine with them")
+    buckets.sd_option(parser)
+    buckets.prob_option(parser)
+    parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    nl = getattr(logging, args.log.upper(), None)
+    if not isinstance(nl, int):
+        raise ValueError("Invalid log level: {}".format(args.log))
+    logging.basicConfig(level=nl,
+                        format='%(asctime)s : %(message)s')
+    if args.no_per_day:
+        args.per_day = None
+    meter = metrics.Metrics("pipeline", args.metrics_out)
+    fheader = windcube.header_any(args.model_file)
+    iheader = windcube.header_any(args.insitu)
+    assert fheader["models"] and not iheader["models"], "Expected a forecast file and an in-situ file"
+    header = model_errors.common_header(fheader, iheader)
+    report = model_errors.MismatchReport()
+    scheme = buckets.sd_scheme(args.sd_buckets)
+    sds, bsds = first_pass(args, header, report, meter, scheme)
+    report.log()
+    if args.mismatches is not None:
+        report.write(args.mismatches)
+    cacher = weighted_means.CacherOne(sds, bsds, args, scheme, args.variance_maps)
+    written = second_pass(args, cacher, header, meter)
+    written += [args.sdfile, args.sdbucketfile]
+    logging.warning("Wrote {} bytes over {} files".format(metrics.file_bytes(*written), len(written)))
+    meter.total()
+
+
+if __name__ == '__main__':
+    main()
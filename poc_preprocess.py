@@ -1,108 +1,166 @@
 #!/usr/bin/env python3
+#
+# Blend the 10 models of the forecast file into one value per location and hour with
+# a fixed weight per model.
+# With -W a file of candidate weightings, one per line, is swept instead : every
+# weighting is applied to each chunk of forecast cells with one matrix product over
+# the model axis and scored against the in-situ data in the same pass - the RMSE, and
+# the Brier score of the P(in-situ >= 15) per bucket of the blended value that
+# weighted_means.py would derive. The weightings are written ranked by score.
 
 WEIGHTSTR = "1.0,1.0,1.0,1.0,1.0,1.0,1.0,1.0,1.0,1.0"
-EMPTY10 = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
 FILENAME = "ForecastDataforTraining_201712.csv"
 OUTPUT = "processed_data_for_training.csv"
+INSITU = "In_situMeasurementforTraining_201712.csv"
+SWEEP_OUTPUT = "weight_sweep.csv"
+SWEEP_VALUES = 1 << 22  # blended values held at once - weightings x cells of a chunk
 NEWHEADER = "xid,yid,date_id,hour,wind\n"
+MODELHEADER = "xid,yid,date_id,hour,model,wind\n"
+KEYS = ("xid", "yid", "date_id", "hour")
+NMODELS = 10
 
 import argparse
-import sys
 
+import numpy as np
 
-class Cacher(object):
+import buckets
+import chunked_csv
+import metrics
+import model_errors
+import streams
+import windcube
+
+
+def scan_file_and_process(infile, outfile, weights, phase):
     """
-    We need to build up the model data over multiple lines.
-    This takes the xid, yid, date_id, hour and creates a key
-    used for caching. The key links to an array of values for
-    each model. 
-    If the key does not match the current active key, write out
-    the processed value for that (xid, yid, date_id, hour) and
-    start a new
+    Combine the 10 model rows of every location/hour into one weighted value.
+    :param phase: metrics phase counting the rows read
     """
+    wsum = sum(weights)
+    with streams.open_file(outfile, "w") as fout:
+        fout.write(NEWHEADER)
+        for cols in chunked_csv.read_groups(infile, MODELHEADER, KEYS, NMODELS):
+            phase.add(len(cols["wind"]))
+            model_data = chunked_csv.group_values(cols, NMODELS)
+            value = np.zeros(len(model_data))
+            for i in range(NMODELS):
+                value += model_data[:, i] * weights[i]
+            value /= wsum
+            fout.write(chunked_csv.format_rows(cols["xid"][::NMODELS],
+                                               cols["yid"][::NMODELS],
+                                               cols["date_id"][::NMODELS],
+                                               cols["hour"][::NMODELS],
+                                               value))
 
-    
-    def __init__(self, weights):
-        self.model_data = EMPTY10
-        self.key = None
-        self.added = 0
-        self.weights = weights
-        self.wsum = 0
-        for w in self.weights:
-            self.wsum += w
-
-    def calc(self):
-        value = 0
-        for i in range(len(self.model_data)):
-            value += self.model_data[i] * self.weights[i]
-        value /= self.wsum
-        return value
-
-    def add_line(self, line):
-        if line is None:  # special case - write what we have
-            assert self.key is not None
-            return "{0},{1},{2},{3},{4}\n".format(self.key[0],
-                                                  self.key[1],
-                                                  self.key[2],
-                                                  self.key[3],
-                                                  self.calc())
-        xid_r, yid_r, date_id_r, hour_r, model_r, wind_r = line.split(',')
-        xid, yid, date_id, hour, model, wind = int(xid_r), int(yid_r), int(date_id_r), int(hour_r), int(model_r), float(wind_r)
-        model -= 1  # models are 1 .. 10
-        newkey = (xid, yid, date_id, hour)
-        if self.key is None:  # first time 
-            self.added = 1
-            self.key = newkey
-            self.model_data = EMPTY10
-            self.model_data[model] = wind
-            return None
-        if newkey != self.key:  # only one key at a time
-            assert self.added == 10
-            self.added = 1
-            result = "{0},{1},{2},{3},{4}\n".format(self.key[0],
-                                                    self.key[1],
-                                                    self.key[2],
-                                                    self.key[3],
-                                                    self.calc())
-            self.key = newkey
-            self.model_data = EMPTY10
-            self.model_data[model] = wind
-            return result
-        # OK - we just record this model's data and return None
-        self.added += 1
-        self.model_data[model] = wind
-        return None 
-        
-
-
-
-def scan_file_and_process(infile, outfile, weights):
-    counter = 0
-    cache = Cacher(weights)
-    with open(infile, "r") as fin:
-        with open(outfile, "w") as fout:
-            line = fin.readline()
-            line = line[:-1]  # drop \n
-            # First line is a header - write new header and skip
-            assert line == "xid,yid,date_id,hour,model,wind", "line is : " + line
-            fout.write(NEWHEADER)
-            line = fin.readline()
-            while line != '':
-                try:
-                    if line[-1] == '\n':
-                        line = line[:-1]  # drop \n
-                except IndexError:
-                    print("Bad line is " + line)
-                    raise
-                if counter % 1000 == 0:
-                    print(counter)
-                counter += 1
-                result = cache.add_line(line)
-                if result != None:
-                    fout.write(result)
-                line = fin.readline()
-            # still has data for last line - write it
-            fout.write(cache.add_line(None))
+
+class SweepScores(object):
+    """
+    Squared errors and P(in-situ >= 15) bucket counts of every candidate weighting.
+    """
+
+    def __init__(self, weights, scheme=buckets.DEFAULT_PROB):
+        """
+        :param weights: list of weightings, each a weight per model
+        :param scheme: buckets.BucketScheme of the blended values
+        """
+        self.weights = np.array(weights)
+        self.scheme = scheme
+        self.count = 0
+        self.sum_err_2 = np.zeros(len(weights))
+        self.bucket_count = np.zeros((len(weights), len(scheme)), dtype=np.int64)
+        self.greater_15 = np.zeros_like(self.bucket_count)
+
+    def add(self, forecast, insitu):
+        """
+        :param forecast: model values of a chunk of cells (models, cells), NaN where a
+                         model is missing - the others are then weighted up
+        :param insitu: in-situ values of the same cells
+        """
+        present = ~np.isnan(forecast)
+        blended = self.weights.dot(np.where(present, forecast, 0.0)) / self.weights.dot(present)
+        err = blended - insitu
+        self.sum_err_2 += np.einsum("kn,kn->k", err, err)
+        self.count += len(insitu)
+        size = self.bucket_count.size
+        index = np.arange(len(self.weights)).reshape(-1, 1) * len(self.scheme) + self.scheme.assign(blended)
+        self.bucket_count += np.bincount(index.ravel(), minlength=size).reshape(self.bucket_count.shape)
+        self.greater_15 += np.bincount(index[:, insitu >= 15].ravel(), minlength=size).reshape(self.bucket_count.shape)
+
+    def rmse(self):
+        return np.sqrt(self.sum_err_2 / self.count)
+
+    def brier(self):
+        """
+        Brier score of predicting in-situ >= 15 by the probability of the bucket each
+        blended value falls in - lower means buckets that separate calm from storm better.
+        """
+        with np.errstate(invalid="ignore"):
+            probs = np.where(self.bucket_count > 0, self.greater_15 / self.bucket_count, 0.0)
+        return (self.bucket_count * probs * (1 - probs)).sum(axis=1) / self.count
+
+    def write(self, fn, rank_by="rmse"):
+        """
+        Write the weightings best first.
+        :param rank_by: "rmse" or "brier"
+        :return: the scores table rows, best first
+        """
+        rmse = self.rmse()
+        brier = self.brier()
+        order = np.lexsort((brier, rmse) if rank_by == "rmse" else (rmse, brier))
+        rows = []
+        with streams.open_file(fn, "w") as f:
+            f.write(",".join(["rank", "rmse", "brier"] + ["w{}".format(m + 1) for m in range(self.weights.shape[1])])
+                    + "\n")
+            for rank, k in enumerate(order.tolist()):
+                rows.append([rank + 1, rmse[k], brier[k]] + self.weights[k].tolist())
+                f.write(",".join("{}".format(v) for v in rows[-1]) + "\n")
+        return rows
+
+
+def sweep(forecast_fn, insitu_fn, weights, scheme, phase):
+    """
+    Score every weighting over the days of the forecast and in-situ data, a day and a
+    chunk of cells at a time. Cells without an in-situ value or any model are skipped.
+    :param weights: list of weightings, each a weight per model of the forecast
+    :return: SweepScores
+    """
+    header = model_errors.common_header(windcube.header_any(forecast_fn), windcube.header_any(insitu_fn))
+    assert len(weights[0]) == len(header["models"]), "Weightings need a weight for each of models {}".format(
+        header["models"])
+    scores = SweepScores(weights, scheme)
+    chunk = max(1, SWEEP_VALUES // len(weights))
+    for day in header["days"]:
+        forecast, fheader = windcube.open_any(forecast_fn, day, np.float64)
+        insitu, iheader = windcube.open_any(insitu_fn, day, np.float64)
+        fday = model_errors.day_slice(forecast, fheader, header, day).reshape(len(header["models"]), -1)
+        iday = model_errors.day_slice(insitu, iheader, header, day)[0].ravel()
+        keep = ~np.isnan(iday) & ~np.isnan(fday).all(axis=0)
+        fday = fday[:, keep]
+        iday = iday[keep]
+        for start in range(0, len(iday), chunk):
+            scores.add(fday[:, start:start + chunk], iday[start:start + chunk])
+        phase.add(len(iday))
+        del forecast, insitu
+    return scores
+
+
+def read_weight_file(fn):
+    """
+    :param fn: file of weightings, one comma separated line of weights per weighting.
+               Blank lines and lines starting with # are skipped.
+    :return: list of weightings
+    """
+    weights = []
+    with streams.open_file(fn, "r") as f:
+        for n, line in enumerate(f):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            ws = get_weights(line)
+            assert ws is not None, "Malformed weights on line {} of {}".format(n + 1, fn)
+            weights.append(ws)
+    assert weights, "No weightings in {}".format(fn)
+    return weights
 
 
 def get_weights(wstr):
@@ -121,12 +179,40 @@ def main():
     parser.add_argument("-i", "--input", default=FILENAME, help="file to process")
     parser.add_argument("-o", "--output", default=OUTPUT, help="filename for results")
     parser.add_argument("-w", "--weights", default=WEIGHTSTR, help="comma separated weights e.g. 1.0,0.9,0.2,0.4 ...")
+    parser.add_argument("-W", "--weight_file", default=None,
+                        help="sweep the weightings of this file, one per line, instead of combining with -w - "
+                             "each line, e.g. each group of an lsq_weights.py file, is scored over the whole grid")
+    parser.add_argument("-I", "--insitu", default=INSITU, help="in-situ data to score a sweep against")
+    parser.add_argument("-s", "--sweep_output", default=SWEEP_OUTPUT, help="ranked table of a sweep")
+    parser.add_argument("-R", "--rank_by", default="rmse", choices=["rmse", "brier"],
+                        help="score to rank a sweep by")
+    buckets.prob_option(parser)
+    metrics.add_argument(parser)
     args = parser.parse_args()
+    if args.weight_file is not None:
+        run_sweep(args)
+        return
     print("Input file is " + args.input)
     print("Output file is " + args.output)
     weights = get_weights(args.weights)
     assert weights is not None, "Malformed weights string"
-    scan_file_and_process(args.input, args.output, weights)
+    m = metrics.Metrics("poc_preprocess", args.metrics_out)
+    with m.phase("combine", nbytes=metrics.file_bytes(args.input)) as phase:
+        scan_file_and_process(args.input, args.output, weights, phase)
+    m.total()
+
+def run_sweep(args):
+    print("Sweeping weightings of " + args.weight_file)
+    weights = read_weight_file(args.weight_file)
+    m = metrics.Metrics("poc_preprocess", args.metrics_out)
+    with m.phase("sweep", unit="cells", nbytes=metrics.file_bytes(args.input, args.insitu)) as phase:
+        scores = sweep(args.input, args.insitu, weights, buckets.prob_scheme(args.prob_buckets), phase)
+    rows = scores.write(args.sweep_output, args.rank_by)
+    print("{} weightings over {} cells ranked in {}".format(len(rows), scores.count, args.sweep_output))
+    for row in rows[:5]:
+        print("  {} : rmse = {}, brier = {}, weights = {}".format(row[0], row[1], row[2], row[3:]))
+    m.total()
+
 
 if __name__ == '__main__':
     main()
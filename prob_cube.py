@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+#
+# The probability of a wind >= 15 at every [hour][x][y] of a day, as the solvers use
+# it, mapped from the day's winds with one table lookup and kept on disk as a
+# float32 cube next to the weather file :
+#    <weather root>_day<d>.probs.cube
+# The cube header records the sha1 of the day's weather data and of the probability
+# file, and the cube is only built again when one of them changes. Csv weather files
+# are keyed by the checksum their sidecar already holds, cubes by the data of the day.
+# The solvers work in log space, from the cost cube of the day instead :
+#    <weather root>_day<d>.costs.cube holding -log(1 - p)
+# so the confidence of a path, the product of the (1 - p) along it, becomes a sum of
+# costs that does not underflow. A p of 1 costs +inf - the cell cannot be entered.
+# Run on its own to build the cubes of some days ahead of the solvers.
+
+import argparse
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+import buckets
+import metrics
+import sidecar
+import streams
+import windcube
+
+PROBS_EXTENSION = ".probs.cube"
+COSTS_EXTENSION = ".costs.cube"
+DTYPE = np.float32
+
+
+def read_probfile(fn):
+    """
+    Read a probability file - the results file of weighted_means.py or a copy of it.
+    Comment lines are skipped, bar an edges line giving the bucket scheme.
+    :return: list of probabilities, one per bucket, buckets.BucketScheme
+    """
+    scheme = buckets.DEFAULT_PROB
+    with streams.open_file(fn, "r") as f:
+        line = f.readline()
+        # skip comments as weight file has a lot of extra stuff
+        while line != '' and line[0] == '#':
+            scheme = buckets.from_edges_line(line) or scheme
+            line = f.readline()
+        values = list(map(float, line[:-1].split(',')))
+    assert len(values) == len(scheme), "Unexpected number of probabilities!"
+    return values, scheme
+
+
+def weather_digest(fn, date_id):
+    """
+    sha1 of the weather data of a day - the checksum of a csv file from its sidecar,
+    or of the day's data in a cube.
+    """
+    if not windcube.is_cube(fn):
+        return sidecar.load_sidecar(fn)["sha1"]
+    cube, header = windcube.open_cube(fn)
+    return hashlib.sha1(np.ascontiguousarray(cube[:, windcube.day_index(header, date_id)]).tobytes()).hexdigest()
+
+
+def cache_name(weatherfile, date_id, costs=False):
+    """
+    Default probability or cost cube for a day of a weather file, compressed or not.
+    """
+    root, _ = os.path.splitext(streams.strip_codec(weatherfile))
+    return "{}_day{}{}".format(root, date_id, COSTS_EXTENSION if costs else PROBS_EXTENSION)
+
+
+def cost_table(values):
+    """
+    :param values: probabilities per bucket
+    :return: -log(1 - p) per bucket, +inf where p is 1
+    """
+    with np.errstate(divide="ignore"):
+        return -np.log1p(-np.array(values, dtype=np.float64))
+
+
+def build(weatherfile, date_id, probfile, costs=False):
+    """
+    Map every wind of the day to its probability, or its cost, with one gather from
+    the table.
+    :return: values (1, 1, hours, x, y), cube header
+    """
+    layers, xsize, ysize, minh, maxh = windcube.read_day_layers(weatherfile, date_id)
+    values, scheme = read_probfile(probfile)
+    assert max(values) <= 1.0, "Bad value"
+    table = cost_table(values) if costs else np.array(values)
+    data = table.astype(DTYPE)[scheme.assign(layers)]
+    header = windcube.make_header(xsize, ysize, minh, maxh, [int(date_id)], [], DTYPE)
+    return data.reshape(header["shape"]), header
+
+
+def day_probs(weatherfile, date_id, probfile, cache=None, costs=False):
+    """
+    Probabilities, or costs, of a day, from the cache cube if it is up to date.
+    :param cache: cube file to keep them in, default from cache_name - "" to not cache
+    :param costs: give -log(1 - p) rather than p
+    :return: values [hour][x][y] as a float32 array, xsize, ysize, min hour, max hour
+    """
+    date_id = int(date_id)
+    kind = "costs" if costs else "probs"
+    if cache == "":
+        data, header = build(weatherfile, date_id, probfile, costs)
+    else:
+        if cache is None:
+            cache = cache_name(weatherfile, date_id, costs)
+        digests = {"values": kind,
+                   "weather_sha1": weather_digest(weatherfile, date_id),
+                   "prob_sha1": sidecar.file_checksum(probfile)}
+        header = windcube.read_header(cache)[0] if windcube.is_cube(cache) else {}
+        if all(header.get(k) == v for k, v in digests.items()):
+            logging.warning("Reading {} from {} ...".format(kind, cache))
+            data, header = windcube.open_cube(cache)
+        else:
+            logging.warning("Building {} into {} ...".format(kind, cache))
+            data, header = build(weatherfile, date_id, probfile, costs)
+            header.update(digests)
+            windcube.write_cube(cache, data, header)
+    return np.asarray(data[0, 0]), header["xsize"], header["ysize"], header["min_hour"], header["max_hour"]
+
+
+def day_costs(weatherfile, date_id, probfile, cache=None):
+    """
+    The -log(1 - p) cost of every [hour][x][y] of a day, as the solvers use it.
+    """
+    return day_probs(weatherfile, date_id, probfile, cache, costs=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--weatherfile", default="combined.cube",
+                        help="Weather prediction data in csv or cube format")
+    parser.add_argument("-p", "--probfile", default="ProbData.csv", help="Mapping of wind to prob >= 15")
+    parser.add_argument("-d", "--days", default="1", help="Comma separated days to build")
+    parser.add_argument("-C", "--costs", action="store_true", help="Build the cost cubes the solvers read")
+    parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    nl = getattr(logging, args.log.upper(), None)
+    if not isinstance(nl, int):
+        raise ValueError("Invalid log level: {}".format(args.log))
+    logging.basicConfig(level=nl,
+                        format='%(asctime)s : %(message)s')
+    meter = metrics.Metrics("prob_cube", args.metrics_out)
+    with meter.phase("build", unit="days") as phase:
+        for day in args.days.split(","):
+            day_probs(args.weatherfile, int(day), args.probfile, costs=args.costs)
+            phase.add()
+    meter.total()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+#
+# Ingest step that records the metadata of a csv weather file in a sidecar next to it,
+# so readers can size their structures without a separate scanning pass.
+#
+#   <file>.meta.json : dims, hour range, date ids, model ids, row count, size/mtime and checksum
+#   <file>.runs.npy  : byte ranges of the contiguous (date_id, hour) runs of rows
+#
+# A sidecar is stale when the size or mtime of the csv no longer match - it is then
+# rebuilt by a full scan. Compressed files get no runs as they cannot be seeked into.
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import chunked_csv
+import metrics
+import streams
+
+VERSION = 2
+META_SUFFIX = ".meta.json"
+RUNS_SUFFIX = ".runs.npy"
+WEATHERHEADER = "xid,yid,date_id,hour,wind\n"
+MODELHEADER = "xid,yid,date_id,hour,model,wind\n"
+ERRORHEADER = "xid,yid,date_id,hour,model,wind,error\n"
+KNOWNHEADERS = (WEATHERHEADER, MODELHEADER, ERRORHEADER)
+# Hour runs are only useful for files sorted by day and hour. A file sorted by location
+# has a run every few rows, so past this many the runs are merged down to days.
+MAX_RUNS = 2000000
+HASH_BLOCK = 16 * 1024 * 1024
+RANGES_PER_WORKER = 4  # more ranges than workers evens out the load
+
+RUN_DTYPE = np.dtype([("date_id", np.int32),
+                      ("hour", np.int32),
+                      ("start", np.int64),
+                      ("end", np.int64),
+                      ("rows", np.int64)])
+
+
+def meta_name(fn):
+    return fn + META_SUFFIX
+
+
+def runs_name(fn):
+    return fn + RUNS_SUFFIX
+
+
+def file_stamp(fn):
+    st = os.stat(fn)
+    return st.st_size, st.st_mtime_ns
+
+
+def segment_digest(job):
+    """
+    Worker : sha1 of one HASH_BLOCK segment of a file.
+    """
+    fn, offset = job
+    with open(fn, "rb") as f:
+        f.seek(offset)
+        return hashlib.sha1(f.read(HASH_BLOCK)).digest()
+
+
+def file_checksum(fn, workers=1):
+    """
+    sha1 over the sha1 of each HASH_BLOCK segment of the file, so the segments
+    can be hashed in parallel and give the same answer whatever the worker count.
+    """
+    jobs = [(fn, offset) for offset in range(0, os.path.getsize(fn), HASH_BLOCK)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            digests = list(pool.map(segment_digest, jobs))
+    else:
+        digests = [segment_digest(job) for job in jobs]
+    return hashlib.sha1(b"".join(digests)).hexdigest()
+
+
+def collapse_runs(runs):
+    """
+    Merge neighbouring runs with the same day and hour.
+    :param runs: structured array of runs in file order (see RUN_DTYPE)
+    """
+    if len(runs) < 2:
+        return runs
+    same = (runs["date_id"][1:] == runs["date_id"][:-1]) & (runs["hour"][1:] == runs["hour"][:-1])
+    first = np.flatnonzero(np.concatenate(([True], ~same)))
+    last = np.concatenate((first[1:] - 1, [len(runs) - 1]))
+    merged = runs[first].copy()
+    merged["end"] = runs["end"][last]
+    merged["rows"] = np.add.reduceat(runs["rows"], first)
+    return merged
+
+
+def block_runs(block, offset, dids, hours):
+    """
+    Runs of rows with the same (date_id, hour) within one block.
+    :param block: the raw bytes of the rows
+    :param offset: file offset of the block
+    """
+    ends = offset + np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n")) + 1
+    starts = np.concatenate(([offset], ends[:-1]))
+    change = np.flatnonzero((dids[1:] != dids[:-1]) | (hours[1:] != hours[:-1])) + 1
+    first = np.concatenate(([0], change))
+    last = np.concatenate((change, [len(dids)])) - 1
+    runs = np.empty(len(first), dtype=RUN_DTYPE)
+    runs["date_id"] = dids[first]
+    runs["hour"] = hours[first]
+    runs["start"] = starts[first]
+    runs["end"] = ends[last]
+    runs["rows"] = last - first + 1
+    return runs
+
+
+def limit_runs(runs, run_key):
+    """
+    Apply MAX_RUNS - hour runs are merged down to day runs, then dropped.
+    :return: runs, run_key
+    """
+    if len(runs) > MAX_RUNS and run_key == "hour":
+        logging.warning("  too many hour runs - file is not sorted by hour, indexing days only")
+        run_key = "day"
+        runs["hour"] = -1
+        runs = collapse_runs(runs)
+    if len(runs) > MAX_RUNS:
+        logging.warning("  too many day runs - file is not sorted by day, no run index kept")
+        run_key = None
+        runs = np.empty(0, dtype=RUN_DTYPE)
+    return runs, run_key
+
+
+def scan_range(job):
+    """
+    Worker : scan one byte range of a csv file.
+    :param job: file name, column names, start and end offsets - end is None to read to the end
+    :return: dict of the partial results
+    """
+    fn, names, start, end = job
+    part = {"rows": 0, "xsize": 0, "ysize": 0, "min_hour": 24, "max_hour": 0, "days": set(), "models": set()}
+    runs = np.empty(0, dtype=RUN_DTYPE)
+    run_key = None if streams.is_compressed(fn) else "hour"  # no seeking in compressed files
+    offset = start
+    with streams.open_file(fn, "rb") as f:
+        streams.seek_forward(f, start)
+        for block in chunked_csv.read_blocks(f, limit=None if end is None else end - start):
+            cols = chunked_csv.to_columns(chunked_csv.parse_block(block, len(names)), names)
+            part["rows"] += len(cols["xid"])
+            part["xsize"] = max(part["xsize"], int(cols["xid"].max()))
+            part["ysize"] = max(part["ysize"], int(cols["yid"].max()))
+            part["max_hour"] = max(part["max_hour"], int(cols["hour"].max()))
+            part["min_hour"] = min(part["min_hour"], int(cols["hour"].min()))
+            part["days"].update(np.unique(cols["date_id"]).tolist())
+            if "model" in cols:
+                part["models"].update(np.unique(cols["model"]).tolist())
+            if run_key is not None:
+                hours = cols["hour"] if run_key == "hour" else np.full(len(cols["hour"]), -1, dtype=np.int32)
+                runs = np.concatenate((runs[:-1], collapse_runs(np.concatenate(
+                    (runs[-1:], block_runs(block, offset, cols["date_id"], hours))))))
+                runs, run_key = limit_runs(runs, run_key)
+            offset += len(block)
+    part["runs"] = runs
+    part["run_key"] = run_key
+    return part
+
+
+def merge_parts(parts):
+    """
+    Combine the results of scan_range over consecutive byte ranges.
+    :return: merged dict of results
+    """
+    merged = {"rows": sum(p["rows"] for p in parts),
+              "xsize": max(p["xsize"] for p in parts),
+              "ysize": max(p["ysize"] for p in parts),
+              "min_hour": min(p["min_hour"] for p in parts),
+              "max_hour": max(p["max_hour"] for p in parts),
+              "days": set().union(*[p["days"] for p in parts]),
+              "models": set().union(*[p["models"] for p in parts])}
+    keys = [p["run_key"] for p in parts]
+    if None in keys:
+        merged["runs"], merged["run_key"] = np.empty(0, dtype=RUN_DTYPE), None
+        return merged
+    runs = np.concatenate([p["runs"] for p in parts])
+    run_key = "hour"
+    if "day" in keys:
+        run_key = "day"
+        runs["hour"] = -1
+    merged["runs"], merged["run_key"] = limit_runs(collapse_runs(runs), run_key)
+    return merged
+
+
+def scan_csv(fn, workers=1):
+    """
+    Pass over a csv weather file collecting everything the sidecar records.
+    :param workers: processes to scan with - each takes a share of the byte ranges
+    :return: meta dict, structured array of runs
+    """
+    logging.warning("Scanning {} for size information ...".format(fn))
+    with streams.open_file(fn, "rb") as f:
+        header = f.readline().decode("ascii")
+    assert header in KNOWNHEADERS, "Malformed file - header is : " + header
+    names = chunked_csv.header_names(header)
+    data_offset = len(header)
+    if workers > 1 and not streams.is_compressed(fn):
+        ranges = chunked_csv.byte_ranges(fn, data_offset, workers * RANGES_PER_WORKER)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(scan_range, [(fn, names, start, end) for start, end in ranges]))
+    else:
+        parts = [scan_range((fn, names, data_offset, None))]
+    merged = merge_parts(parts)
+    size, mtime_ns = file_stamp(fn)
+    meta = {"version": VERSION,
+            "source": os.path.basename(fn),
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "sha1": file_checksum(fn, workers),
+            "header": header[:-1],
+            "has_model": "model" in names,
+            "data_offset": data_offset,
+            "rows": merged["rows"],
+            "xsize": merged["xsize"],
+            "ysize": merged["ysize"],
+            "min_hour": merged["min_hour"],
+            "max_hour": merged["max_hour"],
+            "days": sorted(merged["days"]),
+            "models": sorted(merged["models"]),
+            "run_key": merged["run_key"]}
+    return meta, merged["runs"]
+
+
+def write_sidecar(fn, meta, runs):
+    np.save(runs_name(fn), runs)
+    with open(meta_name(fn), "w") as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+
+
+def build_sidecar(fn, workers=1):
+    """
+    Scan fn and write its sidecar files.
+    :return: meta dict
+    """
+    meta, runs = scan_csv(fn, workers)
+    write_sidecar(fn, meta, runs)
+    logging.warning("  wrote {}".format(meta_name(fn)))
+    return meta
+
+
+def is_stale(fn, meta, verify=False, workers=1):
+    """
+    :param verify: also recompute the checksum rather than trusting size and mtime
+    """
+    if meta.get("version") != VERSION:
+        return True
+    if (meta["size"], meta["mtime_ns"]) != file_stamp(fn):
+        return True
+    if verify and meta["sha1"] != file_checksum(fn, workers):
+        return True
+    return False
+
+
+def load_sidecar(fn, verify=False, workers=1):
+    """
+    Get the metadata of fn from its sidecar, rebuilding the sidecar by a scan if it is
+    missing or stale.
+    :param fn: csv file name
+    :param verify: check the checksum as well as size and mtime
+    :param workers: processes to use if a scan is needed
+    :return: meta dict
+    """
+    try:
+        with open(meta_name(fn), "r") as f:
+            meta = json.load(f)
+        if not is_stale(fn, meta, verify, workers):
+            return meta
+        logging.warning("Sidecar for {} is stale".format(fn))
+    except (IOError, ValueError):
+        logging.warning("No usable sidecar for {}".format(fn))
+    return build_sidecar(fn, workers)
+
+
+def load_runs(fn, verify=False):
+    """
+    :return: meta dict, structured array of runs (see RUN_DTYPE)
+    """
+    meta = load_sidecar(fn, verify)
+    return meta, np.load(runs_name(fn))
+
+
+def merge_touching(starts, ends):
+    """
+    :return: list of (start, end) with ranges that touch merged into one
+    """
+    if len(starts) == 0:
+        return []
+    brk = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+    first = np.concatenate(([0], brk))
+    last = np.concatenate((brk, [len(starts)])) - 1
+    return list(zip(starts[first].tolist(), ends[last].tolist()))
+
+
+def day_ranges(fn, date_id, hour=None):
+    """
+    Byte ranges holding the rows of one day, or of one hour of a day.
+    :param date_id: a day, or a list of days
+    :return: list of (start, end) in file order, or None if the run index cannot answer
+    """
+    meta, runs = load_runs(fn)
+    if meta["run_key"] is None or (hour is not None and meta["run_key"] != "hour"):
+        return None
+    selected = np.isin(runs["date_id"], np.atleast_1d(date_id).astype(np.int64))
+    if hour is not None:
+        selected &= runs["hour"] == int(hour)
+    runs = runs[selected]
+    return merge_touching(runs["start"], runs["end"])
+
+
+def split_days(fn, output_for_day, expected=None):
+    """
+    Copy the rows of each day of fn to the file given by output_for_day, using the run
+    index and large buffered copies rather than parsing the rows.
+    :param output_for_day: function of date_id returning a file open for binary writing
+    :param expected: header line the file must have, including the newline
+    :return: False if the file has no run index to split with
+    """
+    meta, runs = load_runs(fn)
+    if expected is not None:
+        assert meta["header"] + "\n" == expected, "Malformed file - header is : " + meta["header"]
+    if meta["run_key"] is None:
+        return False
+    if len(runs) == 0:
+        return True
+    # hour runs of the same day that touch are copied as one
+    starts, ends, dids = runs["start"], runs["end"], runs["date_id"]
+    brk = np.flatnonzero((starts[1:] != ends[:-1]) | (dids[1:] != dids[:-1])) + 1
+    first = np.concatenate(([0], brk)).astype(np.int64)
+    last = np.concatenate((brk, [len(runs)])).astype(np.int64) - 1
+    outputs = [output_for_day(d) for d in dids[first].tolist()]
+    ranges = list(zip(starts[first].tolist(), ends[last].tolist()))
+    with open(fn, "rb") as f:
+        for i, data in chunked_csv.read_range_slices(f, ranges):
+            outputs[i].write(data)
+    return True
+
+
+def get_dimensions(fn):
+    """
+    Drop-in for the old scan_file_for_dimensions helpers.
+    :return: max x, max y, min hour, max hour
+    """
+    meta = load_sidecar(fn)
+    return meta["xsize"], meta["ysize"], meta["min_hour"], meta["max_hour"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="csv weather files to ingest")
+    parser.add_argument("-f", "--force", action="store_true", help="rebuild even if the sidecar is current")
+    parser.add_argument("-v", "--verify", action="store_true", help="check the checksum of existing sidecars")
+    parser.add_argument("-j", "--workers", default=1, type=int, help="processes to scan with")
+    parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    nl = getattr(logging, args.log.upper(), None)
+    if not isinstance(nl, int):
+        raise ValueError("Invalid log level: {}".format(args.log))
+    logging.basicConfig(level=nl,
+                        format='%(asctime)s : %(message)s')
+    meter = metrics.Metrics("sidecar", args.metrics_out)
+    for fn in args.files:
+        with meter.phase("scan", nbytes=metrics.file_bytes(fn)) as phase:
+            if args.force:
+                meta = build_sidecar(fn, args.workers)
+            else:
+                meta = load_sidecar(fn, args.verify, args.workers)
+            phase.add(meta["rows"])
+        logging.warning("{} : {} rows, x = {}, y = {}, hours {}..{}, days = {}, runs by {}".format(
+            fn, meta["rows"], meta["xsize"], meta["ysize"], meta["min_hour"], meta["max_hour"], meta["days"],
+            meta["run_key"]))
+    meter.total()
+
+
+if __name__ == '__main__':
+    main()
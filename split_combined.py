@@ -7,28 +7,54 @@
 import argparse
 import logging
 
+import numpy as np
+
+import chunked_csv
+import metrics
+import sidecar
+import streams
+
 EXPECTEDHDR = "xid,yid,date_id,hour,wind\n"
+DATE_COLUMN = 2
+COPY_BUFFER = 16 * 1024 * 1024
 
 
-def do_split(args):
+def do_split(args, phase):
+    """
+    :param phase: metrics phase counting the rows split
+    """
     output_files = {}
-    with open(args.input, "r") as inp:
+
+    def output_for_day(date_id):
+        try:
+            return output_files[date_id]
+        except KeyError:
+            out = streams.open_file("{}_{}.csv{}".format(args.output, date_id, args.compress), "wb",
+                                    buffering=COPY_BUFFER)
+            output_files[date_id] = out
+            out.write(EXPECTEDHDR.encode("ascii"))
+            return out
+
+    # copy whole runs of each day if the sidecar has indexed them
+    try:
+        if sidecar.split_days(args.input, output_for_day, EXPECTEDHDR):
+            phase.add(sidecar.load_sidecar(args.input)["rows"])
+            return
+    finally:
+        for k in output_files.keys():
+            output_files[k].close()
+    ncols = len(chunked_csv.header_names(EXPECTEDHDR))
+    with streams.open_file(args.input, "rb") as inp:
         # do header things
-        inline = inp.readline()
-        assert inline == EXPECTEDHDR, "Input file does not have expected header"
-        inline = inp.readline()
-        # OK - now do the splits. Ouch.
+        chunked_csv.read_header(inp, EXPECTEDHDR)
+        # OK - now do the splits, a block at a time.
         try:
-            while inline != '':
-                xid, yid, date_id, hour, wind = inline[:-1].split(',')
-                try:
-                    out = output_files[date_id]
-                except KeyError:
-                    out = open("{}_{}.csv".format(args.output, date_id), "w")
-                    output_files[date_id] = out
-                    out.write(EXPECTEDHDR)
-                out.write(inline)
-                inline = inp.readline()
+            for block in chunked_csv.read_blocks(inp):
+                dates = chunked_csv.parse_block(block, ncols)[:, DATE_COLUMN].astype(np.int64)
+                phase.add(len(dates))
+                lines = np.array(block.splitlines(True), dtype=object)
+                for date_id in np.unique(dates).tolist():
+                    output_for_day(date_id).write(b"".join(lines[dates == date_id]))
         except IOError as e:
             logging.critical("IO Error : {}".format(e))
         finally:
@@ -40,14 +66,20 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", default="combined.csv", help="Input file to split")
     parser.add_argument("-o", "--output", default="combined_per_day", help="Root name of output file.")
+    parser.add_argument("-z", "--compress", default="", choices=["", ".gz", ".bz2", ".xz"],
+                        help="Compress the per-day files.")
     parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
     args = parser.parse_args()
     nl = getattr(logging, args.log.upper(), None)
     if not isinstance(nl, int):
         raise ValueError("Invalid log level: {}".format(args.log))
     logging.basicConfig(level=nl,
                         format='%(message)s')
-    do_split(args)
+    meter = metrics.Metrics("split_combined", args.metrics_out)
+    with meter.phase("split", nbytes=metrics.file_bytes(args.input)) as phase:
+        do_split(args, phase)
+    meter.total()
 
 
 
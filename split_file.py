@@ -5,48 +5,86 @@ Splits the input file into per-day sets
 
 import argparse
 
+import numpy as np
+
+import chunked_csv
+import metrics
+import sidecar
+import streams
+import windcube
+
 FILENAME = "ForecastDataforTraining_201712.csv"
 OUTPUT = "processed_data_for_training"
 NEWHEADER = "xid,yid,date_id,hour,model,wind\n"
-message_count = 10000  # every message_count iterations, output a message
+DATE_COLUMN = 2
+COPY_BUFFER = 16 * 1024 * 1024
 
 day_files = {}
 
+
+def split(args, phase):
+    """
+    Write the rows of each day to their own file.
+    :param phase: metrics phase counting the rows split
+    """
+    def output_for_day(date_id):
+        if date_id not in day_files:
+            outfilename = "{0}.{1}.csv{2}".format(args.output, date_id, args.compress)
+            fout = streams.open_file(outfilename, "wb", buffering=COPY_BUFFER)
+            print("Opened {} for writing".format(outfilename))
+            day_files[date_id] = fout
+            fout.write(NEWHEADER.encode("ascii"))
+        return day_files[date_id]
+
+    # copy whole runs of each day if the sidecar has indexed them
+    try:
+        if sidecar.split_days(args.input, output_for_day, NEWHEADER):
+            phase.add(sidecar.load_sidecar(args.input)["rows"])
+            return
+    finally:
+        for tf in day_files.keys():
+            day_files[tf].close()
+    day_files.clear()
+    ncols = len(chunked_csv.header_names(NEWHEADER))
+    with streams.open_file(args.input, "rb") as fin:
+        chunked_csv.read_header(fin, NEWHEADER)
+        try:
+            for block in chunked_csv.read_blocks(fin):
+                dates = chunked_csv.parse_block(block, ncols)[:, DATE_COLUMN].astype(np.int64)
+                phase.add(len(dates))
+                lines = np.array(block.splitlines(True), dtype=object)
+                for date_id in np.unique(dates).tolist():
+                    output_for_day(date_id).write(b"".join(lines[dates == date_id]))
+        finally:
+            for tf in day_files.keys():
+                day_files[tf].close()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", default=FILENAME, help="file to process")
     parser.add_argument("-o", "--output", default=OUTPUT, help="filename for results")
+    parser.add_argument("-z", "--compress", default="", choices=["", ".gz", ".bz2", ".xz"],
+                        help="compress the per-day files")
+    parser.add_argument("-c", "--cube", default=None,
+                        help="ingest into this cube file instead - days are then slices of the cube")
+    parser.add_argument("-j", "--workers", default=1, type=int, help="processes used to ingest into the cube")
+    metrics.add_argument(parser)
     args = parser.parse_args()
+    meter = metrics.Metrics("split_file", args.metrics_out)
     print("Input file is " + args.input)
+    if args.cube is not None:
+        print("Cube file is " + args.cube)
+        with meter.phase("ingest", nbytes=metrics.file_bytes(args.input)) as phase:
+            windcube.csv_to_cube(args.input, args.cube, args.workers)
+            phase.add(sidecar.load_sidecar(args.input)["rows"])
+        meter.total()
+        return
     print("Output file is " + args.output)
-    counter = 0
-    with open(args.input, "r") as fin:
-        line = fin.readline()  # should be the header line
-        assert line == "xid,yid,date_id,hour,model,wind\n", "line is : " + line
-        line = fin.readline()
-        while line != '':
-            if counter % message_count == 0:
-                print(counter)
-            counter += 1
-            xid_r, yid_r, date_id_r, hour_r, model_r, wind_r = line.split(',')
-            try:
-                _ = day_files[date_id_r]
-            except KeyError:
-                outfilename = "{0}.{1}.csv".format(args.output, date_id_r)
-                fout = open(outfilename, "w")
-                print("Opened {} for writing".format(outfilename))
-                day_files[date_id_r] = fout
-                try:
-                    day_files[date_id_r].write(NEWHEADER)
-                except IOError:
-                    day_files[date_id_r].close()
-            try:
-                day_files[date_id_r].write(line)
-                line = fin.readline()
-            except IOError:
-                for tf in day_files.keys():
-                    day_files[tf].close()
-                raise
+    with meter.phase("split", nbytes=metrics.file_bytes(args.input)) as phase:
+        split(args, phase)
+    meter.total()
+
 
 if __name__ == '__main__':
     main()
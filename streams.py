@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# Opens csv inputs and outputs that may be compressed, picked by extension :
+#    .gz  - gzip
+#    .bz2 - bzip2
+#    .xz  - lzma
+# Compressed inputs are decompressed by a background thread into a small queue of
+# blocks, so decompression (which releases the GIL in zlib/bz2/lzma) overlaps with
+# parsing - on machines with more than one CPU. Compressed streams cannot seek, so
+# byte range tricks (parallel ingest, per-day seeks, run based splits) are only used
+# on plain files.
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+
+CODECS = {".gz": gzip, ".bz2": bz2, ".xz": lzma}
+BLOCK_BYTES = 4 * 1024 * 1024
+QUEUE_BLOCKS = 4  # decompressed blocks held ahead of the reader
+
+
+def codec_for(fn):
+    """
+    :return: the compression module for fn, or None for a plain file
+    """
+    return CODECS.get(os.path.splitext(fn)[1].lower())
+
+
+def is_compressed(fn):
+    return codec_for(fn) is not None
+
+
+def strip_codec(fn):
+    """
+    Drop a compression extension - "x.csv.gz" gives "x.csv".
+    """
+    if is_compressed(fn):
+        return os.path.splitext(fn)[0]
+    return fn
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Raw stream handing out blocks decompressed by a background thread.
+    """
+
+    def __init__(self, fn, codec, block_bytes=BLOCK_BYTES, queue_blocks=QUEUE_BLOCKS):
+        super(ThreadedReader, self).__init__()
+        self.source = codec.open(fn, "rb")
+        self.block_bytes = block_bytes
+        self.blocks = queue.Queue(maxsize=queue_blocks)
+        self.stopping = threading.Event()
+        self.pending = memoryview(b"")
+        self.done = False
+        self.thread = threading.Thread(target=self.decompress, name="decompress " + fn)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def decompress(self):
+        try:
+            while not self.stopping.is_set():
+                data = self.source.read(self.block_bytes)
+                self.put(data)
+                if not data:
+                    return
+        except Exception as e:  # handed to the reader rather than lost in the thread
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopping.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.pending:
+            if self.done:
+                return 0
+            item = self.blocks.get()
+            if isinstance(item, Exception):
+                self.done = True
+                raise item
+            if not item:
+                self.done = True
+                return 0
+            self.pending = memoryview(item)
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopping.set()
+            self.thread.join()
+            self.source.close()
+        super(ThreadedReader, self).close()
+
+
+def open_file(fn, mode="r", threaded=None, buffering=-1):
+    """
+    Drop-in for open() that handles compressed files by extension.
+    :param fn: file name - .gz, .bz2 and .xz are compressed, anything else is plain
+    :param mode: "r", "rb", "w", "wb", "a" or "ab"
+    :param threaded: decompress compressed inputs in a background thread - by default
+                     only if there is a second CPU for the thread to run on
+    :param buffering: as for open() - plain files only
+    :return: file object - text or binary as mode asks
+    """
+    codec = codec_for(fn)
+    if codec is None:
+        return open(fn, mode, buffering)
+    binary = "b" in mode
+    if threaded is None:
+        threaded = (os.cpu_count() or 1) > 1
+    if mode[0] != "r" or not threaded:
+        return codec.open(fn, mode if binary else mode[0] + "t")
+    f = io.BufferedReader(ThreadedReader(fn, codec), BLOCK_BYTES)
+    if binary:
+        return f
+    return io.TextIOWrapper(f, encoding="ascii")
+
+
+def seek_forward(f, pos):
+    """
+    Move a freshly opened stream to pos, reading and discarding if it cannot seek.
+    """
+    if f.seekable():
+        f.seek(pos)
+        return
+    while pos > 0:
+        data = f.read(min(pos, BLOCK_BYTES))
+        if not data:
+            return
+        pos -= len(data)
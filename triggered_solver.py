@@ -2,14 +2,19 @@
 #
 
 import argparse
+import io
 import logging
-import os
-import pdb
-import tqdm
+import math
+
+import corridor
+import metrics
+import prob_cube
+import streams
 
 
 WEATHERHEADER = "xid,yid,date_id,hour,wind\n"
 MESSAGE_COUNT = 400000
+INF = float("inf")
 
 
 class Cell(object):
@@ -24,27 +29,27 @@ class Cell(object):
     OUT_VAL = 0
     OUT_TIM = 1
 
-    def __init__(self, x, y, layers, wthing):
+    def __init__(self, x, y, costs):
         self.x = x
         self.y = y
-        self.layers = layers
-        self.wthing = wthing
+        self.costs = costs  # [hour][x][y] -log(1 - probability of a wind >= 15)
         self.input_value_list = []        # value, when, who
         self.output_value_list = []        # value, when
+        # values are costs, -log of the confidence - lower is better
 
     def force_input_value(self):
-        self.calc_value(0, 1)
-        self.input_value_list.append((0, 0, None))
+        self.calc_value(0, 0)
+        self.input_value_list.append((INF, 0, None))
 
     def force_output_value(self):
-        self.output_value_list.append((1, 0))
+        self.output_value_list.append((0, 0))
 
     def calc_value(self, now, iv=None):
         if iv is None:
             ival = self.input_value_list[-1][Cell.INP_VAL]
         else:
             ival = iv
-        oval = ival * (1 - self.wthing.get_prob(self.layers[int(now / TriggerSolver.STEPS_PER_HOUR)][self.x][self.y]))
+        oval = ival + self.costs[int(now / TriggerSolver.STEPS_PER_HOUR)][self.x][self.y]
         return oval
 
     def poked(self, culprit, now):
@@ -58,8 +63,8 @@ class Cell(object):
         try:
             ival = self.input_value_list[-1][Cell.INP_VAL]
         except IndexError:
-            ival = 0
-        if culprit.output_value_list[-1][0] > ival:
+            ival = INF
+        if culprit.output_value_list[-1][0] < ival:
             self.input_value_list.append((culprit.output_value_list[-1][Cell.OUT_VAL], now, culprit))
             self.output_value_list.append((self.calc_value(now, iv=culprit.output_value_list[-1][Cell.OUT_VAL]), now))
             return True
@@ -75,11 +80,13 @@ class TriggerSolver(object):
     MIN_STEPS = MIN_HOUR * STEPS_PER_HOUR
     MAX_STEPS = MAX_HOUR * STEPS_PER_HOUR
     TOTAL_STEPS = (MAX_HOUR - MIN_HOUR) * STEPS_PER_HOUR
+    # (x, y) of the grid the solver covers, on the whole grid - set by solve
+    origin = (0, 0)
 
-    def __init__(self, xsize, ysize, layers, wthing):
+    def __init__(self, xsize, ysize, costs):
         self.xsize = xsize
         self.ysize = ysize
-        self.store = [[Cell(x, y, layers, wthing) for y in range(ysize)] for x in range(xsize)]
+        self.store = [[Cell(x, y, costs) for y in range(ysize)] for x in range(xsize)]
         self.active = []
         self.next = []
 
@@ -136,114 +143,54 @@ class TriggerSolver(object):
             self.trace_back(prev.x, prev.y, w - 1, cid, did, fout)
             line = ("{},{},{}:{},{},{}".format(cid, did,
                                                int(w / TriggerSolver.STEPS_PER_HOUR) + TriggerSolver.MIN_HOUR,
-                                               2 * (w % TriggerSolver.STEPS_PER_HOUR), x + 1, y + 1))
+                                               2 * (w % TriggerSolver.STEPS_PER_HOUR),
+                                               x + self.origin[0] + 1, y + self.origin[1] + 1))
             # print(line)
             fout.write(line + "\n")
 
     def find_best_path(self, cid, cities, dayid, fout):
-        when = None
+        """
+        Write the best path to a city - nothing if it is never reached.
+        :return: cost of the path, INF if the city is never reached
+        """
         cityx, cityy = cities[cid][0], cities[cid][1]
-        try:
-            when = self.store[cityx][cityy].input_value_list[-1][1]
-        except IndexError:
-            pdb.set_trace()
+        cost = self.best_cost(cityx, cityy)
+        if cost == INF:
+            logging.warning("City {} is unreachable - no path written".format(cid))
+            return cost
+        when = self.store[cityx][cityy].input_value_list[-1][Cell.INP_TIM]
+        logging.info("City {} reached with confidence {}".format(cid, to_confidence(cost)))
         self.trace_back(cityx, cityy, when, cid, dayid, fout)
+        return cost
 
+    def city_cost(self, cid, cities):
+        """
+        :return: the cost of the best path to a city
+        """
+        return self.best_cost(cities[cid][0], cities[cid][1])
 
-class Weighter(object):
-    """
-    This reads probabilities from a file, then
-    uses this to map winds to probs
-    The data is a single line of probabilities for buckets of 0.5 each
-    """
-
-    Nprobs = 60
-    BucketWidth = 0.5
-    MAX = 1.0
-
-    def __init__(self, args):
-        self.values = None
-        logging.warning("Reading probabilites ...")
-        with open(args.probfile, "r") as f:
-            line = f.readline()
-            # skip comments as weight file has a lot of extra stuff
-            while line != '' and line[0] == '#':
-                line = f.readline()
-            self.values = list(map(float, line[:-1].split(',')))
-        assert len(list(self.values)) == Weighter.Nprobs, "Unexpected number of probabilities!"
-        for v in self.values:
-            assert v <= Weighter.MAX, "Bad value"
-        logging.warning("  done.")
-
-    def get_prob(self, wind):
-        index = int(wind / Weighter.BucketWidth)
-        if index >= Weighter.Nprobs:
-            index = Weighter.Nprobs - 1
-        return self.values[index]
-
-
-def scan_file_for_dimensions(fn):
-    mx = 0
-    my = 0
-    maxh = 0
-    minh = 24  # hour cannot be beyond end of day
-    count = 0
-    logging.warning("Scanning input file for size information ...")
-    filesize = os.path.getsize(fn)
-    pbar = tqdm.tqdm(total=filesize)
-    with open(fn, "r") as f:
-        line = f.readline()
-        assert line == WEATHERHEADER, "Malformed file - header does not match expectations"
-        pbar.update(len(line))
-        line = f.readline()
-        pbar.update(len(line))
-        while line != '':
-            # note dropping of final \n
-            xid_r, yid_r, date_r, hour_r, wind_r = line[:-1].split(',')
-            xid, yid, hid = int(xid_r), int(yid_r), int(hour_r)
-            if xid > mx:
-                mx = xid
-            if yid > my:
-                my = yid
-            if hid > maxh:
-                maxh = hid
-            if hid < minh:
-                minh = hid
-            line = f.readline()
-            pbar.update(len(line))
-        pbar.close()
-        return mx, my, minh, maxh, count
+    def best_cost(self, x, y):
+        """
+        :return: the lowest cost a cell was reached at, INF if never
+        """
+        inputs = self.store[x][y].input_value_list
+        return inputs[-1][Cell.INP_VAL] if inputs else INF
 
 
-def read_layers(args):
-    xsize, ysize, minh, maxh, nlines = scan_file_for_dimensions(args.weatherfile)
-    assert minh >= TriggerSolver.MIN_HOUR, "Unexpected early hour!"
+def read_costs(args):
+    """
+    The -log(1 - p) costs of the day, from its cost cube - see prob_cube.py.
+    """
+    cache = "" if args.no_cost_cache else args.cost_cache
+    costs, xsize, ysize, minh, maxh = prob_cube.day_costs(args.weatherfile, args.dayid, args.probfile, cache)
+    assert minh == TriggerSolver.MIN_HOUR, "Unexpected early hour!"
     assert maxh < TriggerSolver.MAX_HOUR, "Unexpected late hour!"
-    logging.warning("Creating layer structure ...")
-    layers = [[[0 for y in range(1, ysize + 1)] for x in range(1, xsize + 1)] for h in range(minh, maxh + 1)]
-    logging.warning("Reading weather file data into layers...")
-    filesize = os.path.getsize(args.weatherfile)
-    pbar = tqdm.tqdm(total=filesize)
-    with open(args.weatherfile, "r") as f:
-        line = f.readline()
-        assert line == WEATHERHEADER, "Unexpected header for weather data"
-        pbar.update(len(line))
-        line = f.readline()
-        pbar.update(len(line))
-        while line != '':
-            xid_r, yid_r, date_id_r, hour_r, wind_r = line[:-1].split(',')
-            xid, yid, hour, wind = int(xid_r) - 1, int(yid_r) - 1, int(hour_r) - TriggerSolver.MIN_HOUR, float(
-                wind_r)
-            layers[hour][xid][yid] = wind
-            line = f.readline()
-            pbar.update(len(line))
-    pbar.close()
-    return layers, xsize, ysize
+    return costs, xsize, ysize
 
 
 def read_cities(args):
     tmp = {}
-    with open(args.cities, "r") as f:
+    with streams.open_file(args.cities, "r") as f:
         line = f.readline()
         assert line == "cid,xid,yid\n", "Malformed city file"
         line = f.readline()
@@ -258,61 +205,139 @@ def read_cities(args):
     return cities
 
 
-def confidence(before, prob):
-    return before * (1 - prob)
+def to_confidence(cost):
+    """
+    The confidence of a path from its cost - only done when reporting.
+    """
+    return math.exp(-cost)
 
 
-def get_furthest_city(cities):
-    maxd = 0
-    fc = None
-    for c in cities[1:]:
-        dist = abs(c[0] - cities[0][0]) + abs(c[1] - cities[0][1])
-        if dist > maxd:
-            maxd = dist
-            fc = c
-    return fc
+def solve(costs, cities, xsize, ysize, phase, origin=(0, 0)):
+    """
+    Run the solver over the day from the start city.
+    :param costs: costs [hour][x][y]
+    :param cities: list of (x, y) on the grid of the costs
+    :param phase: metrics phase counting the steps
+    :param origin: (x, y) of the grid of the costs on the whole grid
+    :return: TriggerSolver
+    """
+    # the solver indexes single cells in its inner loop - nested lists are quicker for that
+    costs = costs.tolist()
+    # forcing initial behaviour
+    london = Cell(cities[0][0], cities[0][1], costs)
+    london.force_output_value()
+    ts = TriggerSolver(xsize, ysize, costs)
+    ts.origin = origin
+    ts.store[london.x][london.y].force_input_value()
+    ts.poke_cell(london, ts.store[london.x][london.y], 0)
+    ts.active = ts.next
+    ts.next = []
+    # end of initial forcing
+    logging.warning("Processing ...")
+    for now in range(1, TriggerSolver.TOTAL_STEPS):
+        # size = len(ts.active)
+        # if size == 1:
+        #     logging.warning("1 entry in the active list.")
+        # else:
+        #     logging.warning("{} entries in the active list.".format(size))
+        ts.take_step(now)
+        phase.add()
+    return ts
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-w", "--weatherfile", default="combined_day_1.csv",
-                        help="Weather prediction data in csv format")
+                        help="Weather prediction data in csv or cube format")
     parser.add_argument("-c", "--cities", default="CityData.csv", help="City data in csv format")
     parser.add_argument("-p", "--probfile", default="ProbData.csv", help="Mapping of wind to prob >= 15")
     parser.add_argument("-o", "--output", default="paths_output.csv", help="Output path information")
-    parser.add_argument("-d", "--dayid", default=1, help="Which day is being processed. Used during output only")
+    parser.add_argument("-d", "--dayid", "--day", default=1,
+                        help="Which day is being processed - only this day's rows of a multi-day file are read")
+    parser.add_argument("-k", "--cost_cache", default=None,
+                        help="Cost cube of the day, built if out of date - default next to the weather file")
+    parser.add_argument("-K", "--no-cost-cache", action="store_true",
+                        help="Map the winds to costs without keeping them in a cube")
+    parser.add_argument("-W", "--corridor", default=None, type=int,
+                        help="Solve coarse to fine - only cells within this many blocks of the coarse paths")
+    parser.add_argument("-R", "--coarse_ratio", default=corridor.RATIO, type=int,
+                        help="Cells per side of the blocks of the coarse solve")
+    parser.add_argument("-S", "--corridor_report", default=corridor.REPORT,
+                        help="What the corridor did for each city, written with -W")
     parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
     args = parser.parse_args()
     nl = getattr(logging, args.log.upper(), None)
     if not isinstance(nl, int):
         raise ValueError("Invalid log level: {}".format(args.log))
     logging.basicConfig(level=nl,
                         format='%(asctime)s : %(message)s')
-    layers, xsize, ysize = read_layers(args)
+    meter = metrics.Metrics("triggered_solver", args.metrics_out)
+    with meter.phase("read", unit="layers", nbytes=metrics.file_bytes(args.weatherfile)) as phase:
+        costs, xsize, ysize = read_costs(args)
+        phase.add(len(costs))
     cities = read_cities(args)
-    weighter = Weighter(args)
-    # forcing initial behaviour
-    london = Cell(cities[0][0], cities[0][1], layers, weighter)
-    london.force_output_value()
-    ts = TriggerSolver(xsize, ysize, layers, weighter)
-    ts.store[london.x][london.y].force_input_value()
-    ts.poke_cell(london, ts.store[london.x][london.y], 0)
-    ts.active = ts.next
-    ts.next = []
-    # end of initial forcing
-    logging.warning("Processing ...")
-    for now in tqdm.trange(1, TriggerSolver.TOTAL_STEPS):
-        # size = len(ts.active)
-        # if size == 1:
-        #     logging.warning("1 entry in the active list.")
-        # else:
-        #     logging.warning("{} entries in the active list.".format(size))
-        ts.take_step(now)
-    # completed the process - now extract a path
-    logging.warning("Finding paths ...")
-    with open(args.output, "w") as fout:
-        for cityid in range(1, len(cities)):
-            ts.find_best_path(cityid, cities, args.dayid, fout)
+    paths = {}
+    # per city : the corridor width its path was taken from, None for the whole grid,
+    # the cost of the path, and the cost found in the first corridor
+    widths = {}
+    path_costs = {}
+    corridor_costs = {}
+    remaining = list(range(1, len(cities)))
+    width = args.corridor
+    while remaining:
+        mask = None
+        if width is not None:
+            with meter.phase("coarse", unit="cities") as phase:
+                mask = corridor.corridor_mask(costs, cities, TriggerSolver.STEPS_PER_HOUR, TriggerSolver.TOTAL_STEPS,
+                                              args.coarse_ratio, width, remaining)
+                phase.add(len(remaining))
+            # the solver builds a cell for every cell of its grid, so only the box
+            # around the corridor is solved
+            box = corridor.bounding_box(mask)
+            if corridor.box_area(box) > corridor.MAX_AREA * mask.size:
+                logging.warning("Solving the whole grid for {} cities ...".format(len(remaining)))
+                mask = None
+        if mask is None:
+            box = (slice(0, xsize), slice(0, ysize))
+            box_costs = costs
+        else:
+            box_costs = corridor.restrict(costs, mask)[(slice(None),) + box]
+        x0, y0 = box[0].start, box[1].start
+        local = [(x - x0, y - y0) for x, y in cities]
+        with meter.phase("solve", unit="steps") as phase:
+            ts = solve(box_costs, local, box_costs.shape[1], box_costs.shape[2], phase, (x0, y0))
+        settled = remaining
+        if mask is not None:
+            cells = corridor.edge_cells(mask)
+            with meter.phase("bounds", unit="cities") as phase:
+                bounds = corridor.leaving_bounds(costs, mask, cells, [ts.best_cost(x - x0, y - y0) for x, y in cells])
+                phase.add(len(remaining))
+            settled = [cid for cid in remaining
+                       if not corridor.report(cid, ts.city_cost(cid, local), bounds[cities[cid]])]
+        # completed the process - now extract a path
+        logging.warning("Finding paths ...")
+        with meter.phase("paths", unit="cities") as phase:
+            for cid in settled:
+                fout = io.StringIO()
+                ts.find_best_path(cid, local, args.dayid, fout)
+                paths[cid] = fout.getvalue()
+                widths[cid] = None if mask is None else width
+                path_costs[cid] = ts.city_cost(cid, local)
+                phase.add()
+        for cid in remaining:
+            corridor_costs.setdefault(cid, ts.city_cost(cid, local))
+        remaining = [cid for cid in remaining if cid not in settled]
+        if remaining:
+            width *= corridor.WIDEN
+            logging.warning("Solving {} cities again in a corridor of width {} ...".format(len(remaining), width))
+        del ts
+    if args.corridor is not None:
+        corridor.write_report(args.corridor_report, widths, path_costs, corridor_costs)
+    with streams.open_file(args.output, "w") as fout:
+        for cid in sorted(paths):
+            fout.write(paths[cid])
+    meter.total()
     logging.warning("  Done!")
 
 
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+#
+# Per model error variance maps : one per (x, y) over all days and hours, and one per
+# hour over the whole grid, from the same day at a time errors as model_stats.py.
+# Written as two small cubes :
+#    <root>.cells.cube : shape (models, 1, 1, x, y)
+#    <root>.hours.cube : shape (models, 1, hours, 1, 1)
+# so the maps broadcast straight over the (models, hours, x, y) of a forecast day.
+# Each header also lists the variance of each model over everything
+# ("model_variance") and the days the maps were taken from ("pooled_days").
+# Variance is the mean squared error, as in sd_file.csv. Cells or hours without
+# data are NaN.
+
+import argparse
+import logging
+
+import numpy as np
+
+import metrics
+import model_errors
+import model_stats
+import windcube
+
+CELLS_SUFFIX = ".cells.cube"
+HOURS_SUFFIX = ".hours.cube"
+DEFAULT_ROOT = "ErrorVariance"
+
+
+class VarianceMaps(object):
+    """
+    Accumulates the squared errors of each model per (x, y) and per hour.
+    """
+
+    def __init__(self, header):
+        """
+        :param header: grid of the errors, as from model_errors.common_header
+        """
+        self.header = header
+        nmodels, _, nhours, xsize, ysize = header["shape"]
+        self.cell_sums = np.zeros((nmodels, xsize, ysize))
+        self.cell_counts = np.zeros((nmodels, xsize, ysize), dtype=np.int64)
+        self.hour_sums = np.zeros((nmodels, nhours))
+        self.hour_counts = np.zeros((nmodels, nhours), dtype=np.int64)
+
+    def add_day(self, err):
+        """
+        :param err: errors of one day (models, hours, x, y), NaN where missing
+        """
+        present = ~np.isnan(err)
+        err_2 = np.where(present, err * err, 0.0)
+        self.cell_sums += err_2.sum(axis=1)
+        self.cell_counts += present.sum(axis=1)
+        self.hour_sums += err_2.sum(axis=(2, 3))
+        self.hour_counts += present.sum(axis=(2, 3))
+
+    def write(self, root):
+        """
+        Write the cells and hours cubes.
+        """
+        h = self.header
+        with np.errstate(invalid="ignore", divide="ignore"):
+            model_variance = self.cell_sums.sum(axis=(1, 2)) / self.cell_counts.sum(axis=(1, 2))
+            cells = self.cell_sums / self.cell_counts
+            hours = self.hour_sums / self.hour_counts
+        for suffix, data, header in (
+                (CELLS_SUFFIX, cells, windcube.make_header(h["xsize"], h["ysize"], 0, 0, [0], h["models"])),
+                (HOURS_SUFFIX, hours, windcube.make_header(1, 1, h["min_hour"], h["max_hour"], [0], h["models"]))):
+            header["model_variance"] = model_variance.tolist()
+            header["pooled_days"] = h["days"]
+            logging.warning("Writing {} ...".format(root + suffix))
+            windcube.write_cube(root + suffix, data.reshape(header["shape"]), header)
+
+
+def load_maps(root):
+    """
+    :return: cells memmap (models, 1, 1, x, y), hours memmap (models, 1, hours, 1, 1),
+             header of the hours cube
+    """
+    cells, _ = windcube.open_cube(root + CELLS_SUFFIX)
+    hours, header = windcube.open_cube(root + HOURS_SUFFIX)
+    return cells, hours, header
+
+
+def day_variance(root, header):
+    """
+    Variance of each model at every cell and hour of a forecast day, taken as the
+    model variance scaled by how its cell and its hour compare with it. Cells and
+    hours the maps do not cover, or have no data for, are not scaled.
+    :param header: of the forecast cube - its models must match the maps'
+    :return: array (models, hours, x, y)
+    """
+    cells, hours, mheader = load_maps(root)
+    assert mheader["models"] == header["models"], "Variance maps are for models {}".format(mheader["models"])
+    overall = np.array(mheader["model_variance"]).reshape(-1, 1, 1, 1)
+    nhours = header["max_hour"] - header["min_hour"] + 1
+    cell_ratio = np.ones((len(header["models"]), 1, header["xsize"], header["ysize"]))
+    xs = min(header["xsize"], cells.shape[3])
+    ys = min(header["ysize"], cells.shape[4])
+    cell_ratio[:, 0, :xs, :ys] = cells[:, 0, 0, :xs, :ys] / overall[:, 0]
+    hour_ratio = np.ones((len(header["models"]), nhours, 1, 1))
+    h0 = max(header["min_hour"], mheader["min_hour"])
+    h1 = min(header["max_hour"], mheader["max_hour"]) + 1
+    if h0 < h1:
+        hour_ratio[:, h0 - header["min_hour"]:h1 - header["min_hour"]] = \
+            hours[:, 0, h0 - mheader["min_hour"]:h1 - mheader["min_hour"]] / overall
+    cell_ratio[np.isnan(cell_ratio)] = 1.0
+    hour_ratio[np.isnan(hour_ratio)] = 1.0
+    return overall * cell_ratio * hour_ratio
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model_file", default=model_errors.mfile, help="Forecast data - csv or cube format")
+    parser.add_argument("-i", "--insitu", default=model_errors.rfile, help="In-situ data - csv or cube format")
+    parser.add_argument("-o", "--output", default=DEFAULT_ROOT,
+                        help="Root name of the maps - {} and {} are added".format(CELLS_SUFFIX, HOURS_SUFFIX))
+    parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    nl = getattr(logging, args.log.upper(), None)
+    if not isinstance(nl, int):
+        raise ValueError("Invalid log level: {}".format(args.log))
+    logging.basicConfig(level=nl,
+                        format='%(asctime)s : %(message)s')
+    meter = metrics.Metrics("variance_maps", args.metrics_out)
+    fheader = windcube.header_any(args.model_file)
+    iheader = windcube.header_any(args.insitu)
+    assert fheader["models"] and not iheader["models"], "Expected a forecast file and an in-situ file"
+    header = model_errors.common_header(fheader, iheader)
+    report = model_errors.MismatchReport()
+    maps = VarianceMaps(header)
+    with meter.phase("accumulate", nbytes=metrics.file_bytes(args.model_file, args.insitu)) as phase:
+        model_stats.accumulate(args.model_file, args.insitu, header, report, phase, maps=maps)
+    report.log()
+    maps.write(args.output)
+    meter.total()
+
+
+if __name__ == '__main__':
+    main()
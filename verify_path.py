@@ -5,9 +5,11 @@
 
 import argparse
 import logging
-import os
 import pdb
-import tqdm
+
+import metrics
+import streams
+import windcube
 
 
 MESSAGE_COUNT = 100000
@@ -22,44 +24,29 @@ H24 = 24 * 60
 
 
 def read_insitu(args):
-    logging.warning("Creating empty insitu structure ...")
-    data = [[[[0 for h in range(MAX_H - MIN_H)] for d in range(DAYS)] for y in range(MAX_Y)] for x in range(MAX_X)]
-    logging.warning("  done")
-    size = os.path.getsize(args.insitu)
+    """
+    Map (cube) or load (csv) the in-situ data and present it as [x][y][day][hour].
+    :return: data, list of the day ids held by the day axis
+    """
     logging.warning("Reading in-situ file ...")
-    pbar = tqdm.tqdm(total=size)
-    with open(args.insitu, "r") as insitu:
-        iline = insitu.readline()
-        pbar.update(len(iline))
-        assert iline == INSITUHEADER, "unexpected content in {}".format(args.insitu)
-        iline = insitu.readline()
-        pbar.update(len(iline))
-        while iline != '':
-            ix_r, iy_r, idate_r, ihour_r, iwind_r = iline[:-1].split(',')
-            ix, iy, idate, ihour = int(ix_r) - 1, int(iy_r) - 1, int(idate_r), int(ihour_r) - MIN_H
-            iwind = float(iwind_r)
-            try:
-                data[ix][iy][idate][ihour] = iwind
-            except IndexError:
-                pdb.set_trace()
-            iline = insitu.readline()
-            pbar.update(len(iline))
-    pbar.close()
-    return data
+    cube, header = windcube.open_any(args.insitu, args.day)
+    assert header["min_hour"] == MIN_H, "Unexpected early hour!"
+    logging.warning("  done")
+    return cube[0].transpose(2, 3, 0, 1), header["days"]
 
 
-def walk_path(insitu, cities, args):
+def walk_path(insitu, days, cities, args, phase):
+    """
+    :param phase: metrics phase counting the path rows checked
+    """
     bad_places = []
     cities_seen = {}
     for cx, cy in cities:
         cities_seen["{}-{}".format(cx, cy)] = False
     cities_count = [0 for c in cities]
     logging.warning("Reading path file and verifying ...")
-    size = os.path.getsize(args.pathfile)
-    pbar = tqdm.tqdm(total=size)
-    with open(args.pathfile, "r") as path:
+    with streams.open_file(args.pathfile, "r") as path:
         line = path.readline()
-        pbar.update(len(line))
         while line != '':
             cid_r, date_id_r, ts_r, xid_r, yid_r = line[:-1].split(',')
             cid = int(cid_r)
@@ -67,17 +54,17 @@ def walk_path(insitu, cities, args):
             h_r, _ = ts_r.split(':')
             hour = int(h_r) - MIN_H
             xid, yid = int(xid_r) - 1, int(yid_r) - 1
+            day = days.index(date_id)
             if "{}-{}".format(xid, yid) in cities_seen:
                 cities_seen["{}-{}".format(xid, yid)] = True
-            if insitu[xid][yid][date_id][hour] >= BOOM:
-                bad_places.append((cid, xid + 1, yid + 1, date_id, hour + MIN_H, insitu[xid][yid][date_id][hour]))
+            if insitu[xid][yid][day][hour] >= BOOM:
+                bad_places.append((cid, xid + 1, yid + 1, date_id, hour + MIN_H, float(insitu[xid][yid][day][hour])))
                 cities_count[cid] = H24
             else:
                 if cities_count[cid] < H24:
                     cities_count[cid] += 2
+            phase.add(1, len(line))
             line = path.readline()
-            pbar.update(len(line))
-    pbar.close()
     for i in range(len(cities)):
         k = "{}-{}".format(cities[i][0], cities[i][1])
         if not cities_seen[k]:
@@ -98,7 +85,7 @@ def walk_path(insitu, cities, args):
 def read_cities(args):
     logging.warning("Reading city information")
     tmp = {}
-    with open(args.cities, "r") as f:
+    with streams.open_file(args.cities, "r") as f:
         line = f.readline()
         assert line == "cid,xid,yid\n", "Malformed city file"
         line = f.readline()
@@ -117,18 +104,26 @@ def read_cities(args):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--pathfile", default="output_path.csv", help="Path file in csv format")
-    parser.add_argument("-i", "--insitu", default="insitu.csv", help="Insitu file for the day")
+    parser.add_argument("-i", "--insitu", default="insitu.csv", help="Insitu file for the day - csv or cube format")
     parser.add_argument("-c", "--cities", default="CityData.csv", help="City data in csv format")
+    parser.add_argument("--day", default=None, type=int,
+                        help="Only read this day's rows of a multi-day in-situ csv file")
     parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
     args = parser.parse_args()
     nl = getattr(logging, args.log.upper(), None)
     if not isinstance(nl, int):
         raise ValueError("Invalid log level: {}".format(args.log))
     logging.basicConfig(level=nl,
                         format='%(asctime)s : %(message)s')
-    insitu = read_insitu(args)
+    meter = metrics.Metrics("verify_path", args.metrics_out)
+    with meter.phase("read", unit="days", nbytes=metrics.file_bytes(args.insitu)) as phase:
+        insitu, days = read_insitu(args)
+        phase.add(len(days))
     cities = read_cities(args)
-    walk_path(insitu, cities, args)
+    with meter.phase("verify") as phase:
+        walk_path(insitu, days, cities, args, phase)
+    meter.total()
 
 
 if __name__ == '__main__':
@@ -7,46 +7,19 @@ import argparse
 import json
 import logging
 
+import sidecar
+import streams
+
 
 EXPECTEDHDR = "xid,yid,date_id,hour,wind\n"
 message_count = 100000
 
 
-def scan_file_for_dimensions(fn):
-    mx = 0
-    my = 0
-    mxh = 0
-    minh = 24  # hour cannot be beyond end of day
-    count = 0
-    logging.warning("Scanning input file for size information ...")
-    with open(fn, "r") as f:
-        line = f.readline()
-        assert line == EXPECTEDHDR, "Malformed file - header does not match expectations"
-        line = f.readline()
-        while line != '':
-            if count % message_count == 0:
-                print(count)
-            count += 1
-            # note dropping of final \n
-            xid_r, yid_r, date_r, hour_r, wind_r = line[:-1].split(',')
-            xid, yid, hid = int(xid_r), int(yid_r), int(hour_r)
-            if xid > mx:
-                mx = xid
-            if yid > my:
-                my = yid
-            if hid > mxh:
-                mxh = hid
-            if hid < minh:
-                minh = hid
-            line = f.readline()
-        return mx, my, minh, mxh
-
-
 def read_data_and_shift_one(filename):
-    xsize, ysize, minh, maxh = scan_file_for_dimensions(filename)
+    xsize, ysize, minh, maxh = sidecar.get_dimensions(filename)
     # create empty structure
     data = [[[0 for y in range(ysize)] for x in range(xsize)] for h in range(maxh - minh)]
-    with open(filename, "r") as f:
+    with streams.open_file(filename, "r") as f:
         line = f.readline()
         assert line == EXPECTEDHDR, "Unexpected format for insitu file"
         line = f.readline()
@@ -58,7 +31,7 @@ def read_data_and_shift_one(filename):
 
 
 def check_points(filename, data):
-    with open(filename, "r") as f:
+    with streams.open_file(filename, "r") as f:
         line = f.readline()
         while line != '':
             x, y, h = line[:-1].split(',')
@@ -4,8 +4,9 @@
 #    1.1 Take the standard deviations per model and per model/per value bucket, and the
 #      per model data.
 #    1.2 Using the variance, estimate a wind value per location by the following formula :
-#          new cell value at location = sum_over_all_models(vn*rn)/sum(vn)
+#          new cell value at location = sum_over_all_models(rn/vn)/sum(1/vn)
 #        where vn is variance of model n and rn is wind value for model n at that location.
+#        i.e. an inverse variance weighted mean.
 #        That gives a new predicted value for each location based on models and their perceived accuracy.
 #    1.3 Use this new data point to calculate a value as before, but this time, rather than use the
 #        global model variance, use the variance per bucket, where buckets are defined wind values between
@@ -16,109 +17,151 @@
 #    * Using these new data sets, bucketize the predicted wind value down to one decimal place, and show which of the
 #      buckets correspond to a case where the real value was >= 15. Express as a % of the total number of items in that
 #      bucket. And show the total number.
+#      The same probabilities are also written per day and per hour, to results_per_day.csv and
+#      results_per_hour.csv next to the results file.
 #    * Once these values are accepted by the customer, create a new predicted dataset replacing the windvalues with
 #      confidence ratings
 #      (confidence rating = 1 - % defined above) - [this confidence rating will be the input to the path finding model]
 #
 
 import argparse
+import hashlib
 import logging
 import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import buckets
+import chunked_csv
+import lsq_weights
+import manifest
+import metrics
+import model_errors
+import model_stats
+import streams
+import variance_maps
+import windcube
 
 Nmodels = 10  # but they start at 1
-Nbuckets = 6
-BucketWidth = 5
-message_count = 10000  # every message_count iterations, output a message
-OutputBuckets = 60
-OutputBucketWidth = 0.5
 
 
 class CacherOne(object):
     """
-    We need to build up the model data over multiple lines.
-    This takes the xid, yid, date_id, hour and creates a key
-    used for caching. The key links to an array of values for
-    each model.
-    If the key does not match the current active key, write out
-    the processed value for that (xid, yid, date_id, hour) and
-    start a new
+    Combines the model values of each (xid, yid, date_id, hour) into one value,
+    working on whole (models, ...) arrays of a forecast cube, so the order the rows
+    came in does not matter.
     """
 
-    def __init__(self, sds, bsds, args):
+    def __init__(self, sds, bsds, args, scheme=buckets.DEFAULT_SD, maps=None, blend=None):
         """
         Init
         :param sds:  Per model SD
         :param bsds: Per bucket per model SD
         :param args: General args
+        :param scheme: buckets.BucketScheme the per bucket SDs were taken with
+        :param maps: root name of variance maps from variance_maps.py - if given, cubes
+                     are combined with location dependent weights instead
+        :param blend: lsq_weights.BlendWeights - if given, these weights are used
+                      instead of the SDs, which may then be None
         """
         self.sds = sds
         self.bsds = bsds
+        self.args = args
+        self.scheme = scheme
+        self.maps = maps
+        self.blend = blend
+        self.map_weights = {}
+        if blend is not None:
+            self.model_weights = blend.weights
+            self.wsum = self.model_weights.sum()
+            self.scheme, self.bucket_weights = blend.bucket_weights()
+            return
         self.variances = {}
         for m in sorted(self.sds.keys()):
             self.variances[m] = self.sds[m] * self.sds[m]
-        self.vsum = sum(self.variances)
-        self.args = args
-        self.model_data = [0 for x in range(Nmodels)]  # zero'd array
-        self.key = None
-        self.added = 0
+        # inverse variance weights as arrays - remember models start at 1 not 0
+        self.model_weights = 1.0 / np.array([self.variances[m + 1] for m in range(Nmodels)])
+        self.wsum = self.model_weights.sum()
+        self.bucket_weights = 1.0 / np.array([[self.bsds[m + 1][b] * self.bsds[m + 1][b] for m in range(Nmodels)]
+                                              for b in range(len(scheme))])
 
-    def calc(self):
+    def combine(self, model_data):
         """
-        At this point we should have all 10 model values available - we need to combine
-        that data using the magic formula
-        :return:
+        Combine the model values using the magic formula.
+        :param model_data: array (Nmodels, ...) - e.g. a day (Nmodels, hours, x, y)
+        :return: array of combined values, the shape of model_data without the models
         """
-        initial_value = 0.0
-        for i in range(len(self.model_data)):
-            initial_value += self.model_data[i] * self.variances[i + 1]  # remember variances start at 1 not 0
-        initial_value /= self.vsum
-        # get the bucket based on this initial value
-        bucket = int(initial_value / BucketWidth)
-        if bucket >= Nbuckets: bucket = Nbuckets - 1
-        value = 0.0
-        sumit = 0
-        for i in range(len(self.model_data)):
-            var = self.bsds[i + 1][bucket]  * self.bsds[i + 1][bucket]
-            value += self.model_data[i] * var
-            sumit += var
-        value /= sumit
-        return value
-
-    def add_line(self, line):
-        if line is None:  # special case - write what we have
-            assert self.key is not None
-            return "{0},{1},{2},{3},{4}\n".format(self.key[0],
-                                                  self.key[1],
-                                                  self.key[2],
-                                                  self.key[3],
-                                                  self.calc())
-        xid_r, yid_r, date_id_r, hour_r, model_r, wind_r = line[:-1].split(',')
-        xid, yid, date_id, hour, model, wind = int(xid_r), int(yid_r), int(date_id_r), int(hour_r), int(model_r), float(
-            wind_r)
-        model -= 1  # models are 1 .. 10
-        newkey = (xid, yid, date_id, hour)
-        if self.key is None:  # first time
-            self.added = 1
-            self.key = newkey
-            self.model_data = [0 for x in range(Nmodels)]
-            self.model_data[model] = wind
-            return None
-        if newkey != self.key:  # only one key at a time
-            assert self.added == Nmodels
-            self.added = 1
-            result = "{0},{1},{2},{3},{4}\n".format(self.key[0],
-                                                    self.key[1],
-                                                    self.key[2],
-                                                    self.key[3],
-                                                    self.calc())
-            self.key = newkey
-            self.model_data = [0 for x in range(Nmodels)]
-            self.model_data[model] = wind
-            return result
-        # OK - we just record this model's data and return None
-        self.added += 1
-        self.model_data[model] = wind
-        return None
+        initial_value = np.tensordot(self.model_weights, model_data, axes=1) / self.wsum
+        # weights (..., Nmodels) for the bucket of each initial value, moved to the front
+        weights = np.moveaxis(self.bucket_weights[self.scheme.assign(initial_value)], -1, 0)
+        return (model_data * weights).sum(axis=0) / weights.sum(axis=0)
+
+    def combine_day(self, cube, header, di, combined, ci=None):
+        """
+        Combine one day of a forecast cube into the combined cube.
+        Locations with no model data at all stay NaN.
+        :param cube: memmap of shape (models, days, hours, x, y)
+        :param di: index of the day in the forecast cube
+        :param combined: float64 cube of shape (1, days, hours, x, y)
+        :param ci: index of the day in the combined cube, if not di
+        """
+        if ci is None:
+            ci = di
+        if self.maps is not None or self.blend is not None and self.blend.region is not None:
+            combined[0, ci] = self.combine_weighted(cube[:, di], header)
+            return
+        assert header["models"] == list(range(1, Nmodels + 1)), "Unexpected models in forecast cube"
+        model_data = np.asarray(cube[:, di], dtype=np.float64)
+        missing = np.isnan(model_data)
+        assert np.all(missing.any(axis=0) == missing.all(axis=0)), "Forecast cube has locations with missing models"
+        combined[0, ci] = self.combine(model_data)
+
+    def weights_for(self, header):
+        """
+        Inverse variance weights (models, hours, x, y) from the variance maps, or the
+        least squares weights of each region (models, 1, x, y), for the grid of a
+        forecast cube.
+        """
+        key = (header["min_hour"], header["max_hour"], header["xsize"], header["ysize"])
+        if key not in self.map_weights and self.maps is None:
+            self.map_weights[key] = self.blend.cell_weights(header)
+        elif key not in self.map_weights:
+            self.map_weights[key] = 1.0 / variance_maps.day_variance(self.maps, header)
+        return self.map_weights[key]
+
+    def combine_weighted(self, day, header):
+        """
+        Weighted mean of the models, each weighted by how well it does at that cell
+        and hour, or in that region - one array expression over the day.
+        :param day: forecast values (models, hours, x, y)
+        :return: combined values (hours, x, y), NaN where any model is missing
+        """
+        weights = self.weights_for(header)
+        return (day * weights).sum(axis=0) / weights.sum(axis=0)
+
+    @staticmethod
+    def write_cube(combined, header, out, phase):
+        """
+        Write a combined cube in the xid, yid, date_id, hour order of the forecast csv,
+        skipping locations with no value.
+        :param out: open combined file
+        :param phase: metrics phase counting the rows written
+        """
+        hours = np.arange(header["min_hour"], header["max_hour"] + 1)
+        yids, date_ids, hours = [a.ravel() for a in np.meshgrid(np.arange(1, header["ysize"] + 1),
+                                                                header["days"], hours, indexing="ij")]
+        for x in range(header["xsize"]):
+            # (days, hours, y) -> one row per (y, day, hour)
+            values = combined[0, :, :, x, :].transpose(2, 0, 1).ravel()
+            present = ~np.isnan(values)
+            phase.add(int(present.sum()))
+            out.write(chunked_csv.format_rows(np.full(present.sum(), x + 1),
+                                              yids[present],
+                                              date_ids[present],
+                                              hours[present],
+                                              values[present]))
 
 
 class WeighingMachine(object):
@@ -126,7 +169,7 @@ class WeighingMachine(object):
     Class that wraps up the various methods required. Grouped as a class as a lot of
     overlap expected.
 
-    Buckets are:
+    Buckets are, unless the sd bucket file records others:
     b0 : 0..5-
     b1 : 5..10-
     b2 : 10..15-
@@ -136,6 +179,7 @@ class WeighingMachine(object):
     """
     COMBINEDHEADER = "xid,yid,date_id,hour,wind\n"
     INSITUHEADER = "xid,yid,date_id,hour,wind\n"
+    STAGE = "weighted_means"
 
     def __init__(self, args):
         """
@@ -143,6 +187,7 @@ class WeighingMachine(object):
         :param args: parsed argparse info
         """
         self.args = args
+        self.meter = metrics.Metrics("weighted_means", args.metrics_out)
 
 
     def get_first_wind_estimate(self):
@@ -153,111 +198,312 @@ class WeighingMachine(object):
         model,b0-sd,b1-sd,b2-sd,b3-sd,b4-sd,b5-sd
         :return:
         """
-        # suck in the model sd info
-        sd_per_model = {}
-        with open(self.args.sdfile, "r") as f:
-            line = f.readline()
-            assert line=="model,sd\n", "Malformed sd file : {}".format(self.args.sdfile)
-            line = f.readline()
-            while line != '':
-                model, data = line[:-1].split(',')
-                sd_per_model[int(model)] = float(data)
-                line = f.readline()
-        # sd_per_bucket_per_model
-        sd_per_bucket_per_model = {}
-        for i in range(1, 1 + Nmodels):
-            sd_per_bucket_per_model[i] = []
-        with open(self.args.sdbucketfile, "r") as f:
-            line = f.readline()
-            assert line=="model,b0,b1,b2,b3,b4,b5\n"
-            line = f.readline()
-            while line != '':
-                model, b0, b1, b2, b3, b4, b5 = line[:-1].split(',')
-                sd_per_bucket_per_model[int(model)] = [float(b0), float(b1), float(b2), float(b3), float(b4), float(b5)]
-                line = f.readline()
+        if self.args.lsq_weights is not None:
+            cacher = CacherOne(None, None, self.args, blend=lsq_weights.read_weights(self.args.lsq_weights))
+            self.combine_cube(cacher, self.sd_digest())
+            return
+        sd_per_model, sd_per_bucket_per_model, scheme = model_stats.read_sd_files(self.args.sdfile,
+                                                                                 self.args.sdbucketfile)
         # OK - now we have the values
-        cacher = CacherOne(sd_per_model, sd_per_bucket_per_model, self.args)
-        counter = 0
-        with open(self.args.combined, "w") as out:
-            with open(self.args.model_file, "r") as inp:
-                line = inp.readline()
-                assert line == "xid,yid,date_id,hour,model,wind\n", "line is : " + line
-                out.write(WeighingMachine.COMBINEDHEADER)
-                line = inp.readline()
-                while line != '':
-                    if counter % message_count == 0: print(counter)
-                    counter += 1
-                    result = cacher.add_line(line)
-                    if result is not None:
-                        out.write(result)
-                    line = inp.readline()
-                out.write(cacher.add_line(None))
+        cacher = CacherOne(sd_per_model, sd_per_bucket_per_model, self.args, scheme, self.args.variance_maps)
+        self.combine_cube(cacher, self.sd_digest())
+
+    def sd_digest(self):
+        """
+        sha1 of the sd files and variance maps, or of the least squares weights - a
+        change to them makes every combined day dirty.
+        """
+        h = hashlib.sha1()
+        names = [self.args.sdfile, self.args.sdbucketfile]
+        if self.args.lsq_weights is not None:
+            names = [self.args.lsq_weights]
+        elif self.args.variance_maps is not None:
+            names += [self.args.variance_maps + variance_maps.CELLS_SUFFIX,
+                      self.args.variance_maps + variance_maps.HOURS_SUFFIX]
+        for fn in names:
+            with streams.open_file(fn, "rb") as f:
+                h.update(f.read())
+        return h.hexdigest()
+
+    def combine_cube(self, cacher, inputs):
+        """
+        Step 1 from a forecast cube - the model file is either a cube already, or is
+        ingested into one next to it, incrementally if it has a manifest.
+        The combined values are kept in a float64 cube next to the combined file, and
+        only the days the manifest reports dirty are combined again.
+        :param inputs: digest of the sd files
+        """
+        cube_file = self.args.model_file
+        if not windcube.is_cube(cube_file):
+            cube_file = windcube.cube_name(self.args.model_file)
+            with self.meter.phase("ingest", unit="partitions", nbytes=metrics.file_bytes(self.args.model_file)) as phase:
+                phase.add(len(manifest.ingest(self.args.model_file, cube_file, self.args.workers)))
+        cube, header = windcube.open_cube(cube_file)
+        combined_file = windcube.cube_name(self.args.combined)
+        combined_header = windcube.make_header(header["xsize"], header["ysize"], header["min_hour"],
+                                               header["max_hour"], header["days"], [], np.float64)
+        dirty = manifest.dirty_partitions(cube_file, WeighingMachine.STAGE, inputs)
+        if dirty is not None and windcube.is_cube(combined_file) and \
+                windcube.read_header(combined_file)[0] == combined_header:
+            combined, _ = windcube.open_cube(combined_file, "r+")
+            days = sorted(set(d for d, m in dirty))
+        else:
+            combined = windcube.create_cube(combined_file, combined_header)
+            days = header["days"]
+        logging.warning("Combining {} days of forecast cube {} ...".format(len(days), cube_file))
+        with self.meter.phase("combine", unit="cells") as phase:
+            for day in days:
+                cacher.combine_day(cube, header, header["days"].index(day), combined)
+                phase.add(cube[:, 0].size)
+            combined.flush()
+        with streams.open_file(self.args.combined, "w") as out, self.meter.phase("write") as phase:
+            out.write(WeighingMachine.COMBINEDHEADER)
+            cacher.write_cube(combined, combined_header, out, phase)
+        manifest.mark_consumed(cube_file, WeighingMachine.STAGE, inputs)
+
+    def combined_input(self):
+        """
+        The combined values to score : the float64 cube step 1 keeps next to the
+        combined file, unless the combined file is newer - e.g. written by other means.
+        """
+        cube_file = windcube.cube_name(self.args.combined)
+        if windcube.is_cube(cube_file) and (not os.path.exists(self.args.combined) or
+                                            os.path.getmtime(cube_file) >= os.path.getmtime(self.args.combined)):
+            return cube_file
+        return self.args.combined
 
     def calc_sd(self):
+        """
+        Step 2 - score the combined values against the in-situ data a day at a time,
+        over -j processes if asked, and write the results file along with the per day
+        and per hour probability tables.
+        """
         logging.warning("Calculating SD of combined data set")
-        # global and bucketized
-        sum_err_2 = 0
-        count = 0
-        bucket_err_2 = [0 for n in range(OutputBuckets)]  # zero'ed list
-        bucket_count = [0 for n in range(OutputBuckets)]
-        greater_15 = [0 for n in range(OutputBuckets)]
-        with open(self.args.combined, "r") as combined:
-            with open(self.args.insitu, "r") as insitu :
-                cline = combined.readline()
-                assert cline == WeighingMachine.COMBINEDHEADER, "unexpected content in {}".format(self.args.combined)
-                iline = insitu.readline()
-                assert iline == WeighingMachine.INSITUHEADER, "unexpected content in {}".format(self.args.insitu)
-                cline = combined.readline()
-                iline = insitu.readline()
-                while cline != '' and iline != '':
-                    if count % message_count: print(count)
-                    cx, cy, cdate, chour, cwind = cline[:-1].split(',')
-                    ix, iy, idate, ihour, iwind = iline[:-1].split(',')
-                    assert cx == ix and\
-                           cy == iy and\
-                           cdate == idate and\
-                           chour == ihour, "in-situ and combined files do not line up!"
-                    cval = float(cwind)
-                    ival = float(iwind)
-                    err = cval - ival
-                    sum_err_2 += err * err
-                    count += 1
-                    bucket = int(float(cwind) / OutputBucketWidth)
-                    if bucket >= OutputBuckets:
-                        bucket = OutputBuckets - 1
-                    bucket_err_2[bucket] += err * err
-                    bucket_count[bucket] += 1
-                    if ival >= 15:
-                        greater_15[bucket] += 1
-                    cline = combined.readline()
-                    iline = insitu.readline()
-        var_global = sum_err_2 / count
+        combined = self.combined_input()
+        header = model_errors.common_header(windcube.header_any(combined), windcube.header_any(self.args.insitu))
+        tables = TableSet(header, buckets.prob_scheme(self.args.prob_buckets))
+        jobs = [(combined, self.args.insitu, header, day, tables.scheme) for day in header["days"]]
+        with self.meter.phase("calc_sd", nbytes=metrics.file_bytes(combined, self.args.insitu)) as phase:
+            if self.args.workers > 1 and len(jobs) > 1:
+                logging.warning("  {} days over {} workers".format(len(jobs), self.args.workers))
+                with ProcessPoolExecutor(max_workers=self.args.workers) as pool:
+                    days = list(pool.map(day_tables, jobs))
+            else:
+                days = map(day_tables, jobs)
+            for day, hour_tables in days:
+                phase.add(tables.add_day(day, hour_tables))
+        tables.write(self.args.results)
+
+
+def hour_tables(cval, ival, scheme):
+    """
+    The error tables of one day, one per hour.
+    :param cval: combined values of the day (hours, x, y), NaN where missing
+    :param ival: in-situ values on the same grid
+    :return: list of ErrorTable
+    """
+    tables = []
+    for c, i in zip(cval, ival):
+        both = ~np.isnan(c) & ~np.isnan(i)
+        table = ErrorTable(scheme)
+        table.add(c[both], i[both])
+        tables.append(table)
+    return tables
+
+
+def day_tables(job):
+    """
+    Worker : the error tables of one day of the combined and in-situ files.
+    :param job: combined file, in-situ file, common grid header, date_id, bucket scheme
+    :return: date_id, list of ErrorTable, one per hour of the grid
+    """
+    combined_fn, insitu_fn, header, day, scheme = job
+    combined, cheader = windcube.open_any(combined_fn, day, np.float64)
+    insitu, iheader = windcube.open_any(insitu_fn, day, np.float64)
+    cval = model_errors.day_slice(combined, cheader, header, day)[0]
+    ival = model_errors.day_slice(insitu, iheader, header, day)[0]
+    return day, hour_tables(cval, ival, scheme)
+
+
+def table_name(results, kind):
+    """
+    :param kind: "day" or "hour"
+    :return: name of a probability table written alongside the results file,
+             e.g. results_per_day.csv
+    """
+    root, ext = os.path.splitext(streams.strip_codec(results))
+    return "{}_per_{}{}{}".format(root, kind, ext, results[len(streams.strip_codec(results)):])
+
+
+class TableSet(object):
+    """
+    The error table of the whole grid, and one per day and one per hour, built from
+    the per day and hour tables of hour_tables.
+    """
+
+    def __init__(self, header, scheme=buckets.DEFAULT_PROB):
+        """
+        :param header: common grid of the combined and in-situ data
+        :param scheme: buckets.BucketScheme of the combined values
+        """
+        self.scheme = scheme
+        self.total = ErrorTable(scheme)
+        self.days = []
+        self.per_day = []
+        self.hours = list(range(header["min_hour"], header["max_hour"] + 1))
+        self.per_hour = [ErrorTable(scheme) for _ in self.hours]
+
+    def add_day(self, day, hour_tables):
+        """
+        :param hour_tables: tables of the day, one per hour of the grid
+        :return: values added
+        """
+        day_table = ErrorTable(self.scheme)
+        for table, hour_table in zip(hour_tables, self.per_hour):
+            day_table.merge(table)
+            hour_table.merge(table)
+        self.days.append(day)
+        self.per_day.append(day_table)
+        self.total.merge(day_table)
+        return day_table.count
+
+    def write(self, results):
+        """
+        Write the results file and the per day and per hour tables next to it.
+        :return: files written
+        """
+        self.total.write(results)
+        written = [results]
+        for kind, key, keys, tables in (("day", "date_id", self.days, self.per_day),
+                                        ("hour", "hour", self.hours, self.per_hour)):
+            written.append(table_name(results, kind))
+            write_table(written[-1], key, keys, tables, self.scheme)
+        return written
+
+
+def write_table(fn, key, keys, tables, scheme):
+    """
+    Write a probability table : one row per key, with the count of values and the
+    probability per bucket, as on the last line of the results file. Rows without
+    values have nan probabilities.
+    :param key: name of the key column
+    """
+    logging.warning("Probability table written to {}".format(fn))
+    with streams.open_file(fn, "w") as f:
+        buckets.write_edges(f, scheme, buckets.DEFAULT_PROB)
+        f.write(",".join([key, "count"] + ["b{}".format(b) for b in range(len(scheme))]) + "\n")
+        for k, table in zip(keys, tables):
+            probs = table.probabilities() if table.count else [float("nan")] * len(scheme)
+            f.write(",".join(["{}".format(k), "{}".format(table.count)] + ["{}".format(p) for p in probs]) + "\n")
+
+
+class ErrorTable(object):
+    """
+    Squared errors of the combined values against the in-situ data, overall and per
+    output bucket of the combined value, with the count of in-situ values >= 15 per
+    bucket - the probabilities used by the solvers.
+    """
+
+    def __init__(self, scheme=buckets.DEFAULT_PROB):
+        """
+        :param scheme: buckets.BucketScheme of the combined values
+        """
+        self.scheme = scheme
+        self.sum_err_2 = 0
+        self.count = 0
+        self.bucket_err_2 = np.zeros(len(scheme))
+        self.bucket_count = np.zeros(len(scheme), dtype=np.int64)
+        self.greater_15 = np.zeros(len(scheme), dtype=np.int64)
+
+    def add(self, cval, ival):
+        """
+        :param cval: combined values
+        :param ival: in-situ values of the same cells
+        """
+        err_2 = (cval - ival) ** 2
+        self.sum_err_2 += err_2.sum()
+        self.count += len(cval)
+        nbuckets = len(self.scheme)
+        bucket = self.scheme.assign(cval)
+        self.bucket_err_2 += np.bincount(bucket, weights=err_2, minlength=nbuckets)
+        self.bucket_count += np.bincount(bucket, minlength=nbuckets)
+        self.greater_15 += np.bincount(bucket[ival >= 15], minlength=nbuckets)
+
+    def merge(self, other):
+        """
+        Add in a table of other values - e.g. of another day, or from another process.
+        """
+        assert other.scheme == self.scheme, "Cannot merge tables of different buckets"
+        self.sum_err_2 += other.sum_err_2
+        self.count += other.count
+        self.bucket_err_2 += other.bucket_err_2
+        self.bucket_count += other.bucket_count
+        self.greater_15 += other.greater_15
+
+    def probabilities(self):
+        """
+        Probability of an in-situ value >= 15 per bucket. Buckets with no values - as
+        fine buckets can have - take the probability of the nearest lower bucket with
+        values, or failing that the nearest upper one.
+        :return: list of probabilities
+        """
+        counts = self.bucket_count.tolist()
+        greater_15 = self.greater_15.tolist()
+        probs = [float(g) / c if c > 0 else None for g, c in zip(greater_15, counts)]
+        assert any(p is not None for p in probs), "No values to take probabilities from"
+        last = next(p for p in probs if p is not None)
+        for i, p in enumerate(probs):
+            if p is None:
+                probs[i] = last
+            else:
+                last = p
+        return probs
+
+    def write(self, results):
+        """
+        :param results: file to write, ending with the csv line of probabilities
+        """
+        nbuckets = len(self.scheme)
+        sum_err_2 = float(self.sum_err_2)
+        bucket_err_2 = self.bucket_err_2.tolist()
+        bucket_count = self.bucket_count.tolist()
+        greater_15 = self.greater_15.tolist()
+        var_global = sum_err_2 / self.count
         sd_global = math.sqrt(var_global)
-        var_buckets = [0 for n in range(OutputBuckets)]
-        sd_buckets = [0 for n in range(OutputBuckets)]
-        for i in range(OutputBuckets):
-            var_buckets[i] = bucket_err_2[i] / bucket_count[i]
-            sd_buckets[i] = math.sqrt(var_buckets[i])
-        logging.warning("Results written to {}".format(self.args.results))
-        with open(self.args.results, "w") as res:
+        var_buckets = [float("nan") for n in range(nbuckets)]
+        sd_buckets = [float("nan") for n in range(nbuckets)]
+        percent = [float("nan") for n in range(nbuckets)]
+        for i in range(nbuckets):
+            if bucket_count[i] > 0:
+                var_buckets[i] = bucket_err_2[i] / bucket_count[i]
+                sd_buckets[i] = math.sqrt(var_buckets[i])
+                percent[i] = 100 * greater_15[i] / bucket_count[i]
+        probs = self.probabilities()
+        empty = bucket_count.count(0)
+        if empty:
+            logging.warning("{} of the {} buckets are empty - using their neighbours' probabilities".format(
+                empty, nbuckets))
+        logging.warning("Results written to {}".format(results))
+        with streams.open_file(results, "w") as res:
             gline = "# Global variance = {}, sd = {}\n".format(var_global, sd_global)
             res.write(gline)
             print(gline)
-            for i in range(OutputBuckets):
+            for i in range(nbuckets):
                 iline = "# Bucket {}, var = {}, sd = {}\n".format(i, var_buckets[i], sd_buckets[i])
                 res.write(iline)
                 print(iline)
-            for i in range(OutputBuckets):
+            for i in range(nbuckets):
                 iline = "# Bucket {}, count > 15 = {}, total = {}, % = {}\n".format(i,
                                                                                   greater_15[i],
                                                                                   bucket_count[i],
-                                                                                  100 * greater_15[i] / bucket_count[i])
+                                                                                  percent[i])
                 res.write(iline)
                 print(iline)
+            buckets.write_edges(res, self.scheme, buckets.DEFAULT_PROB)
             res.write("# This last line is a csv set of probs\n")
             iline = ""
-            for i in range(OutputBuckets):
-                iline = iline + "{},".format(float(greater_15[i]) / bucket_count[i])
+            for i in range(nbuckets):
+                iline = iline + "{},".format(probs[i])
             iline = iline[:-1]
             iline += "\n"
             res.write(iline)
@@ -280,8 +526,19 @@ def main():
                         help="File name for file containing the new predicted data based on combining model info")
     parser.add_argument("-r", "--results", default='results.csv',
                         help="File name for file containing the SD of the new predicted data vs in-situ")
+    parser.add_argument("-j", "--workers", default=1, type=int,
+                        help="processes used to ingest the model file into a cube for step 1, and to score the days "
+                             "of step 2")
+    parser.add_argument("-V", "--variance_maps", default=None,
+                        help="Root name of per cell and per hour variance maps from variance_maps.py - "
+                             "step 1 then weighs each model by how well it does at each cell and hour")
+    parser.add_argument("-L", "--lsq_weights", default=None,
+                        help="Weights file from lsq_weights.py - step 1 then blends with these weights "
+                             "instead of the sd files")
+    buckets.prob_option(parser)
     parser.add_argument("-O", action="store_false", help="skip step 1")
     parser.add_argument("-S", action="store_false", help="skip step 2")
+    metrics.add_argument(parser)
     args = parser.parse_args()
     nl = getattr(logging, args.log.upper(), None)
     if not isinstance(nl, int):
@@ -293,6 +550,7 @@ def main():
         wm.get_first_wind_estimate()
     if args.S:
         wm.calc_sd()
+    wm.meter.total()
 
 
 if __name__ == '__main__':
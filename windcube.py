@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+#
+# Converts the csv weather files (forecast, in-situ or combined) into a dense
+# float32 cube on disk so the other tools can open the data via numpy.memmap
+# instead of re-parsing the csv on every run.
+#
+# File layout :
+#    MAGIC (8 bytes)
+#    header length (4 bytes, little endian)
+#    json header - shape, xsize, ysize, min/max hour, day ids, model ids
+#    padding up to a multiple of ALIGN bytes
+#    float32 data in C order, shape = (models, days, hours, x, y)
+#    (derived cubes may ask for another dtype in the header)
+# Files without a model column (in-situ, combined) have a single model entry
+# and an empty model list in the header. Cells with no data are NaN.
+
+import argparse
+import json
+import logging
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import chunked_csv
+import metrics
+import sidecar
+import streams
+
+MAGIC = b"WINDCUBE"
+VERSION = 1
+ALIGN = 64
+DTYPE = np.float32
+CUBE_EXTENSION = ".cube"
+RANGES_PER_WORKER = 4  # more ranges than workers evens out the load
+
+
+def is_cube(fn):
+    """
+    Check for the cube magic rather than trusting the extension.
+    :param fn: file name
+    :return: True if fn is a wind cube file
+    """
+    try:
+        with open(fn, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+def data_offset(header_bytes):
+    fixed = len(MAGIC) + 4 + len(header_bytes)
+    return ((fixed + ALIGN - 1) // ALIGN) * ALIGN
+
+
+def read_header(fn):
+    """
+    Read the json header of a cube file.
+    :param fn: cube file name
+    :return: header dict, offset of the data in the file
+    """
+    with open(fn, "rb") as f:
+        magic = f.read(len(MAGIC))
+        assert magic == MAGIC, "{} is not a wind cube file".format(fn)
+        hlen, = struct.unpack("<I", f.read(4))
+        raw = f.read(hlen)
+    header = json.loads(raw.decode("utf-8"))
+    assert header["version"] == VERSION, "Unsupported cube version {}".format(header["version"])
+    return header, data_offset(raw)
+
+
+def make_header(xsize, ysize, minh, maxh, days, models, dtype=DTYPE):
+    """
+    Build the header dict describing a cube.
+    :param models: list of model ids, empty if the source had no model column
+    """
+    return {"version": VERSION,
+            "dtype": np.dtype(dtype).name,
+            "shape": [max(len(models), 1), len(days), maxh - minh + 1, xsize, ysize],
+            "xsize": xsize,
+            "ysize": ysize,
+            "min_hour": minh,
+            "max_hour": maxh,
+            "days": sorted(days),
+            "models": sorted(models)}
+
+
+def cube_dtype(header):
+    return np.dtype(header.get("dtype", DTYPE))
+
+
+def create_cube(fn, header):
+    """
+    Write the header and size the file, then return a writable memmap of the data
+    with every cell set to NaN.
+    """
+    raw = json.dumps(header, sort_keys=True).encode("utf-8")
+    offset = data_offset(raw)
+    with open(fn, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(raw)))
+        f.write(raw)
+        f.write(b"\0" * (offset - f.tell()))
+    cube = np.memmap(fn, dtype=cube_dtype(header), mode="r+", offset=offset, shape=tuple(header["shape"]))
+    cube[:] = np.nan
+    return cube
+
+
+def write_cube(fn, data, header):
+    """
+    Store an in-memory array as a cube file.
+    :param data: array matching header["shape"]
+    """
+    assert tuple(data.shape) == tuple(header["shape"]), "Data shape does not match header"
+    cube = create_cube(fn, header)
+    cube[:] = data
+    cube.flush()
+    del cube
+
+
+def open_cube(fn, mode="r"):
+    """
+    Map a cube file into memory. Pages are only read when touched, and are
+    shared through the OS page cache between processes using the same file.
+    :param fn: cube file name
+    :param mode: memmap mode - "r" or "r+"
+    :return: memmap of shape (models, days, hours, x, y), header dict
+    """
+    header, offset = read_header(fn)
+    cube = np.memmap(fn, dtype=cube_dtype(header), mode=mode, offset=offset, shape=tuple(header["shape"]))
+    return cube, header
+
+
+def day_index(header, date_id):
+    """
+    Map a date_id onto the day axis of the cube.
+    A cube holding a single day answers for any date_id so per-day cubes can be used
+    without knowing which day they hold.
+    """
+    days = header["days"]
+    if len(days) == 1:
+        return 0
+    try:
+        return days.index(int(date_id))
+    except ValueError:
+        raise ValueError("Day {} not in cube - available days are {}".format(date_id, days))
+
+
+def model_index(header, model):
+    return header["models"].index(int(model))
+
+
+def read_day_layers(fn, date_id=None, model=None):
+    """
+    Get the [hour][x][y] layers for one day, as used by the solvers.
+    Missing cells read as 0 to match the behaviour of the old csv readers.
+    :param fn: cube or csv file name
+    :param date_id: day to extract - may be None if the cube holds one day
+    :param model: model to extract - only needed for forecast cubes
+    :return: layers array, xsize, ysize, min hour, max hour
+    """
+    cube, header = open_any(fn, date_id)
+    if date_id is None:
+        assert len(header["days"]) == 1, "Cube holds several days - a day must be chosen"
+    mi = 0 if model is None else model_index(header, model)
+    layers = np.nan_to_num(cube[mi, day_index(header, date_id)], nan=0.0)
+    return layers, header["xsize"], header["ysize"], header["min_hour"], header["max_hour"]
+
+
+def store_columns(cube, header, cols):
+    """
+    Write a block of parsed rows into the cube.
+    Rows for days the cube does not hold are skipped.
+    :param cols: dict of column arrays as produced by chunked_csv
+    """
+    days = np.array(header["days"])
+    di = np.minimum(np.searchsorted(days, cols["date_id"]), len(days) - 1)
+    keep = days[di] == cols["date_id"]
+    if not np.all(keep):
+        cols = dict((k, v[keep]) for k, v in cols.items())
+        di = di[keep]
+    if header["models"]:
+        model_lut = np.full(max(header["models"]) + 1, -1, dtype=np.int64)
+        model_lut[header["models"]] = np.arange(len(header["models"]))
+        mi = model_lut[cols["model"]]
+    else:
+        mi = 0
+    cube[mi, di, cols["hour"] - header["min_hour"], cols["xid"] - 1, cols["yid"] - 1] = cols["wind"]
+
+
+def header_for_csv(fn, workers=1):
+    """
+    Size a cube for a csv file from its sidecar.
+    :return: cube header, sidecar meta
+    """
+    meta = sidecar.load_sidecar(fn, workers=workers)
+    header = make_header(meta["xsize"], meta["ysize"], meta["min_hour"], meta["max_hour"], meta["days"],
+                         meta["models"])
+    return header, meta
+
+
+def fill_from_csv(cube, header, fn, meta):
+    count = 0
+    for cols in chunked_csv.read_columns(fn, meta["header"] + "\n"):
+        store_columns(cube, header, cols)
+        count += len(cols["wind"])
+    return count
+
+
+def ingest_range(job):
+    """
+    Worker : parse one byte range of a csv file straight into the cube file.
+    Every row has its own cell, so workers never write the same place.
+    :param job: csv file name, cube file name, column names, start and end offsets
+    :return: rows stored
+    """
+    infile, outfile, names, start, end = job
+    cube, header = open_cube(outfile, "r+")
+    count = 0
+    for cols in chunked_csv.read_range_columns(infile, names, start, end):
+        store_columns(cube, header, cols)
+        count += len(cols["wind"])
+    cube.flush()
+    return count
+
+
+def fill_from_csv_parallel(outfile, fn, meta, workers):
+    """
+    Parse a csv file into an existing cube file using a pool of processes,
+    each handling newline aligned byte ranges of the csv.
+    :return: rows stored
+    """
+    ranges = chunked_csv.byte_ranges(fn, meta["data_offset"], workers * RANGES_PER_WORKER)
+    names = chunked_csv.header_names(meta["header"])
+    jobs = [(fn, outfile, names, start, end) for start, end in ranges]
+    logging.warning("  {} byte ranges over {} workers".format(len(jobs), workers))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(ingest_range, jobs))
+
+
+def fill_day_from_csv(cube, header, fn, meta, date_id):
+    """
+    Read only the rows of one day, seeking to them with the sidecar run index.
+    Falls back to reading the whole file if the index cannot locate the day.
+    :return: rows stored
+    """
+    ranges = sidecar.day_ranges(fn, date_id)
+    if ranges is None:
+        logging.warning("  no run index for {} - reading the whole file".format(fn))
+        return fill_from_csv(cube, header, fn, meta)
+    names = chunked_csv.header_names(meta["header"])
+    count = 0
+    for cols in chunked_csv.read_ranges_columns(fn, names, ranges):
+        store_columns(cube, header, cols)
+        count += len(cols["wind"])
+    return count
+
+
+def load_csv(fn, date_id=None, dtype=DTYPE):
+    """
+    Read a csv weather file straight into an in-memory cube.
+    :param date_id: only read this day - ignored if the file holds a single day
+    :param dtype: of the array - float64 keeps the csv values exactly
+    :return: array of shape (models, days, hours, x, y), header dict
+    """
+    header, meta = header_for_csv(fn)
+    header["dtype"] = np.dtype(dtype).name
+    if date_id is None or len(meta["days"]) == 1:
+        data = np.full(header["shape"], np.nan, dtype=dtype)
+        fill_from_csv(data, header, fn, meta)
+        return data, header
+    if int(date_id) not in meta["days"]:
+        raise ValueError("Day {} not in {} - available days are {}".format(date_id, fn, meta["days"]))
+    header = make_header(meta["xsize"], meta["ysize"], meta["min_hour"], meta["max_hour"], [int(date_id)],
+                         meta["models"], dtype)
+    data = np.full(header["shape"], np.nan, dtype=dtype)
+    fill_day_from_csv(data, header, fn, meta, int(date_id))
+    return data, header
+
+
+def open_any(fn, date_id=None, dtype=DTYPE):
+    """
+    Get the cube of fn whether it is a cube file or a csv file.
+    :param date_id: for csv files, only read this day
+    :param dtype: for csv files, dtype to load as
+    :return: cube array, header dict
+    """
+    if is_cube(fn):
+        return open_cube(fn)
+    return load_csv(fn, date_id, dtype)
+
+
+def header_any(fn):
+    """
+    Header of fn whether it is a cube file or a csv file, without loading any data.
+    """
+    if is_cube(fn):
+        return read_header(fn)[0]
+    return header_for_csv(fn)[0]
+
+
+def csv_to_cube(infile, outfile, workers=1):
+    """
+    Convert a csv weather file into a cube file.
+    :param workers: processes to parse with
+    :return: header of the new cube
+    """
+    header, meta = header_for_csv(infile, workers)
+    logging.warning("Creating cube {} with shape {} ...".format(outfile, header["shape"]))
+    cube = create_cube(outfile, header)
+    logging.warning("Reading {} into cube ...".format(infile))
+    if workers > 1 and not streams.is_compressed(infile):
+        cube.flush()
+        del cube
+        count = fill_from_csv_parallel(outfile, infile, meta, workers)
+    else:
+        count = fill_from_csv(cube, header, infile, meta)
+        cube.flush()
+        del cube
+    logging.warning("  done - {} rows.".format(count))
+    return header
+
+
+def cube_name(fn):
+    """
+    Default cube name for a csv file, compressed or not.
+    """
+    root, _ = os.path.splitext(streams.strip_codec(fn))
+    return root + CUBE_EXTENSION
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", default="ForecastDataforTraining_201712.csv",
+                        help="csv file to convert - xid,yid,date_id,hour[,model],wind")
+    parser.add_argument("-o", "--output", default=None,
+                        help="cube file name - defaults to the input name with a .cube extension")
+    parser.add_argument("-j", "--workers", default=1, type=int, help="processes to parse with")
+    parser.add_argument("-l", "--log", default='WARNING', help="Logging level to use.")
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    nl = getattr(logging, args.log.upper(), None)
+    if not isinstance(nl, int):
+        raise ValueError("Invalid log level: {}".format(args.log))
+    logging.basicConfig(level=nl,
+                        format='%(asctime)s : %(message)s')
+    if args.output is None:
+        args.output = cube_name(args.input)
+    meter = metrics.Metrics("windcube", args.metrics_out)
+    with meter.phase("ingest", nbytes=metrics.file_bytes(args.input)) as phase:
+        header = csv_to_cube(args.input, args.output, args.workers)
+        phase.add(sidecar.load_sidecar(args.input)["rows"])
+    meter.total()
+    logging.warning("Cube shape = {}, days = {}, models = {}".format(header["shape"], header["days"],
+                                                                    header["models"]))
+
+
+if __name__ == '__main__':
+    main()
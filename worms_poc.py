@@ -6,6 +6,9 @@ import random
 import logging
 import sys
 
+import streams
+import windcube
+
 slimit = 15
 
 steps_per_layer = 30  # step every 2 mins
@@ -284,7 +287,7 @@ def show_layers(lys):
 
 def read_cities(cfile):
     cities = []
-    with open(cfile, "r") as f:
+    with streams.open_file(cfile, "r") as f:
         line = f.readline()
         assert line == "cid,xid,yid\n", "Malformed city file header"
         line = f.readline()
@@ -295,75 +298,15 @@ def read_cities(cfile):
     return cities
 
 
-def scan_file_for_dimensions(fn):
-    mx = 0
-    my = 0
-    mxh = 0
-    minh = 24  # hour cannot be beyond end of day
-    count = 0
-    logging.warning("Scanning input file for size information ...")
-    with open(fn, "r") as f:
-        line = f.readline()
-        assert line == EXPECTEDHDR, "Malformed file - header does not match expectations"
-        line = f.readline()
-        while line != '':
-            if count % message_count == 0:
-                print(count)
-            count += 1
-            # note dropping of final \n
-            xid_r, yid_r, date_r, hour_r, wind_r = line[:-1].split(',')
-            xid, yid, hid = int(xid_r), int(yid_r), int(hour_r)
-            if xid > mx:
-                mx = xid
-            if yid > my:
-                my = yid
-            if hid > mxh:
-                mxh = hid
-            if hid < minh:
-                minh = hid
-            line = f.readline()
-        return mx, my, minh, mxh
-
-
 def get_file_data(filename):
     """
-    Scan the file for the dimensions, then create an empty structure and fill with the
-    available data.
-    :param filename: File with the data in it
+    Read the layers of a single day file.
+    :param filename: File with the data in it - csv or cube
     :return:  layers, xsize, ysize
     """
-    xsize, ysize, minh, maxh = scan_file_for_dimensions(filename)
-    nlayers = maxh - minh + 1
-    date_value = -1  # defensive check to ensure we always read the same day
-    logging.warning("xsize = {}, ysize = {}, nlayers = {}".format(xsize, ysize, nlayers))
-    count = 0
-    with open(filename, "r") as f:
-        line = f.readline()
-        assert line == EXPECTEDHDR, "Malformed file - header does not match expectations"
-        line = f.readline()
-        logging.warning("Creating empty data structure ...")
-        layers = [[[0 for y in range(ysize)] for x in range(xsize)] for h in range(nlayers)]  # create empty layer structure
-        logging.warning("Starting to read file data")
-        while line != '':
-            if count % message_count == 0:
-                print(count)
-            count += 1
-            xid_r, yid_r, date_id_r, hour_r, wind_r = line[:-1].split(',')
-            # note -1 to x, y so arrays can start from 0
-            xid, yid, date_id, hour, wind = int(xid_r) - 1, int(yid_r) - 1, int(date_id_r), int(hour_r), float(wind_r)
-            assert 0 <= xid <= xsize, "xid out of range!"
-            assert 0 <= yid <= ysize, "yid out of range!"
-            if date_value < 0:
-                date_value = date_id
-            else:
-                assert date_value == date_id, "Date for more than one day!"
-            try:
-                layers[hour - minh][xid][yid] = wind
-            except IndexError:
-                logging.critical("hour = {} - {} = {}, xid = {}, yid = {}".format(hour, minh, (hour-minh), xid, yid))
-                raise
-            line = f.readline()
-    return layers, xsize, ysize
+    layers, xsize, ysize, _, _ = windcube.read_day_layers(filename)
+    logging.warning("xsize = {}, ysize = {}, nlayers = {}".format(xsize, ysize, len(layers)))
+    return layers.tolist(), xsize, ysize
 
 
 def main():
@@ -426,7 +369,7 @@ def main():
     # TODO: This needs to also include the hour
     for blob in all_blobs:
         filename = "{}_{}_{}.csv".format(args.results, blob["City"][0], blob["City"][1])
-        with open(filename, "w") as f:
+        with streams.open_file(filename, "w") as f:
             for pi in blob["Path"]:
                 line = "{},{}\n".format(pi[0], pi[1])
                 f.write(line)